@@ -5,6 +5,18 @@ import serial
 import serial.tools.list_ports
 import time
 import os
+import glob
+import json
+import re
+import queue
+import multiprocessing
+from multiprocessing import shared_memory
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import numpy as np # Cần cho audio và cv2
 
@@ -34,40 +46,687 @@ except Exception as e:
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
                              QPushButton, QLabel, QComboBox, QTextEdit,
                              QFileDialog, QGroupBox, QMessageBox, QSizePolicy,
-                             QSpacerItem)
-from PyQt5.QtGui import QImage, QPixmap, QFont
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer
+                             QSpacerItem, QCheckBox)
+from PyQt5.QtGui import QImage, QFont, QPainter, QColor
+from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, QTimer, QRect, QSettings
+
+# =============================================================================
+# == Frame Buffer Pool ==
+# =============================================================================
+class PooledFrame:
+    """A captured image plus a reference count on the pool buffer that holds it."""
+    __slots__ = ('image', 'timestamp', 'seq', '_pool', '_slot')
+
+    def __init__(self, image, pool=None, slot=-1):
+        self.image = image
+        self.timestamp = 0.0 # time.monotonic() lúc driver trả frame
+        self.seq = 0         # Số thứ tự frame từ camera
+        self._pool = pool  # None = mảng cấp phát riêng, retain/release không làm gì
+        self._slot = slot
+
+    def retain(self):
+        if self._pool is not None: self._pool._retain(self._slot)
+        return self
+
+    def release(self):
+        if self._pool is not None: self._pool._release(self._slot)
+
+
+class FramePool:
+    """Preallocated ring of frame buffers reused by cap.read(image=...) while no consumer holds them."""
+
+    def __init__(self, shape, count=12, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self._buffers = [np.empty(self.shape, dtype) for _ in range(max(1, int(count)))]
+        self._refs = [0] * len(self._buffers)
+        self._lock = threading.Lock()
+        self._next = 0
+        self.hits = 0    # Lần lấy được buffer tái sử dụng
+        self.misses = 0  # Lần mọi buffer đều bận -> phải cấp phát mới
+
+    def acquire(self):
+        """Return a free buffer with one reference held by the caller (falls back to a fresh array)."""
+        with self._lock:
+            count = len(self._buffers)
+            for step in range(count):
+                slot = (self._next + step) % count
+                if self._refs[slot] == 0:
+                    self._refs[slot] = 1
+                    self._next = (slot + 1) % count
+                    self.hits += 1
+                    return PooledFrame(self._buffers[slot], self, slot)
+            self.misses += 1
+        # Không buffer nào rảnh (preview/ghi đang giữ): không bao giờ ghi đè, cấp phát mảng mới
+        return PooledFrame(np.empty(self.shape, self._buffers[0].dtype))
+
+    def _retain(self, slot):
+        with self._lock:
+            self._refs[slot] += 1
+
+    def _release(self, slot):
+        with self._lock:
+            if self._refs[slot] > 0: self._refs[slot] -= 1
+
+    def counters(self):
+        with self._lock:
+            in_use = sum(1 for r in self._refs if r > 0)
+        return {'pool_size': len(self._buffers), 'pool_in_use': in_use,
+                'pool_hits': self.hits, 'pool_misses': self.misses}
+
+
+# =============================================================================
+# == Latest-Frame Mailbox ==
+# =============================================================================
+class FrameMailbox:
+    """Single-slot, latest-frame-wins handoff between a producer thread and a polling consumer."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._frame = None
+        self._seq = 0 # Số thứ tự frame mới nhất (0 = chưa có frame)
+
+    def put(self, frame):
+        """Replace the slot content with a newer PooledFrame (retained) and return its sequence number."""
+        frame.retain()
+        with self._lock:
+            self._seq += 1
+            old, self._frame = self._frame, frame # Frame cũ (nếu chưa được lấy) bị ghi đè, không xếp hàng
+            seq = self._seq
+        if old is not None: old.release()
+        return seq
+
+    def get(self, last_seq=0):
+        """
+        Return (seq, frame) if a frame newer than last_seq is available, else (last_seq, None).
+        The returned frame is retained for the caller, who must release() it when done.
+        """
+        with self._lock:
+            if self._seq == last_seq or self._frame is None:
+                return last_seq, None
+            return self._seq, self._frame.retain()
+
+    def clear(self):
+        with self._lock:
+            old, self._frame = self._frame, None
+        if old is not None: old.release()
+
+
+class PreRollBuffer:
+    """Copies of the most recent frames, bounded by seconds and bytes, flushed into a recording at START."""
+
+    def __init__(self, max_seconds=0.0, max_bytes=0):
+        self._frames = deque()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._spare = None # Mảng của frame vừa bị loại, dùng lại cho bản sao kế tiếp
+        self._closed = False # Sau shutdown(): luồng capture có thể còn giữ tham chiếu cũ, push() bỏ qua
+        self.configure(max_seconds, max_bytes)
+
+    def configure(self, max_seconds, max_bytes):
+        """Change the limits; 0 seconds or 0 bytes disables the buffer."""
+        with self._lock:
+            self.max_seconds = max(0.0, float(max_seconds))
+            self.max_bytes = max(0, int(max_bytes))
+            if not self.enabled:
+                self._frames.clear()
+                self._bytes = 0
+                self._spare = None
+            else:
+                self._trim(self._frames[-1].timestamp if self._frames else None)
+
+    @property
+    def enabled(self):
+        return self.max_seconds > 0 and self.max_bytes > 0
+
+    def push(self, frame):
+        """Copy a delivered frame into the ring (called from the capture thread)."""
+        if not self.enabled or self._closed: return
+        with self._lock:
+            spare, self._spare = self._spare, None
+        if spare is not None and spare.shape == frame.image.shape:
+            np.copyto(spare, frame.image)
+            image = spare
+        else:
+            image = frame.image.copy()
+        entry = PooledFrame(image)
+        entry.timestamp = frame.timestamp
+        entry.seq = frame.seq
+        with self._lock:
+            self._frames.append(entry)
+            self._bytes += image.nbytes
+            self._trim(frame.timestamp)
+
+    def _trim(self, newest_ts):
+        # Loại frame cũ khi vượt giới hạn dung lượng hoặc quá số giây cho phép (caller giữ lock)
+        while self._frames and (self._bytes > self.max_bytes or
+                                (newest_ts is not None and newest_ts - self._frames[0].timestamp > self.max_seconds)):
+            self._evict(self._frames.popleft())
+
+    def _evict(self, old):
+        self._bytes -= old.image.nbytes
+        self._spare = old.image
+
+    def take_all(self):
+        """Remove and return the buffered frames, oldest first."""
+        with self._lock:
+            frames = list(self._frames)
+            self._frames.clear()
+            self._bytes = 0
+        return frames
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+            self._bytes = 0
+
+    def oldest_timestamp(self):
+        """Capture time of the oldest buffered frame, or None when empty."""
+        with self._lock:
+            return self._frames[0].timestamp if self._frames else None
+
+    def review_frames(self):
+        """Copies of the buffered frames (oldest first) without removing them."""
+        with self._lock:
+            frames = list(self._frames)
+            copies = []
+            for frame in frames:
+                copy = PooledFrame(frame.image.copy())
+                copy.timestamp, copy.seq = frame.timestamp, frame.seq
+                copies.append(copy)
+        return copies
+
+    def shutdown(self):
+        """Release resources when the buffer is replaced or the webcam stops; later pushes are ignored."""
+        self._closed = True
+        self.clear()
+
+    def usage(self):
+        """Current fill: frames, seconds covered and MB held."""
+        with self._lock:
+            count = len(self._frames)
+            span = self._frames[-1].timestamp - self._frames[0].timestamp if count > 1 else 0.0
+            return {'preroll_frames': count, 'preroll_seconds': span, 'preroll_mode': 'raw',
+                    'preroll_mb': self._bytes / (1024 * 1024), 'preroll_enabled': self.enabled}
+
+
+class EncodedFrame:
+    """A JPEG-compressed frame from CompressedPreRollBuffer, decoded on first access to .image.
+
+    The decoded image is dropped when the last reference is released, so a sink writing a pre-roll
+    block holds only the frame it is encoding, not every frame decoded so far.
+    """
+    __slots__ = ('future', 'timestamp', 'seq', 'nbytes', 'evicted', '_image', '_refs')
+
+    def __init__(self, future, timestamp, seq):
+        self.future = future   # Future trả về (jpeg_bytes, raw_bytes, encode_seconds)
+        self.timestamp = timestamp
+        self.seq = seq
+        self.nbytes = 0        # Kích thước JPEG, biết được khi mã hóa xong
+        self.evicted = False
+        self._image = None
+        self._refs = 1         # Tham chiếu của người nhận frame (sink/review)
+
+    @property
+    def image(self):
+        if self._image is None:
+            data = self.future.result()[0]
+            self._image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        return self._image
+
+    def retain(self):
+        self._refs += 1
+        return self
+
+    def release(self):
+        self._refs -= 1
+        if self._refs <= 0: self._image = None # Chỉ giữ bản JPEG; lần đọc .image sau sẽ giải mã lại
+
+
+class CompressedPreRollBuffer(PreRollBuffer):
+    """Pre-roll that stores frames as JPEG, encoded by a small thread pool (cv2.imencode releases the GIL)."""
+
+    def __init__(self, max_seconds=0.0, max_bytes=0, quality=90, workers=2):
+        """
+        Initializes the CompressedPreRollBuffer.
+
+        Args:
+            max_seconds (float): Seconds of video to keep.
+            max_bytes (int): Limit on the compressed bytes held.
+            quality (int): JPEG quality (0-100).
+            workers (int): Encoder threads; at most 2x this many frames wait for encoding, extra
+                frames are left out of the pre-roll instead of piling up.
+        """
+        self.quality = int(quality)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="PreRollJPEG")
+        self._max_pending = 2 * max(1, int(workers))
+        self._pending = 0
+        self._started = time.monotonic()
+        self.frames_encoded = 0
+        self.frames_skipped = 0  # Frame không vào pre-roll vì encoder chưa theo kịp
+        self.raw_bytes = 0
+        self.encoded_bytes = 0
+        self.encode_seconds = 0.0
+        super().__init__(max_seconds, max_bytes)
+
+    def push(self, frame):
+        if not self.enabled: return
+        with self._lock:
+            if self._closed: return # Bộ đệm đã được thay trên luồng GUI
+            if self._pending >= self._max_pending:
+                self.frames_skipped += 1
+                return
+            self._pending += 1
+        frame.retain() # Giữ buffer của pool đến khi mã hóa xong
+        entry = EncodedFrame(None, frame.timestamp, frame.seq)
+        with self._lock:
+            self._frames.append(entry)
+            self._trim(frame.timestamp)
+        try:
+            entry.future = self._executor.submit(self._encode, frame)
+        except RuntimeError:
+            # shutdown() chen vào giữa lần kiểm tra _closed và submit: bỏ frame này
+            frame.release()
+            with self._lock:
+                self._pending -= 1
+                if entry in self._frames: self._frames.remove(entry)
+            return
+        entry.future.add_done_callback(lambda future, entry=entry: self._on_encoded(entry, future))
+
+    def _encode(self, frame):
+        t0 = time.perf_counter()
+        try:
+            ok, data = cv2.imencode('.jpg', frame.image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok: raise IOError("cv2.imencode thất bại")
+            return data.tobytes(), frame.image.nbytes, time.perf_counter() - t0
+        finally:
+            frame.release()
+
+    def _on_encoded(self, entry, future):
+        with self._lock:
+            self._pending -= 1
+            if future.cancelled() or future.exception() is not None: return
+            data, raw_bytes, seconds = future.result()
+            entry.nbytes = len(data)
+            self.frames_encoded += 1
+            self.raw_bytes += raw_bytes
+            self.encoded_bytes += len(data)
+            self.encode_seconds += seconds
+            if not entry.evicted:
+                self._bytes += entry.nbytes
+                self._trim(None)
+
+    def _evict(self, old):
+        old.evicted = True
+        self._bytes -= old.nbytes
+
+    @staticmethod
+    def _completed(frames):
+        # Chờ các frame đang mã hóa dở (tối đa vài frame) và bỏ frame mã hóa lỗi
+        done = []
+        for frame in frames:
+            try:
+                frame.future.result()
+                done.append(frame)
+            except Exception as e:
+                print(f"Pre-roll JPEG encode failed: {e}", file=sys.stderr)
+        return done
+
+    def take_all(self):
+        return self._completed(super().take_all())
+
+    def review_frames(self):
+        """The buffered frames (oldest first), still compressed; each decodes when its image is read."""
+        with self._lock:
+            frames = [EncodedFrame(f.future, f.timestamp, f.seq) for f in self._frames if f.future is not None]
+        return self._completed(frames)
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        self.clear()
+        self._executor.shutdown(wait=False)
+
+    def usage(self):
+        stats = super().usage()
+        with self._lock:
+            elapsed = max(1e-6, time.monotonic() - self._started)
+            stats.update(preroll_mode='jpeg',
+                         preroll_ratio=self.raw_bytes / self.encoded_bytes if self.encoded_bytes else 0.0,
+                         preroll_encode_ms=1000.0 * self.encode_seconds / self.frames_encoded if self.frames_encoded else 0.0,
+                         preroll_encode_fps=self.frames_encoded / elapsed,
+                         preroll_skipped=self.frames_skipped)
+        return stats
+
+
+# =============================================================================
+# == Capture Backend Strategy ==
+# =============================================================================
+SETTINGS_ORG = "SerialCAM"
+SETTINGS_APP = "SerialCAM_Monitoring"
+
+
+def _backend_ids(*names):
+    """Resolve cv2.CAP_* names that exist in this OpenCV build."""
+    return [getattr(cv2, name) for name in names if hasattr(cv2, name)]
+
+
+# Thứ tự thử backend theo hệ điều hành; CAP_ANY luôn là phương án cuối
+if sys.platform.startswith('linux'):
+    CAPTURE_BACKEND_PREFERENCES = _backend_ids('CAP_V4L2', 'CAP_ANY')
+elif sys.platform == 'win32':
+    CAPTURE_BACKEND_PREFERENCES = _backend_ids('CAP_DSHOW', 'CAP_MSMF', 'CAP_ANY')
+elif sys.platform == 'darwin':
+    CAPTURE_BACKEND_PREFERENCES = _backend_ids('CAP_AVFOUNDATION', 'CAP_ANY')
+else:
+    CAPTURE_BACKEND_PREFERENCES = _backend_ids('CAP_ANY')
+
+
+def backend_name(api):
+    """Human readable name of a cv2.CAP_* id."""
+    try: return cv2.videoio_registry.getBackendName(api)
+    except Exception: return "ANY" if api == getattr(cv2, 'CAP_ANY', 0) else str(api)
+
+
+def camera_device_key(index):
+    """
+    Stable identifier of a camera for per-device caches.
+
+    On Linux the /dev/v4l/by-id link (USB vendor/product/serial) or the sysfs driver name is used,
+    so the cache follows the camera when its /dev/videoN number changes; elsewhere the index is all
+    OpenCV exposes.
+    """
+    if sys.platform.startswith('linux'):
+        node = os.path.realpath(f"/dev/video{index}")
+        for link in sorted(glob.glob('/dev/v4l/by-id/*')):
+            if os.path.realpath(link) == node:
+                return re.sub(r'[^A-Za-z0-9.-]+', '-', os.path.basename(link))
+        try:
+            with open(f"/sys/class/video4linux/video{index}/name", encoding='utf-8') as f:
+                return re.sub(r'[^A-Za-z0-9.-]+', '-', f.read().strip()) + f"-{index}"
+        except OSError:
+            pass
+    return str(index)
+
+
+class CaptureBackendRegistry:
+    """Remembers, per device, which backend opened it fastest; persisted with QSettings."""
+    FORGET_AFTER_FAILURES = 3 # Lỗi liên tiếp trước khi bỏ backend đã nhớ (một lần "device busy" không tính)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = None # {device: {api: open_ms}} chỉ cho các lần mở thành công
+        self._failures = {}  # {(device, api): số lần mở lỗi liên tiếp}, chỉ trong phiên chạy
+
+    def _load(self):
+        if self._timings is not None: return
+        self._timings = {}
+        settings = QSettings(SETTINGS_ORG, SETTINGS_APP)
+        settings.beginGroup("capture_backends")
+        for key in settings.childKeys():
+            device, _, api = key.rpartition("_")
+            try: self._timings.setdefault(device, {})[int(api)] = float(settings.value(key))
+            except (TypeError, ValueError): continue
+        settings.endGroup()
+
+    def _save(self, device, api, open_ms):
+        settings = QSettings(SETTINGS_ORG, SETTINGS_APP)
+        settings.setValue(f"capture_backends/{device}_{api}", open_ms)
+
+    def _forget(self, device, api):
+        settings = QSettings(SETTINGS_ORG, SETTINGS_APP)
+        settings.remove(f"capture_backends/{device}_{api}")
+
+    def known(self, device):
+        """True if at least one backend has opened this device before."""
+        with self._lock:
+            self._load()
+            return bool(self._timings.get(str(device)))
+
+    def order(self, device):
+        """Backends to try for a device: known winners (fastest first), then the platform list."""
+        with self._lock:
+            self._load()
+            timings = self._timings.get(str(device), {})
+        ordered = sorted(timings, key=timings.get)
+        return ordered + [api for api in CAPTURE_BACKEND_PREFERENCES if api not in ordered]
+
+    def record(self, device, api, open_ms, opened, count_failure=True):
+        """
+        Record one open attempt.
+
+        A known backend is forgotten only after FORGET_AFTER_FAILURES consecutive failures;
+        count_failure=False (background scan probes, which often hit a busy device) never forgets.
+        """
+        device = str(device)
+        with self._lock:
+            self._load()
+            timings = self._timings.setdefault(device, {})
+            if opened:
+                self._failures.pop((device, api), None)
+                timings[api] = open_ms
+                self._save(device, api, open_ms)
+            elif api in timings and count_failure:
+                failures = self._failures.get((device, api), 0) + 1
+                self._failures[(device, api)] = failures
+                if failures >= self.FORGET_AFTER_FAILURES:
+                    del timings[api]
+                    del self._failures[(device, api)]
+                    self._forget(device, api)
+
+
+CAPTURE_BACKENDS = CaptureBackendRegistry()
+
+
+def open_capture(index, try_all=False, probe=False):
+    """
+    Open a camera using the backend strategy.
+
+    Known-good backends for this device are tried first, then the per-platform preference list.
+    With try_all every candidate is opened once and timed (used by background scans to learn the
+    fastest backend). probe=True marks a scan probe, whose failures do not count against a known
+    backend. Returns (cap or None, api or None, attempts) where attempts is a list of
+    (backend name, open_ms, opened).
+    """
+    device = camera_device_key(index)
+    attempts = []
+    best = None # (open_ms, api)
+    for api in CAPTURE_BACKENDS.order(device):
+        t0 = time.perf_counter()
+        cap = cv2.VideoCapture(index, api)
+        opened = cap.isOpened()
+        open_ms = (time.perf_counter() - t0) * 1000.0
+        attempts.append((backend_name(api), open_ms, opened))
+        CAPTURE_BACKENDS.record(device, api, open_ms, opened, count_failure=not probe)
+        if opened and not try_all:
+            return cap, api, attempts
+        cap.release()
+        if opened and (best is None or open_ms < best[0]): best = (open_ms, api)
+    if best is not None:
+        # Mở lại bằng backend nhanh nhất vừa đo được
+        cap = cv2.VideoCapture(index, best[1])
+        if cap.isOpened(): return cap, best[1], attempts
+        cap.release()
+    return None, None, attempts
+
+
+# =============================================================================
+# == Camera Format Negotiation ==
+# =============================================================================
+# Các tổ hợp được dò khi mở camera. FPS yêu cầu cao để driver tự kẹp về mức tối đa của chế độ đó.
+CAPTURE_PROBE_FOURCCS = ('MJPG', 'YUYV')
+CAPTURE_PROBE_RESOLUTIONS = ((640, 480), (800, 600), (1280, 720), (1280, 960),
+                             (1600, 1200), (1920, 1080), (2560, 1440), (3840, 2160))
+CAPTURE_PROBE_FPS = 60.0
+
+
+def fourcc_to_str(value):
+    """Decode a CAP_PROP_FOURCC value into its four-character code ('' if unknown)."""
+    code = int(value)
+    if code <= 0: return ""
+    return "".join(chr((code >> (8 * i)) & 0xFF) for i in range(4)).strip("\x00 ")
+
+
+def apply_capture_format(cap, fourcc=None, width=None, height=None, fps=None):
+    """
+    Request a FOURCC/resolution/frame rate on an opened capture and read back what took effect.
+
+    FOURCC is set before the size because V4L2 and DirectShow pick the size list from the
+    active pixel format. Returns a dict with the actual 'fourcc', 'width', 'height', 'fps'.
+    """
+    if fourcc: cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    if width: cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    if height: cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    if fps: cap.set(cv2.CAP_PROP_FPS, fps)
+    return {'fourcc': fourcc_to_str(cap.get(cv2.CAP_PROP_FOURCC)),
+            'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': float(cap.get(cv2.CAP_PROP_FPS))}
+
+
+def probe_capture_modes(cap, fourccs=CAPTURE_PROBE_FOURCCS, resolutions=CAPTURE_PROBE_RESOLUTIONS):
+    """
+    Build the table of modes the driver accepts by setting each candidate and reading it back.
+
+    Returns a list of dicts ('fourcc', 'width', 'height', 'fps') sorted by format then size.
+    The capture is left in the last probed mode; callers re-apply the mode they want.
+    """
+    modes = []
+    seen = set()
+    for fourcc in fourccs:
+        for width, height in resolutions:
+            actual = apply_capture_format(cap, fourcc, width, height, CAPTURE_PROBE_FPS)
+            # Một số backend không báo FOURCC (trả về 0) -> giữ định dạng đã yêu cầu
+            actual_fourcc = actual['fourcc'] or fourcc
+            if actual_fourcc != fourcc or (actual['width'], actual['height']) != (width, height):
+                continue
+            key = (fourcc, width, height)
+            if key in seen: continue
+            seen.add(key)
+            modes.append({'fourcc': fourcc, 'width': width, 'height': height,
+                          'fps': actual['fps'] if 0 < actual['fps'] < 1000 else 0.0})
+    return modes
+
+
+# =============================================================================
+# == Capture Statistics ==
+# =============================================================================
+class CaptureStats:
+    """Tracks delivered FPS, inter-frame jitter and estimated driver-side drops."""
+
+    def __init__(self, nominal_fps, window=120):
+        self.nominal_period = 1.0 / nominal_fps if nominal_fps and nominal_fps > 0 else None
+        self._times = deque(maxlen=window)      # Thời điểm nhận frame từ driver (time.monotonic)
+        self._intervals = deque(maxlen=window)  # Khoảng cách giữa các frame (giây)
+        self.frames_captured = 0    # Frame driver trả về
+        self.frames_delivered = 0   # Frame được chuyển tiếp cho preview/ghi
+        self.frames_decimated = 0   # Frame bỏ qua có chủ đích (chế độ tốc độ mục tiêu)
+        self.estimated_drops = 0    # Frame ước tính bị mất phía driver (khoảng trống trong dòng thời gian)
+
+    def on_captured(self, timestamp):
+        """Record a frame returned by the driver at the given monotonic timestamp."""
+        if self._times:
+            interval = timestamp - self._times[-1]
+            self._intervals.append(interval)
+            period = self.nominal_period
+            if period and interval > 1.5 * period:
+                self.estimated_drops += int(round(interval / period)) - 1
+        self._times.append(timestamp)
+        self.frames_captured += 1
+
+    def source_period(self):
+        """Measured period between driver frames, falling back to the nominal one."""
+        if len(self._times) >= 2:
+            return (self._times[-1] - self._times[0]) / (len(self._times) - 1)
+        return self.nominal_period or (1.0 / 30.0)
+
+    def snapshot(self):
+        """Return a dict of the current statistics."""
+        capture_fps = 0.0
+        jitter_ms = 0.0
+        if len(self._times) >= 2:
+            span = self._times[-1] - self._times[0]
+            if span > 0: capture_fps = (len(self._times) - 1) / span
+            jitter_ms = float(np.std(self._intervals)) * 1000.0
+        delivered_fps = capture_fps
+        if self.frames_captured:
+            delivered_fps = capture_fps * self.frames_delivered / self.frames_captured
+        return {'capture_fps': capture_fps, 'delivered_fps': delivered_fps, 'jitter_ms': jitter_ms,
+                'captured': self.frames_captured, 'delivered': self.frames_delivered,
+                'decimated': self.frames_decimated, 'driver_drops': self.estimated_drops}
+
 
 # =============================================================================
 # == Webcam Worker Thread (Giữ nguyên như code gốc) ==
 # =============================================================================
 class WebcamThread(QThread):
     """Handles video capture in a separate thread."""
-    frame_ready = pyqtSignal(object)       # Emits the captured frame (numpy array)
     error = pyqtSignal(str)              # Emits error messages
     properties_ready = pyqtSignal(int, int, float) # Emits width, height, fps on successful open
+    stats_ready = pyqtSignal(dict)       # Emits CaptureStats.snapshot() about once per second
+    modes_ready = pyqtSignal(list)       # Emits the probed mode table (list of dicts)
+    backend_ready = pyqtSignal(str, list) # Emits backend name and open attempts [(name, ms, opened)]
+    format_applied = pyqtSignal(dict, dict) # Emits (requested, actual) capture format
+
+    STATS_INTERVAL = 1.0 # Giây giữa hai lần phát stats_ready
+    FRAME_POOL_SIZE = 12 # Số buffer dùng lại cho cap.read (preview + hàng đợi ghi giữ đồng thời)
+
+    def __init__(self, webcam_index, target_fps=None, capture_format=None, probe_modes=False):
+        """
+        Initializes the WebcamThread.
 
-    def __init__(self, webcam_index):
+        Args:
+            webcam_index (int): Camera index passed to cv2.VideoCapture.
+            target_fps (float, optional): Deliver at most this many frames per second. Extra frames
+                are grabbed but never decoded (grab()/retrieve() split). None = every camera frame.
+            capture_format (dict, optional): Requested 'fourcc', 'width', 'height', 'fps'.
+                None keeps whatever the driver picks.
+            probe_modes (bool): Probe the supported mode table after opening and emit modes_ready.
+        """
         super().__init__()
         self.webcam_index = webcam_index
+        self.target_fps = target_fps if target_fps and target_fps > 0 else None
+        self.capture_format = capture_format
+        self.probe_modes = probe_modes
         self.cap = None
         self._is_running = True
         self._width = 0
         self._height = 0
         self._fps = 0.0
+        # RecordingSink đang nhận frame (None = không ghi). MainWindow gán/gỡ thuộc tính này;
+        # phép gán tham chiếu trong Python là nguyên tử nên không cần khóa.
+        self.recording_sink = None
+        self._pending_sink = None # Sink chờ luồng capture gắn vào sau khi xả pre-roll
+        self.preroll = None # PreRollBuffer (tùy chọn) giữ vài giây frame trước lệnh START
+        # Preview lấy frame mới nhất từ mailbox theo nhịp riêng, thay vì một sự kiện Qt mỗi frame
+        self.preview_mailbox = FrameMailbox()
+        self.stats = None
+        self.frame_pool = None
         # print(f"Initializing WebcamThread for index {self.webcam_index}") # (Giữ log nếu muốn)
 
     def run(self):
         # print(f"WebcamThread {self.webcam_index}: Starting run loop.")
-        self.cap = cv2.VideoCapture(self.webcam_index, cv2.CAP_MSMF)
-        if not self.cap.isOpened():
-            # print(f"Webcam {self.webcam_index}: Failed with MSMF, trying default backend...")
-            self.cap = cv2.VideoCapture(self.webcam_index)
-            if not self.cap.isOpened():
-                self.error.emit(f"Không thể mở webcam {self.webcam_index} với bất kỳ backend nào.")
-                self._is_running = False
-                # print(f"WebcamThread {self.webcam_index}: Failed to open with any backend.")
-                return
+        # Backend đã biết cho thiết bị này được thử trước, sau đó mới đến danh sách theo hệ điều hành
+        self.cap, api, attempts = open_capture(self.webcam_index)
+        if self.cap is None:
+            self.error.emit(f"Không thể mở webcam {self.webcam_index} với bất kỳ backend nào.")
+            self._is_running = False
+            # print(f"WebcamThread {self.webcam_index}: Failed to open with any backend.")
+            return
+        self.backend_ready.emit(backend_name(api), attempts)
+
+        # Chế độ mặc định của driver (để trả lại sau khi dò nếu không yêu cầu định dạng cụ thể)
+        requested = dict(self.capture_format) if self.capture_format else apply_capture_format(self.cap)
+        if self.probe_modes:
+            try:
+                modes = probe_capture_modes(self.cap)
+                print(f"Webcam {self.webcam_index}: {len(modes)} capture modes probed.")
+                self.modes_ready.emit(modes)
+            except Exception as e:
+                print(f"Webcam {self.webcam_index}: Mode probing failed: {e}", file=sys.stderr)
+        if self.capture_format or self.probe_modes:
+            actual = apply_capture_format(self.cap, requested.get('fourcc') or None, requested.get('width'),
+                                          requested.get('height'), requested.get('fps') or None)
+            if self.capture_format: self.format_applied.emit(requested, actual)
 
         self._width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self._height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
@@ -75,187 +734,2462 @@ class WebcamThread(QThread):
         if not (0 < self._fps < 150):
             # print(f"Warning: Invalid FPS ({self._fps:.2f}) detected for webcam {self.webcam_index}. Defaulting to 30.0")
             self._fps = 30.0
-        self.properties_ready.emit(self._width, self._height, self._fps)
+        self.stats = CaptureStats(self._fps)
+        self.frame_pool = FramePool((self._height, self._width, 3), self.FRAME_POOL_SIZE)
+        # Tốc độ ghi thực tế là tốc độ mục tiêu nếu nó thấp hơn tốc độ camera
+        output_fps = min(self._fps, self.target_fps) if self.target_fps else self._fps
+        self.properties_ready.emit(self._width, self._height, output_fps)
         # print(f"Webcam {self.webcam_index} opened successfully ({self._width}x{self._height} @ {self._fps:.2f} FPS)")
 
+        # Vòng lặp được điều nhịp bởi chính lời gọi đọc (chặn đến khi driver có frame mới),
+        # không ngủ cố định: ngủ làm driver đầy buffer và mất frame, còn read() đã chờ sẵn.
+        next_due = None
+        last_stats_emit = time.monotonic()
         while self._is_running:
-            ret, frame = self.cap.read()
-            if ret:
-                self.frame_ready.emit(frame)
+            if self.target_fps:
+                ret = self.cap.grab()
+                frame = None
             else:
+                ret, frame = self._read_into_pool(self.cap.read)
+            if not ret:
                 if self._is_running:
                     self.error.emit(f"Mất kết nối với webcam {self.webcam_index} hoặc đọc frame thất bại.")
                     # print(f"WebcamThread {self.webcam_index}: Frame read failed or lost connection.")
                 self._is_running = False
                 break
-            self.msleep(max(1, int(1000 / (self._fps * 1.5)))) # Điều chỉnh sleep dựa trên FPS
 
-        if self.cap and self.cap.isOpened():
-            # print(f"WebcamThread {self.webcam_index}: Releasing capture...")
-            self.cap.release()
-        # print(f"WebcamThread {self.webcam_index}: Exiting run loop.")
+            now = time.monotonic()
+            self.stats.on_captured(now)
+
+            if self.target_fps:
+                # Giảm tốc theo thời gian: chỉ giải mã (retrieve) frame đến hạn. Dung sai nửa chu kỳ
+                # camera tránh hiện tượng "beat" khi tốc độ mục tiêu gần bằng tốc độ camera.
+                target_period = 1.0 / self.target_fps
+                tolerance = 0.5 * self.stats.source_period()
+                if next_due is None or now >= next_due - tolerance:
+                    # Đồng bộ lại sau khi trễ quá một chu kỳ, tránh xả liền một loạt frame
+                    if next_due is None or now - next_due > target_period: next_due = now
+                    next_due += target_period
+                    ret, frame = self._read_into_pool(self.cap.retrieve)
+                else:
+                    self.stats.frames_decimated += 1
+
+            if frame is not None:
+                frame.timestamp = now
+                frame.seq = self.stats.frames_captured
+                self.stats.frames_delivered += 1
+                self._deliver(frame)
+                frame.release() # Trả tham chiếu của vòng lặp; buffer tái sử dụng khi preview/ghi trả nốt
+
+            if now - last_stats_emit >= self.STATS_INTERVAL:
+                last_stats_emit = now
+                snapshot = self.stats.snapshot()
+                snapshot.update(self.frame_pool.counters())
+                if self.preroll is not None: snapshot.update(self.preroll.usage())
+                self.stats_ready.emit(snapshot)
+
+        if self.cap and self.cap.isOpened():
+            # print(f"WebcamThread {self.webcam_index}: Releasing capture...")
+            self.cap.release()
+        # print(f"WebcamThread {self.webcam_index}: Exiting run loop.")
+
+    def _read_into_pool(self, read):
+        """Decode with cap.read/cap.retrieve into a pooled buffer. Returns (ret, PooledFrame or None)."""
+        frame = self.frame_pool.acquire()
+        ret, image = read(frame.image)
+        if not ret or image is None:
+            frame.release()
+            return ret, None
+        if image is not frame.image:
+            # Driver đã cấp phát mảng khác (kích thước/định dạng thay đổi): dựng lại pool theo hình dạng mới
+            frame.release()
+            if image.shape != self.frame_pool.shape:
+                print(f"Webcam {self.webcam_index}: Frame shape changed to {image.shape}, rebuilding buffer pool.")
+                self.frame_pool = FramePool(image.shape, self.FRAME_POOL_SIZE)
+            frame = PooledFrame(image)
+        return ret, frame
+
+    def _deliver(self, frame):
+        """Hand a decoded PooledFrame to the recording sink and the preview mailbox (each retains it)."""
+        preroll = self.preroll # MainWindow có thể thay bộ đệm (thô/JPEG) trong lúc chạy
+        pending = self._pending_sink
+        if pending is not None:
+            # Gắn sink mới tại đây để frame pre-roll chắc chắn vào hàng đợi trước frame hiện tại
+            self._pending_sink = None
+            if preroll is not None: pending.push_preroll(preroll.take_all())
+            self.recording_sink = pending
+        # Đẩy frame vào hàng đợi ghi ngay tại luồng capture, không đi qua luồng GUI
+        sink = self.recording_sink
+        if sink is not None:
+            sink.push(frame)
+        if preroll is not None:
+            preroll.push(frame)
+        self.preview_mailbox.put(frame)
+
+    def attach_recording_sink(self, sink):
+        """Start feeding a sink; with pre-roll enabled the buffered frames are queued into it first."""
+        if self.preroll is not None and self.preroll.enabled:
+            self._pending_sink = sink
+        else:
+            self.recording_sink = sink
+
+    def detach_recording_sink(self):
+        """Stop feeding the current (or pending) sink."""
+        self._pending_sink = None
+        self.recording_sink = None
+
+    def stop(self):
+        """Requests the thread to stop."""
+        # print(f"WebcamThread {self.webcam_index}: Stop requested.")
+        self._is_running = False
+        if not self.wait(2000):
+             # print(f"Warning: Webcam thread {self.webcam_index} did not finish cleanly after 2s. Terminating.")
+             self.terminate()
+             if self.cap and self.cap.isOpened():
+                  try:
+                      self.cap.release()
+                      # print(f"Webcam {self.webcam_index} capture released after termination.")
+                  except Exception as e:
+                      print(f"Error releasing webcam {self.webcam_index} after termination: {e}")
+        # else:
+            # print(f"WebcamThread {self.webcam_index}: Stopped successfully.")
+        # Double-check release
+        if self.cap and self.cap.isOpened():
+             # print(f"Warning: Webcam {self.webcam_index} capture still open after wait(). Releasing fallback.")
+             try: self.cap.release()
+             except Exception as e: print(f"Error in fallback release for webcam {self.webcam_index}: {e}")
+
+
+# =============================================================================
+# == Camera Discovery Thread ==
+# =============================================================================
+MAX_CAMERA_SCAN_INDEX = 5 # Số index dò thử trên hệ điều hành không liệt kê được thiết bị
+
+
+def list_camera_candidates():
+    """
+    Return [(index, name)] of camera devices worth probing.
+
+    On Linux the /dev/video* nodes are enumerated directly (with the driver name from sysfs)
+    instead of walking indices blindly; elsewhere indices 0..MAX_CAMERA_SCAN_INDEX-1 are tried.
+    """
+    if sys.platform.startswith('linux'):
+        candidates = []
+        for node in glob.glob('/dev/video*'):
+            suffix = node[len('/dev/video'):]
+            if not suffix.isdigit(): continue
+            index = int(suffix)
+            name = f"Webcam {index}"
+            try:
+                with open(f"/sys/class/video4linux/video{index}/name", encoding='utf-8') as f:
+                    name = f"{f.read().strip()} ({index})"
+            except OSError:
+                pass
+            candidates.append((index, name))
+        return sorted(candidates)
+    return [(i, f"Webcam {i}") for i in range(MAX_CAMERA_SCAN_INDEX)]
+
+
+def probe_camera(index):
+    """Try to open a camera index. Returns the backend name that worked, or None."""
+    # Thiết bị chưa có dữ liệu: đo tất cả backend một lần để lần mở sau đi thẳng vào backend nhanh nhất
+    cap, api, attempts = open_capture(index, try_all=not CAPTURE_BACKENDS.known(camera_device_key(index)), probe=True)
+    if cap is None: return None
+    cap.release()
+    if len(attempts) > 1:
+        print(f"Camera {index} backend timings: " +
+              ", ".join(f"{name}={ms:.0f}ms{'' if ok else ' (lỗi)'}" for name, ms, ok in attempts))
+    return backend_name(api)
+
+
+class CameraScanner(QThread):
+    """Probes camera devices concurrently off the GUI thread, reporting each one as it is found."""
+    camera_found = pyqtSignal(int, str, str) # Emits index, display name, backend name
+    scan_finished = pyqtSignal(list, list)   # Emits indices found, indices whose probe timed out or failed
+
+    def __init__(self, probe_timeout=5.0, max_workers=4):
+        """
+        Initializes the CameraScanner.
+
+        Args:
+            probe_timeout (float): Seconds a single probe may take, counted from when it starts;
+                a probe still opening after that is abandoned and its device reported as unresolved.
+            max_workers (int): Number of devices probed at the same time.
+        """
+        super().__init__()
+        self.probe_timeout = probe_timeout
+        self.max_workers = max_workers
+
+    @staticmethod
+    def _probe(index, results):
+        try:
+            results.put((index, probe_camera(index), None))
+        except Exception as e:
+            results.put((index, None, e))
+
+    def run(self):
+        waiting = deque(list_camera_candidates())
+        results = queue.Queue()
+        running = {} # index -> (name, hạn chót theo time.monotonic())
+        found, unresolved = [], []
+        while waiting or running:
+            while waiting and len(running) < self.max_workers:
+                index, name = waiting.popleft()
+                running[index] = (name, time.monotonic() + self.probe_timeout)
+                # Luồng daemon: lượt dò treo trong driver không giữ tiến trình lại khi thoát app
+                threading.Thread(target=self._probe, args=(index, results), name=f"CameraProbe-{index}",
+                                 daemon=True).start()
+            try:
+                timeout = max(0.0, min(deadline for _, deadline in running.values()) - time.monotonic())
+                index, backend, error = results.get(timeout=timeout)
+            except queue.Empty:
+                now = time.monotonic()
+                for index, (_, deadline) in list(running.items()):
+                    if deadline <= now:
+                        # Bỏ lượt dò treo và nhường chỗ cho thiết bị kế tiếp; luồng đó tự kết thúc khi driver trả về
+                        del running[index]
+                        unresolved.append(index)
+                        print(f"Camera probe {index} timed out after {self.probe_timeout:.1f}s, abandoning it")
+                continue
+            if index not in running: continue # Kết quả muộn của lượt dò đã bỏ
+            name, _ = running.pop(index)
+            if error is not None:
+                print(f"Camera probe {index} failed: {error}", file=sys.stderr)
+                unresolved.append(index)
+            elif backend:
+                found.append(index)
+                self.camera_found.emit(index, name, backend)
+        self.scan_finished.emit(sorted(found), sorted(unresolved))
+
+
+# =============================================================================
+# == Preview Worker Thread ==
+# =============================================================================
+class PreviewWorker(QThread):
+    """Downscales the latest captured frame to the preview size at its own, lower frame rate."""
+
+    def __init__(self, source_mailbox, preview_fps=15.0):
+        """
+        Initializes the PreviewWorker.
+
+        Args:
+            source_mailbox (FrameMailbox): Full-resolution frames published by WebcamThread.
+            preview_fps (float): How many preview frames per second to produce.
+        """
+        super().__init__()
+        self.source_mailbox = source_mailbox
+        self.output_mailbox = FrameMailbox() # Frame đã thu nhỏ, GUI kéo về theo nhịp vẽ
+        self.preview_fps = preview_fps
+        self._target_size = (0, 0) # (w, h) vùng hiển thị; GUI cập nhật, gán tuple là nguyên tử
+        self._is_running = True
+        self._pool = None
+        self.frames_scaled = 0
+
+    def set_target_size(self, width, height):
+        self._target_size = (int(width), int(height))
+
+    def set_preview_fps(self, fps):
+        self.preview_fps = max(1.0, float(fps))
+
+    def _scaled_shape(self, image):
+        """Output (h, w) that fits the target size, or None to pass the frame through unchanged."""
+        target_w, target_h = self._target_size
+        h, w = image.shape[:2]
+        if target_w <= 0 or target_h <= 0: return None
+        scale = min(target_w / w, target_h / h)
+        if scale >= 1.0: return None # Không phóng to: việc đó để QPainter làm khi vẽ
+        return max(1, int(h * scale)), max(1, int(w * scale))
+
+    def run(self):
+        last_seq = 0
+        next_tick = time.monotonic()
+        while self._is_running:
+            period = 1.0 / self.preview_fps
+            next_tick += period
+            last_seq, frame = self.source_mailbox.get(last_seq)
+            if frame is not None:
+                try:
+                    self._publish(frame)
+                except Exception as e:
+                    print(f"PreviewWorker: Error scaling frame: {e}", file=sys.stderr)
+                finally:
+                    frame.release()
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                self.msleep(int(delay * 1000))
+            else:
+                next_tick = time.monotonic() # Trễ nhịp: không cố bù, chỉ lấy lại mốc
+        self.output_mailbox.clear()
+
+    def _publish(self, frame):
+        shape = self._scaled_shape(frame.image)
+        if shape is None:
+            self.output_mailbox.put(frame)
+            return
+        out_h, out_w = shape
+        if self._pool is None or self._pool.shape != (out_h, out_w, 3):
+            self._pool = FramePool((out_h, out_w, 3), count=3)
+        scaled = self._pool.acquire()
+        image = frame.image
+        # Thu nhỏ nhiều lần bằng pyrDown (rẻ) rồi INTER_AREA cho bước cuối
+        while image.shape[1] >= 4 * out_w and image.shape[0] >= 4 * out_h:
+            image = cv2.pyrDown(image)
+        cv2.resize(image, (out_w, out_h), dst=scaled.image, interpolation=cv2.INTER_AREA)
+        scaled.timestamp, scaled.seq = frame.timestamp, frame.seq
+        self.frames_scaled += 1
+        self.output_mailbox.put(scaled)
+        scaled.release()
+
+    def stop(self):
+        self._is_running = False
+        if not self.wait(1000):
+            print("Warning: Preview worker did not finish within 1s.")
+
+
+# =============================================================================
+# == Video Encoder Backends ==
+# =============================================================================
+# Các encoder cùng giao diện với cv2.VideoWriter (write/isOpened/release) để RecordingSink dùng chung.
+FFMPEG_BINARY = shutil.which("ffmpeg")
+
+
+class OpenCVEncoder:
+    """cv2.VideoWriter behind the common encoder interface."""
+
+    def __init__(self, path, fps, size, fourcc='mp4v'):
+        self.path = path
+        self.description = f"OpenCV {fourcc}"
+        self._writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*fourcc), fps, size)
+
+    def isOpened(self):
+        return self._writer.isOpened()
+
+    def write(self, image):
+        self._writer.write(image)
+
+    def release(self):
+        self._writer.release()
+
+    def set_quality(self, quality):
+        """Change encoder quality (0-100) mid-stream; only some codecs (e.g. MJPG) honour it."""
+        return bool(self._writer.set(cv2.VIDEOWRITER_PROP_QUALITY, quality))
+
+
+class FFmpegPipeEncoder:
+    """Pipes raw BGR frames into a local ffmpeg process (libx264/libx265/...)."""
+
+    def __init__(self, path, fps, size, codec='libx264', preset='veryfast', crf=23, bitrate=None,
+                 threads=0, pix_fmt='yuv420p', drop_duplicates=True, extra_args=()):
+        """
+        Starts the ffmpeg encoder process.
+
+        Args:
+            path (str): Output file.
+            fps (float): Input/output frame rate.
+            size (tuple): (width, height) of the BGR frames that will be written.
+            codec (str): ffmpeg video encoder name.
+            preset (str): Encoder preset (speed/size tradeoff), None to omit.
+            crf (int): Constant rate factor; ignored when bitrate is given.
+            bitrate (str): Target bitrate such as '4M' instead of CRF.
+            threads (int): Encoder threads, 0 = ffmpeg decides.
+            pix_fmt (str): Output pixel format.
+            drop_duplicates (bool): Drop frames identical to the previous one before encoding (mpdecimate)
+                and keep the remaining frames' timestamps, so CFR duplicates cost only the pipe write.
+            extra_args (tuple): Additional output options placed before the path.
+        """
+        if not FFMPEG_BINARY:
+            raise IOError("Không tìm thấy ffmpeg trong PATH.")
+        self.path = path
+        self.description = f"ffmpeg {codec}" + (f" {preset}" if preset else "") + (f" {bitrate}" if bitrate else f" crf{crf}")
+        width, height = size
+        self._frame_bytes = width * height * 3
+        cmd = [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f"{width}x{height}", '-r', f"{fps:.6f}", '-i', '-',
+               '-an', '-c:v', codec]
+        if preset: cmd += ['-preset', preset]
+        cmd += ['-b:v', str(bitrate)] if bitrate else ['-crf', str(crf)]
+        if drop_duplicates:
+            # Chỉ frame trùng từng bit mới bị bỏ (hi=lo=1, frac=0); '-vsync vfr' thay vì '-fps_mode' để chạy cả ffmpeg 4.x
+            cmd += ['-vf', 'mpdecimate=hi=1:lo=1:frac=0:max=0', '-vsync', 'vfr']
+        cmd += ['-threads', str(int(threads)), '-pix_fmt', pix_fmt, *extra_args, path]
+        self.cpu_seconds = None # CPU (user+sys) của ffmpeg, có sau release() trên Unix
+        self._stderr = tempfile.TemporaryFile()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._stderr,
+                                      bufsize=self._frame_bytes)
+
+    def _reap(self, proc):
+        """
+        Wait for ffmpeg to exit and return its exit code.
+
+        On Unix the process is reaped with os.wait4 so cpu_seconds is the rusage of this ffmpeg PID
+        alone; RUSAGE_CHILDREN would also count segment closers, remuxes and mux jobs ending meanwhile.
+        """
+        if hasattr(os, 'wait4'):
+            try:
+                _, status, usage = os.wait4(proc.pid, 0)
+            except ChildProcessError:
+                return proc.wait() # Đã được poll() thu hồi trước: không còn số liệu CPU
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            self.cpu_seconds = usage.ru_utime + usage.ru_stime
+            return proc.returncode
+        return proc.wait()
+
+    def _error_text(self):
+        try:
+            self._stderr.seek(0)
+            return self._stderr.read()[-500:].decode('utf-8', errors='ignore').strip()
+        except Exception:
+            return ""
+
+    def isOpened(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def write(self, image):
+        if not image.flags['C_CONTIGUOUS']: image = np.ascontiguousarray(image)
+        try:
+            self._proc.stdin.write(memoryview(image).cast('B'))
+        except (BrokenPipeError, OSError) as e:
+            raise IOError(f"ffmpeg dừng bất ngờ: {self._error_text() or e}")
+
+    def release(self):
+        if self._proc is None: return
+        proc, self._proc = self._proc, None
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        code = self._reap(proc)
+        error_text = self._error_text()
+        self._stderr.close()
+        if code != 0:
+            raise IOError(f"ffmpeg kết thúc với mã {code}: {error_text}")
+
+    def abort(self):
+        """Kill ffmpeg without flushing; the partial output is left for the caller to delete."""
+        if self._proc is None: return
+        proc, self._proc = self._proc, None
+        proc.kill()
+        try: proc.stdin.close()
+        except OSError: pass
+        self._reap(proc)
+        self._stderr.close()
+
+
+# Hồ sơ encoder chọn được từ giao diện (lưu lựa chọn bằng QSettings)
+ENCODER_PROFILES = {
+    'opencv_mp4v': ("OpenCV MPEG-4 (mp4v)", OpenCVEncoder, {'fourcc': 'mp4v'}),
+    'opencv_avc1': ("OpenCV H.264 (avc1)", OpenCVEncoder, {'fourcc': 'avc1'}),
+    'ffmpeg_x264_fast': ("ffmpeg H.264 nhanh (veryfast, CRF 23)", FFmpegPipeEncoder,
+                         {'codec': 'libx264', 'preset': 'veryfast', 'crf': 23}),
+    'ffmpeg_x264_small': ("ffmpeg H.264 nhỏ (slow, CRF 26)", FFmpegPipeEncoder,
+                          {'codec': 'libx264', 'preset': 'slow', 'crf': 26}),
+    'ffmpeg_x265': ("ffmpeg H.265 (medium, CRF 28)", FFmpegPipeEncoder,
+                    {'codec': 'libx265', 'preset': 'medium', 'crf': 28}),
+}
+DEFAULT_ENCODER_PROFILE = 'opencv_mp4v'
+
+
+def encoder_available(profile):
+    """False for ffmpeg profiles when no ffmpeg binary is installed."""
+    return ENCODER_PROFILES[profile][1] is not FFmpegPipeEncoder or bool(FFMPEG_BINARY)
+
+
+def create_encoder(profile, path, fps, size, **overrides):
+    """Instantiate the encoder for a profile name; overrides replace profile options (e.g. threads)."""
+    _, encoder_cls, options = ENCODER_PROFILES[profile]
+    return encoder_cls(path, fps, size, **{**options, **overrides})
+
+
+# Định dạng file ghi: key -> (nhãn, đuôi file). Các định dạng ngoài 'mp4' vẫn đọc được khi app bị tắt đột ngột
+RECORDING_CONTAINERS = {
+    'mp4': ("MP4 (chỉ dùng được khi dừng đúng cách)", ".mp4"),
+    'fmp4': ("MP4 phân mảnh (cần ffmpeg)", ".mp4"),
+    'mkv': ("Matroska MKV", ".mkv"),
+    'avi_mjpg': ("AVI MJPEG", ".avi"),
+}
+DEFAULT_RECORDING_CONTAINER = 'mp4'
+
+
+def container_extension(container):
+    return RECORDING_CONTAINERS.get(container, RECORDING_CONTAINERS[DEFAULT_RECORDING_CONTAINER])[1]
+
+
+def create_container_encoder(container, profile, path, fps, size, **overrides):
+    """
+    create_encoder() adjusted for a recording container.
+
+    MJPEG-AVI always uses OpenCV's MJPG writer (every frame is a keyframe, the index is only an
+    optimisation). Fragmented MP4 and MKV through ffmpeg get a keyframe every second so that at most
+    about one second is lost if the process dies. Fragmented MP4 cannot be written by OpenCV.
+
+    Args:
+        container (str): Key of RECORDING_CONTAINERS.
+        profile (str): Key of ENCODER_PROFILES.
+        path (str): Output file.
+        fps (float): Frame rate.
+        size (tuple): (width, height) of the BGR frames that will be written.
+        **overrides: Profile option overrides (e.g. threads).
+    """
+    if container == 'avi_mjpg':
+        return OpenCVEncoder(path, fps, size, fourcc='MJPG')
+    if container in ('fmp4', 'mkv'):
+        if ENCODER_PROFILES[profile][1] is not FFmpegPipeEncoder:
+            if container == 'fmp4':
+                raise IOError("MP4 phân mảnh cần bộ mã hóa ffmpeg.")
+            return create_encoder(profile, path, fps, size, **overrides) # OpenCV tự ghi MKV theo đuôi file
+        # Keyframe mỗi giây theo thời gian, không theo số frame: frame trùng bị bỏ (mpdecimate) làm GOP dài ra
+        extra = ['-g', str(max(1, int(round(fps)))), '-force_key_frames', 'expr:gte(t,n_forced)']
+        if container == 'fmp4':
+            extra += ['-movflags', '+frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4']
+        else:
+            extra += ['-cluster_time_limit', '1000', '-f', 'matroska']
+        return create_encoder(profile, path, fps, size, extra_args=tuple(extra), **overrides)
+    return create_encoder(profile, path, fps, size, **overrides)
+
+
+def _verify_video_file(path):
+    """True when the file exists, is non-empty and its first frame decodes."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0: return False
+    cap = cv2.VideoCapture(path)
+    try:
+        return cap.isOpened() and cap.read()[0]
+    finally:
+        cap.release()
+
+
+def remux_to_mp4(src, transcode=False, timeout=600):
+    """
+    Rewrites a finished crash-tolerant recording as a regular MP4 (moov at the front) next to it.
+
+    The stream is copied without re-encoding unless transcode is set (MJPEG does not belong in MP4).
+    The result is written to a temporary name, verified, and only then replaces the MP4 name;
+    the source is removed afterwards.
+
+    Args:
+        src (str): Fragmented MP4, MKV or AVI file.
+        transcode (bool): Re-encode to H.264 instead of copying the video stream.
+        timeout (float): Seconds before the ffmpeg run is abandoned.
+
+    Returns:
+        str: Path of the MP4 file.
+    """
+    if not FFMPEG_BINARY:
+        raise IOError("Không tìm thấy ffmpeg để chuyển sang MP4.")
+    base = os.path.splitext(src)[0]
+    dst, tmp = base + ".mp4", base + ".remux.mp4"
+    video_args = ['-c:v', 'libx264', '-preset', 'veryfast', '-crf', '20', '-pix_fmt', 'yuv420p'] if transcode \
+        else ['-c', 'copy']
+    cmd = [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', '-i', src, '-map', '0',
+           *video_args, '-movflags', '+faststart', '-f', 'mp4', tmp]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        if proc.returncode != 0:
+            raise IOError(f"ffmpeg kết thúc với mã {proc.returncode}: "
+                          f"{proc.stderr[-500:].decode('utf-8', errors='ignore').strip()}")
+        if not _verify_video_file(tmp):
+            raise IOError("File MP4 sau khi chuyển không đọc được.")
+        os.replace(tmp, dst)
+    except Exception:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    if os.path.abspath(src) != os.path.abspath(dst) and os.path.exists(src):
+        os.remove(src)
+    return dst
+
+
+def _encoder_process_main(container, profile, path, fps, size, overrides, slot_names, commands, free_slots, results,
+                          discarding):
+    """Child-process entry point: encodes frames handed over through shared-memory slots."""
+    width, height = size
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    views = [np.ndarray((height, width, 3), dtype=np.uint8, buffer=slot.buf) for slot in slots]
+    cpu_start = time.process_time()
+    encoder = None
+    try:
+        encoder = create_container_encoder(container, profile, path, fps, size, **overrides)
+        if not encoder.isOpened():
+            raise IOError(f"Không thể mở encoder {profile}")
+        results.put(('opened', encoder.description))
+        while True:
+            command, arg = commands.get()
+            if command == 'frame':
+                try:
+                    # Đã yêu cầu hủy: các frame còn xếp hàng trước lệnh 'discard' chỉ trả slot, không mã hóa
+                    if not discarding.is_set(): encoder.write(views[arg])
+                finally:
+                    free_slots.put(arg) # Trả slot cho tiến trình chính ngay sau khi encoder đã dùng xong
+            elif command in ('stop', 'discard'):
+                enc, encoder = encoder, None
+                if command == 'stop':
+                    enc.release()
+                else:
+                    # File sẽ bị xóa: dừng ffmpeg ngay thay vì chờ nó mã hóa nốt các frame đã nhận
+                    try: getattr(enc, 'abort', enc.release)()
+                    except Exception: pass
+                    if os.path.exists(path): os.remove(path)
+                # CPU của tiến trình này + CPU của ffmpeg con (nếu có)
+                cpu = time.process_time() - cpu_start + (getattr(enc, 'cpu_seconds', None) or 0.0)
+                results.put((command, cpu))
+                break
+    except Exception as e:
+        results.put(('error', str(e)))
+    finally:
+        if encoder is not None:
+            try: encoder.release()
+            except Exception: pass
+        del views
+        for slot in slots: slot.close()
+
+
+class ProcessEncoder:
+    """Runs an encoder profile in a separate process so heavy codecs do not compete with the GUI for the GIL."""
+    SLOT_COUNT = 8 # Số frame có thể nằm chờ trong shared memory
+
+    def __init__(self, profile, path, fps, size, slot_count=SLOT_COUNT, open_timeout=30.0,
+                 container=DEFAULT_RECORDING_CONTAINER, **overrides):
+        """
+        Starts the encoder process and waits until it has opened the output.
+
+        Args:
+            profile (str): Key of ENCODER_PROFILES used inside the child process.
+            path (str): Output file.
+            fps (float): Frame rate.
+            size (tuple): (width, height) of the BGR frames that will be written.
+            slot_count (int): Number of shared-memory frame slots.
+            open_timeout (float): Seconds to wait for the child to start and open the encoder.
+            container (str): Key of RECORDING_CONTAINERS for the output file.
+            **overrides: Profile option overrides (e.g. threads).
+        """
+        self.path = path
+        self.description = ENCODER_PROFILES[profile][0]
+        self.cpu_seconds = None
+        width, height = size
+        self._shape = (height, width, 3)
+        self._closed = False
+        self._slots = []
+        ctx = multiprocessing.get_context('spawn') # Không fork tiến trình Qt đang chạy nhiều thread
+        self._commands = ctx.Queue()
+        self._free_slots = ctx.Queue()
+        self._results = ctx.Queue()
+        self._discarding = ctx.Event() # Báo tiến trình con bỏ qua frame đang chờ khi discard()
+        try:
+            for i in range(max(2, int(slot_count))):
+                self._slots.append(shared_memory.SharedMemory(create=True, size=width * height * 3))
+                self._free_slots.put(i)
+            self._views = [np.ndarray(self._shape, dtype=np.uint8, buffer=slot.buf) for slot in self._slots]
+            self._proc = ctx.Process(target=_encoder_process_main, name=f"Encoder-{os.path.basename(path)}",
+                                     args=(container, profile, path, fps, size, overrides, [slot.name for slot in self._slots],
+                                           self._commands, self._free_slots, self._results, self._discarding),
+                                     daemon=True)
+            self._proc.start()
+            kind, info = self._wait_result(open_timeout)
+            if kind != 'opened':
+                raise IOError(f"Tiến trình encoder không khởi động được: {info}")
+            self.description = f"{info} (tiến trình riêng)"
+        except Exception:
+            self._shutdown(terminate=True)
+            raise
+
+    def _wait_result(self, timeout):
+        """Wait for a control reply from the child; ('error', ...) if it died or timed out."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self._results.get(timeout=0.2)
+            except queue.Empty:
+                if not self._proc.is_alive():
+                    try: return self._results.get(timeout=0.2) # Lời nhắn cuối trước khi tiến trình thoát
+                    except queue.Empty: return ('error', f"tiến trình kết thúc (mã {self._proc.exitcode})")
+                if time.monotonic() > deadline:
+                    return ('error', "hết thời gian chờ")
+
+    def isOpened(self):
+        return not self._closed and self._proc.is_alive()
+
+    def write(self, image):
+        while True:
+            try:
+                slot = self._free_slots.get(timeout=0.5)
+                break
+            except queue.Empty:
+                if not self._proc.is_alive():
+                    _, info = self._wait_result(0)
+                    raise IOError(f"Tiến trình encoder dừng bất ngờ: {info}")
+        np.copyto(self._views[slot], image)
+        self._commands.put(('frame', slot))
+
+    def _finish(self, command, timeout=120.0):
+        if self._closed: return
+        self._commands.put((command, None))
+        kind, info = self._wait_result(timeout)
+        self._shutdown(terminate=kind == 'error')
+        if kind == 'error':
+            raise IOError(f"Tiến trình encoder lỗi khi {command}: {info}")
+        self.cpu_seconds = info
+
+    def release(self):
+        """Flush and close the output in the child process, then tear it down."""
+        self._finish('stop')
+
+    def discard(self):
+        """Abort encoding: the child skips the frames still queued, then closes and deletes the output."""
+        self._discarding.set()
+        self._finish('discard', timeout=30.0)
+
+    def _shutdown(self, terminate=False):
+        self._closed = True
+        proc = getattr(self, '_proc', None)
+        if proc is not None and proc.pid is not None: # start() có thể đã lỗi: join() tiến trình chưa chạy sẽ assert
+            proc.join(timeout=0.5 if terminate else 5.0)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join(timeout=2.0)
+        self._views = []
+        for slot in self._slots:
+            try:
+                slot.close()
+                slot.unlink()
+            except (OSError, BufferError):
+                pass
+        self._slots = []
+        for q in (self._commands, self._free_slots, self._results):
+            q.close()
+            q.cancel_join_thread()
+
+
+class SegmentedEncoder:
+    """Splits one recording into consecutive segment files, rolling over by duration or file size.
+
+    The next segment's encoder is opened in the background while the current one is written, and
+    closed segments are finalized on helper threads, so the writing thread never waits at a boundary.
+    A JSON manifest next to the recording lists the segments and is rewritten as each one closes.
+    """
+    SIZE_CHECK_INTERVAL = 1.0 # Giây video giữa hai lần kiểm tra kích thước file
+
+    def __init__(self, open_segment, path, fps, segment_seconds=0, segment_bytes=0):
+        """
+        Opens the first segment and starts pre-opening the second.
+
+        Args:
+            open_segment (callable): open_segment(path) -> opened encoder (write/isOpened/release).
+            path (str): Nominal recording path; segments are named <name>_seg001<ext>, ...
+            fps (float): Output frame rate, used to convert frame counts to seconds.
+            segment_seconds (float): Roll over after this much video, 0 = no time limit.
+            segment_bytes (int): Roll over once the current file reaches this size, 0 = no size limit.
+        """
+        if not segment_seconds and not segment_bytes:
+            raise ValueError("SegmentedEncoder needs segment_seconds or segment_bytes")
+        self.path = path
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        self.cpu_seconds = None
+        self._open_segment = open_segment
+        self._base, self._ext = os.path.splitext(path)
+        self.manifest_path = self._base + ".segments.json"
+        self._segment_frames = int(round(segment_seconds * fps)) if segment_seconds else 0
+        self._size_check_frames = max(1, int(round(self.SIZE_CHECK_INTERVAL * fps)))
+        self._lock = threading.Lock() # Bảo vệ danh sách segment/manifest (luồng đóng file ghi song song)
+        self._closers = []
+        self._next = None
+        self._frames_total = 0
+        self._cpu_total = 0.0
+        self._closed = False
+        self.segments = []
+        self._current = self._checked(open_segment(self._segment_path(0)), self._segment_path(0))
+        self.description = f"{getattr(self._current, 'description', type(self._current).__name__)} [chia đoạn]"
+        self._begin_segment()
+        self._prepare_next()
+
+    def _segment_path(self, index):
+        return f"{self._base}_seg{index + 1:03d}{self._ext}"
+
+    @staticmethod
+    def _checked(encoder, path):
+        if not encoder.isOpened():
+            encoder.release()
+            raise IOError(f"Không thể mở đoạn video: {os.path.basename(path)}")
+        return encoder
+
+    def _begin_segment(self):
+        index = len(self.segments)
+        with self._lock:
+            self.segments.append({'index': index, 'file': os.path.basename(self._segment_path(index)),
+                                  'start_frame': self._frames_total, 'frames': 0, 'status': 'recording'})
+            self._write_manifest()
+
+    def _prepare_next(self):
+        """Open the following segment's encoder on a helper thread."""
+        path = self._segment_path(len(self.segments))
+        holder = {}
+        def open_next():
+            try: holder['encoder'] = self._checked(self._open_segment(path), path)
+            except Exception as e: holder['error'] = e
+        thread = threading.Thread(target=open_next, name=f"SegmentOpen-{os.path.basename(path)}", daemon=True)
+        thread.start()
+        self._next = (path, thread, holder)
+
+    def _take_next(self):
+        path, thread, holder = self._next
+        self._next = None
+        thread.join()
+        if 'encoder' in holder: return holder['encoder']
+        # Mở trước thất bại: thử lại đồng bộ một lần trước khi báo lỗi
+        print(f"Pre-opening {os.path.basename(path)} failed ({holder.get('error')}), retrying", file=sys.stderr)
+        return self._checked(self._open_segment(path), path)
+
+    def _should_roll(self):
+        frames = self.segments[-1]['frames']
+        if frames == 0: return False
+        if self._segment_frames and frames >= self._segment_frames: return True
+        if self.segment_bytes and frames % self._size_check_frames == 0:
+            try: return os.path.getsize(self._segment_path(len(self.segments) - 1)) >= self.segment_bytes
+            except OSError: return False
+        return False
+
+    def _roll(self):
+        new_encoder = self._take_next()
+        old_encoder, old_segment = self._current, self.segments[-1]
+        self._current = new_encoder
+        self._begin_segment()
+        self._prepare_next()
+        closer = threading.Thread(target=self._close_segment, args=(old_encoder, old_segment),
+                                  name=f"SegmentClose-{old_segment['file']}", daemon=True)
+        closer.start()
+        self._closers.append(closer)
+        print(f"Segment rollover: {old_segment['file']} -> {self.segments[-1]['file']}")
+
+    def _close_segment(self, encoder, segment):
+        path = os.path.join(os.path.dirname(self.path), segment['file'])
+        try:
+            encoder.release()
+            status, error = 'closed', None
+        except Exception as e:
+            status, error = 'error', str(e)
+        with self._lock:
+            segment['status'] = status
+            segment['duration_s'] = round(segment['frames'] / self.fps, 3) if self.fps else None
+            segment['start_time_s'] = round(segment['start_frame'] / self.fps, 3) if self.fps else None
+            segment['size_bytes'] = os.path.getsize(path) if os.path.exists(path) else 0
+            if error: segment['error'] = error
+            self._cpu_total += getattr(encoder, 'cpu_seconds', None) or 0.0
+            self._write_manifest()
+
+    def _write_manifest(self, complete=False):
+        """Rewrite the manifest atomically (caller holds the lock)."""
+        manifest = {'video': os.path.basename(self.path), 'fps': self.fps,
+                    'segment_seconds': self.segment_seconds, 'segment_bytes': self.segment_bytes,
+                    'complete': complete, 'segments': self.segments}
+        tmp_path = self.manifest_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+        except OSError as e:
+            print(f"Cannot write segment manifest {self.manifest_path}: {e}", file=sys.stderr)
+
+    def _drop_pending_next(self):
+        if self._next is None: return
+        path, thread, holder = self._next
+        self._next = None
+        thread.join()
+        if 'encoder' in holder:
+            encoder = holder['encoder']
+            try:
+                if hasattr(encoder, 'discard'): encoder.discard()
+                else: encoder.release()
+            except Exception: pass
+        try:
+            if os.path.exists(path): os.remove(path)
+        except OSError as e: print(f"Cannot remove unused segment {os.path.basename(path)}: {e}", file=sys.stderr)
+
+    def isOpened(self):
+        return not self._closed and self._current.isOpened()
+
+    def set_quality(self, quality):
+        set_quality = getattr(self._current, 'set_quality', None)
+        return bool(set_quality and set_quality(quality))
+
+    def write(self, image):
+        if self._should_roll(): self._roll()
+        self._current.write(image)
+        self.segments[-1]['frames'] += 1
+        self._frames_total += 1
+
+    def release(self):
+        """Close the last segment, wait for earlier ones and finalize the manifest."""
+        if self._closed: return
+        self._closed = True
+        self._drop_pending_next()
+        self._close_segment(self._current, self.segments[-1])
+        for closer in self._closers: closer.join()
+        with self._lock:
+            self._write_manifest(complete=True)
+            failed = [seg['file'] for seg in self.segments if seg['status'] == 'error']
+        self.cpu_seconds = self._cpu_total
+        if failed:
+            raise IOError(f"Lỗi đóng đoạn video: {', '.join(failed)}")
+
+    def discard(self):
+        """Abort the recording and delete every segment and the manifest."""
+        if self._closed: return
+        self._closed = True
+        self._drop_pending_next()
+        try:
+            if hasattr(self._current, 'discard'): self._current.discard()
+            else: self._current.release()
+        except Exception as e:
+            print(f"Error discarding current segment: {e}", file=sys.stderr)
+        for closer in self._closers: closer.join()
+        for path in self.output_paths() + [self.manifest_path]:
+            try:
+                if os.path.exists(path): os.remove(path)
+            except OSError as e: print(f"Cannot remove {os.path.basename(path)}: {e}", file=sys.stderr)
+
+    @staticmethod
+    def rename_in_manifest(manifest_path, old_name, new_name):
+        """Rewrite file names in a finished manifest after its recording was renamed from old_name to new_name."""
+        def renamed(name): return new_name + name[len(old_name):] if name.startswith(old_name) else name
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest['video'] = renamed(manifest.get('video', ''))
+        for segment in manifest.get('segments', []):
+            segment['file'] = renamed(segment['file'])
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    def output_paths(self):
+        """Segment files written so far, in order."""
+        return [self._segment_path(i) for i in range(len(self.segments))]
+
+    def sidecar_paths(self):
+        return [self.manifest_path]
+
+
+# =============================================================================
+# == Recording Sink (Encoder Worker Thread) ==
+# =============================================================================
+class RecordingSink(QThread):
+    """Owns a video encoder and writes frames from a bounded queue on its own thread."""
+    error = pyqtSignal(str)  # Emits error messages (write failures)
+
+    POLICY_BLOCK = "block"              # Luồng capture chờ đến khi hàng đợi có chỗ
+    POLICY_DROP_OLDEST = "drop_oldest"  # Bỏ frame cũ nhất trong hàng đợi để nhận frame mới
+    POLICY_DROP_NEWEST = "drop_newest"  # Bỏ frame mới đến khi hàng đợi đầy
+    POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_DROP_NEWEST)
+
+    _STOP = object()  # Sentinel báo hết frame
+
+    # Các mức giảm tải khi encoder không theo kịp (mức sau bao gồm mức trước). Frame bỏ vẫn được CFR
+    # lấp bằng frame nhân bản để file giữ đúng thời lượng thực; nhân bản rẻ với ffmpeg (mpdecimate bỏ
+    # frame trùng trước encoder), còn với mp4v/x264 qua OpenCV thì gần bằng frame mới
+    DEGRADE_NONE = 0
+    DEGRADE_HALF_RATE = 1   # Bỏ 1/2 frame trước khi xếp hàng
+    DEGRADE_SOFTEN = 2      # Thêm giảm chi tiết (pyrDown/pyrUp): ít hệ số DCT hơn, mọi codec mã hóa rẻ hơn
+    DEGRADE_QUALITY = 3     # Chỉ giữ 1/3 frame và hạ chất lượng encoder (nếu hỗ trợ)
+    DEGRADE_NAMES = ("bình thường", "bỏ 1/2 frame", "giảm chi tiết", "bỏ 2/3 frame, giảm chất lượng")
+    DEGRADE_KEEP_EVERY = (1, 2, 2, 3) # Giữ 1 trong N frame ở từng mức
+    DEGRADE_HOLD = 1.0      # Giây áp lực liên tục tối thiểu giữa hai lần tăng mức
+    RECOVER_HOLD = 3.0      # Giây tải nhẹ liên tục trước khi hạ mức
+    DEGRADED_QUALITY = 50
+    NORMAL_QUALITY = 95
+
+    degradation_changed = pyqtSignal(int, str) # Emits (new level, reason)
+
+    def __init__(self, writer, filepath, fps=30.0, max_queue=60, policy=POLICY_BLOCK, cfr=True, adaptive=False):
+        """
+        Initializes the RecordingSink.
+
+        Args:
+            writer: An already opened encoder (OpenCVEncoder, FFmpegPipeEncoder or anything with the
+                cv2.VideoWriter write/isOpened/release interface). The sink takes ownership and releases it.
+            filepath (str): Path of the file being written (for logging and the timestamp sidecar).
+            fps (float): Frame rate the writer was opened with.
+            max_queue (int): Maximum number of frames waiting to be encoded.
+            policy (str): What push() does when the queue is full, one of RecordingSink.POLICIES.
+            cfr (bool): Duplicate/drop frames so output frame N is the one captured at N/fps seconds
+                after the first frame, keeping playback length equal to wall-clock duration.
+            adaptive (bool): Degrade in steps (DEGRADE_*) while the queue fills up or writes take longer
+                than the frame interval, and step back once the load eases.
+        """
+        super().__init__()
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.writer = writer
+        self.writer_description = getattr(writer, 'description', type(writer).__name__)
+        self.filepath = filepath
+        self.final_filepath = filepath # Tên lưu cuối cùng; khác filepath khi sink được chuẩn bị sẵn trên file tạm
+        self.fps = fps
+        self.policy = policy
+        self.cfr = cfr
+        self.timestamps_path = os.path.splitext(filepath)[0] + ".timestamps.csv"
+        self._writer_sidecars = writer.sidecar_paths() if hasattr(writer, 'sidecar_paths') else []
+        self._output_paths = [filepath]
+        self.paused = False
+        self._pause_started = None
+        self._pause_offset = 0.0 # Tổng thời gian tạm dừng, trừ khỏi timestamp để dòng thời gian liền mạch
+        self._queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._accepting = True
+        self._discard = False
+        self._first_ts = None
+        self._preroll_frame_bytes = 1 # Byte của một frame thô (đặt bởi push_preroll)
+        self._preroll_credit = 0      # Byte pre-roll đã giải phóng nhưng chưa đổi thành chỗ trong hàng đợi
+        self._preroll_allowance = 0   # Chỗ đã thêm vào maxsize trong lúc ghi khối pre-roll
+        self._last_frame = None # Frame ghi gần nhất, dùng để nhân bản khi có khoảng trống (CFR)
+        self._last_rel = 0.0
+        # --- Counters ---
+        self.frames_queued = 0
+        self.frames_dropped = 0
+        self.frames_preroll = 0    # Frame pre-roll (chụp trước START) đã đưa vào hàng đợi
+        self.frames_written = 0    # Frame ra file (gồm cả frame nhân bản)
+        self.cfr_duplicated = 0    # Frame nhân bản để lấp khoảng trống
+        self.cfr_skipped = 0       # Frame bỏ vì đến sớm hơn lịch CFR
+        self.encode_seconds = 0.0  # Tổng thời gian nằm trong writer.write (đo chi phí encoder)
+        self.encoder_cpu_seconds = None # CPU của tiến trình encoder (ffmpeg/tiến trình riêng, nếu đo được)
+        # --- Adaptive degradation ---
+        self.adaptive = adaptive
+        self.degrade_level = self.DEGRADE_NONE
+        self.degrade_max = self.DEGRADE_NONE
+        self.degrade_events = []   # [{'time_s', 'level', 'reason'}] theo dòng thời gian của file
+        self.frames_shed = 0       # Frame bỏ do giảm tải (không tính vào 'dropped' của hàng đợi)
+        self._shed_counter = 0
+        self._write_ewma = 0.0     # Thời gian ghi trung bình trượt (giây/frame, gồm cả frame nhân bản)
+        self._fresh_ewma = 0.0     # Như trên nhưng chỉ frame mới (ước lượng chi phí khi hạ mức)
+        self._soft_key = None      # (seq, timestamp) của frame đang nằm trong _soft_image
+        self._soft_half = None     # Bộ đệm cấp phát sẵn cho pyrDown/pyrUp
+        self._soft_image = None
+        self._pressure_since = None
+        self._relaxed_since = None
+        self.armed_at = None       # time.monotonic() lúc yêu cầu bắt đầu ghi (START)
+        self.first_write_at = None # time.monotonic() khi frame đầu tiên đã ghi xong
+        # --- Release result (đọc sau khi thread kết thúc) ---
+        self.released_cleanly = False
+        self.release_error = None
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def counters(self):
+        """Return a snapshot of the frame counters."""
+        encode_ms = 1000.0 * self.encode_seconds / self.frames_written if self.frames_written else 0.0
+        return {'queued': self.frames_queued, 'dropped': self.frames_dropped,
+                'written': self.frames_written, 'pending': self._queue.qsize(),
+                'duplicated': self.cfr_duplicated, 'skipped': self.cfr_skipped,
+                'preroll': self.frames_preroll, 'encode_ms_per_frame': encode_ms,
+                'shed': self.frames_shed, 'degrade_max': self.degrade_max,
+                'degrade_events': len(self.degrade_events)}
+
+    def sidecar_paths(self):
+        """Files written next to the video (removed together with it on discard)."""
+        return [self.timestamps_path] + self._writer_sidecars
+
+    def output_paths(self):
+        """Video files produced by this recording (several when recording in segments)."""
+        return list(self._output_paths)
+
+    def sync_info(self):
+        """The written video's timeline on the capture clock (time.monotonic()), or None before any frame."""
+        if self._first_ts is None: return None
+        return {'first_frame_time': self._first_ts, 'last_frame_time': self._first_ts + self._last_rel,
+                'frames': self.frames_written, 'fps': self.fps, 'cfr': self.cfr, 'paused_s': self._pause_offset}
+
+    def start_latency(self):
+        """Seconds from the START request (armed_at) until the first frame was written, or None."""
+        if self.armed_at is None or self.first_write_at is None: return None
+        return self.first_write_at - self.armed_at
+
+    def rename_outputs(self, filepath):
+        """Move the finished recording (video or segments, sidecars) to filepath's name; returns the new video paths."""
+        old_base = os.path.splitext(self.filepath)[0]
+        new_base = os.path.splitext(filepath)[0]
+        def renamed(path): return new_base + path[len(old_base):] if path.startswith(old_base) else path
+        for path in self._output_paths + self.sidecar_paths():
+            if os.path.exists(path): os.replace(path, renamed(path))
+        for path in self._writer_sidecars:
+            if path.endswith(".segments.json") and os.path.exists(renamed(path)):
+                SegmentedEncoder.rename_in_manifest(renamed(path), os.path.basename(old_base), os.path.basename(new_base))
+        self._output_paths = [renamed(path) for path in self._output_paths]
+        self._writer_sidecars = [renamed(path) for path in self._writer_sidecars]
+        self.timestamps_path = renamed(self.timestamps_path)
+        self.filepath = filepath
+        return list(self._output_paths)
+
+    def set_paused(self, paused):
+        """Pause/resume; paused time is cut out of the CFR timeline."""
+        now = time.monotonic()
+        if paused and not self.paused:
+            self._pause_started = now
+        elif not paused and self.paused and self._pause_started is not None:
+            self._pause_offset += now - self._pause_started
+            self._pause_started = None
+        self.paused = paused
+
+    def push(self, frame):
+        """Queue a frame for writing. Called from the capture thread; never touches the writer."""
+        if not self._accepting or self.paused:
+            return False
+        keep_every = self.DEGRADE_KEEP_EVERY[self.degrade_level]
+        if keep_every > 1:
+            # Giảm tải: chỉ giữ 1/2 (hoặc 1/3) frame; ô trống trên lưới CFR được lấp bằng frame nhân bản
+            self._shed_counter += 1
+            if self._shed_counter % keep_every:
+                self.frames_shed += 1
+                return False
+        # Giữ tham chiếu trước khi xếp hàng; trả lại khi frame được ghi hoặc bị bỏ
+        frame.retain()
+        accepted = self._enqueue((frame, self._pause_offset))
+        if not accepted: frame.release()
+        return accepted
+
+    def push_preroll(self, frames):
+        """Queue frames captured before START ahead of live frames, as a single queue item written in order."""
+        if not frames or not self._accepting:
+            return False
+        # Hàng đợi không nới trước: run() chỉ cho thêm chỗ cho frame trực tiếp theo số byte pre-roll đã ghi
+        # và giải phóng (_credit_preroll), nên RAM đỉnh ≈ pre-roll + max_queue, không gấp đôi pre-roll
+        count = len(frames)
+        first = frames[0]
+        # Kích thước một frame trực tiếp (ảnh thô); frame JPEG chỉ giải phóng phần nén của nó
+        self._preroll_frame_bytes = (first.future.result()[1] if isinstance(first, EncodedFrame)
+                                     else first.image.nbytes) or 1
+        # deque: run() lấy từng frame ra khi ghi, khối không giữ frame đã ghi (và ảnh đã giải mã) đến cuối
+        self._queue.put((deque(frames), self._pause_offset))
+        self.frames_preroll += count
+        self.frames_queued += count
+        return True
+
+    def _credit_preroll(self, freed_bytes):
+        """Turn memory freed by written pre-roll frames into queue room for live frames (sink thread)."""
+        self._preroll_credit += freed_bytes
+        slots = self._preroll_credit // self._preroll_frame_bytes
+        if slots <= 0: return
+        self._preroll_credit -= slots * self._preroll_frame_bytes
+        with self._queue.mutex:
+            self._queue.maxsize += slots
+            self._preroll_allowance += slots
+            self._queue.not_full.notify(slots)
+
+    @staticmethod
+    def _release_item(item):
+        frames = item[0] if isinstance(item[0], deque) else [item[0]]
+        for frame in frames: frame.release()
+
+    def _enqueue(self, item):
+        if self.policy == self.POLICY_BLOCK:
+            # Chờ theo từng nhịp ngắn để stop() không bị kẹt nếu writer chết
+            while self._accepting:
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    self.frames_queued += 1
+                    return True
+                except queue.Full:
+                    continue
+            self.frames_dropped += 1
+            return False
+        try:
+            self._queue.put_nowait(item)
+            self.frames_queued += 1
+            return True
+        except queue.Full:
+            pass
+        if self.policy == self.POLICY_DROP_NEWEST:
+            self.frames_dropped += 1
+            return False
+        # POLICY_DROP_OLDEST: chỉ có một producer nên sau khi lấy ra chắc chắn có chỗ
+        try:
+            oldest = self._queue.get_nowait()
+            if oldest is not self._STOP: self._release_item(oldest)
+            self.frames_dropped += 1
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(item)
+            self.frames_queued += 1
+            return True
+        except queue.Full:
+            self.frames_dropped += 1
+            return False
+
+    def _encode(self, frame, duplicate=False):
+        t0 = time.perf_counter()
+        self.writer.write(self._soften(frame) if self.degrade_level >= self.DEGRADE_SOFTEN else frame.image)
+        elapsed = time.perf_counter() - t0
+        self.encode_seconds += elapsed
+        self._write_ewma = elapsed if self._write_ewma == 0.0 else 0.8 * self._write_ewma + 0.2 * elapsed
+        if not duplicate:
+            self._fresh_ewma = elapsed if self._fresh_ewma == 0.0 else 0.8 * self._fresh_ewma + 0.2 * elapsed
+
+    def _soften(self, frame):
+        """Return a detail-reduced copy of the frame (cached, so duplicates don't redo the filter)."""
+        key = (frame.seq, frame.timestamp)
+        if key != self._soft_key:
+            image = frame.image
+            h, w = image.shape[:2]
+            if self._soft_image is None or self._soft_image.shape != image.shape:
+                self._soft_half = np.empty(((h + 1) // 2, (w + 1) // 2) + image.shape[2:], image.dtype)
+                self._soft_image = np.empty_like(image)
+            # Mất chi tiết tần số cao nên encoder sinh ít hệ số hơn; đo ở 1080p: mp4v 38 -> 30 ms, x264 63 -> 56 ms/frame
+            cv2.pyrDown(image, dst=self._soft_half)
+            cv2.pyrUp(self._soft_half, dst=self._soft_image, dstsize=(w, h))
+            self._soft_key = key
+        return self._soft_image
+
+    def _update_load(self, log):
+        """Step the degradation level up/down from queue fill and write latency (sink thread)."""
+        now = time.monotonic()
+        fill = self._queue.qsize() / max(1, self._queue.maxsize)
+        interval = 1.0 / self.fps if self.fps > 0 else 0.033
+        # Mỗi ô lưới CFR vẫn được ghi (frame mới hoặc nhân bản) nên ngân sách luôn là 1/fps. Chỉ hạ mức khi
+        # riêng frame mới cũng đủ nhanh, vì mức thấp hơn giữ nhiều frame mới hơn
+        if fill >= 0.75 or self._write_ewma > interval:
+            self._relaxed_since = None
+            if self._pressure_since is None: self._pressure_since = now
+            if self.degrade_level < self.DEGRADE_QUALITY and now - self._pressure_since >= self.DEGRADE_HOLD:
+                self._pressure_since = now
+                self._set_degrade_level(self.degrade_level + 1,
+                                        f"hàng đợi {fill:.0%}, ghi {self._write_ewma * 1000:.1f} ms/frame", log)
+        elif fill <= 0.25 and self._fresh_ewma < 0.6 * interval:
+            self._pressure_since = None
+            if self._relaxed_since is None: self._relaxed_since = now
+            if self.degrade_level > self.DEGRADE_NONE and now - self._relaxed_since >= self.RECOVER_HOLD:
+                self._relaxed_since = now
+                self._set_degrade_level(self.degrade_level - 1,
+                                        f"tải giảm (hàng đợi {fill:.0%}, ghi {self._write_ewma * 1000:.1f} ms/frame)", log)
+        else:
+            self._pressure_since = None
+            self._relaxed_since = None
+
+    def _set_degrade_level(self, level, reason, log):
+        previous, self.degrade_level = self.degrade_level, level
+        self.degrade_max = max(self.degrade_max, level)
+        set_quality = getattr(self.writer, 'set_quality', None)
+        if (level >= self.DEGRADE_QUALITY) != (previous >= self.DEGRADE_QUALITY):
+            quality = self.DEGRADED_QUALITY if level >= self.DEGRADE_QUALITY else self.NORMAL_QUALITY
+            if not (set_quality and set_quality(quality)): reason += "; encoder không đổi được chất lượng"
+        time_s = self._last_rel if self._first_ts is not None else 0.0
+        self.degrade_events.append({'time_s': round(time_s, 3), 'level': level, 'reason': reason})
+        log.write(f"-1,-1,{time_s:.6f},degrade_{level}\n")
+        print(f"RecordingSink ({os.path.basename(self.filepath)}): degradation {previous} -> {level} ({reason})")
+        self.degradation_changed.emit(level, reason)
+
+    def _write_frame(self, frame, pause_offset, log):
+        """Write one captured frame, repeated or skipped as needed to hold a constant frame rate."""
+        ts = frame.timestamp - pause_offset
+        if self._first_ts is None: self._first_ts = ts
+        rel = ts - self._first_ts
+        if self.cfr:
+            # Frame thứ N của file phải là frame mới nhất chụp trước thời điểm N/fps kể từ frame đầu
+            target_index = int(round(rel * self.fps))
+            if target_index < self.frames_written:
+                self.cfr_skipped += 1
+                log.write(f"-1,{frame.seq},{rel:.6f},skip\n")
+                return
+            # Lấp khoảng trống (driver mất frame, camera chậm) bằng frame trước đó
+            last = self._last_frame
+            while last is not None and self.frames_written < target_index:
+                self._encode(last, duplicate=True)
+                log.write(f"{self.frames_written},{last.seq},{self._last_rel:.6f},dup\n")
+                self.frames_written += 1
+                self.cfr_duplicated += 1
+            frame.retain()
+            self._last_frame, self._last_rel = frame, rel
+            if last is not None: last.release()
+        self._encode(frame)
+        log.write(f"{self.frames_written},{frame.seq},{rel:.6f},frame\n")
+        self.frames_written += 1
+        self._last_rel = rel
+        if self.first_write_at is None: self.first_write_at = time.monotonic()
+
+    def run(self):
+        write_failed = False
+        try:
+            log = open(self.timestamps_path, 'w', encoding='utf-8', buffering=1 << 16)
+            log.write("out_frame,source_seq,capture_time_s,action\n")
+        except OSError as e:
+            print(f"Cannot create timestamp sidecar {self.timestamps_path}: {e}", file=sys.stderr)
+            log = open(os.devnull, 'w')
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            frames, pause_offset = item
+            item = None
+            preroll_block = isinstance(frames, deque)
+            if not preroll_block: frames = deque([frames]) # Một frame trực tiếp hoặc cả khối pre-roll
+            while frames:
+                frame = frames.popleft() # Bỏ tham chiếu của khối ngay khi lấy ra
+                if preroll_block: self._credit_preroll(frame.nbytes if isinstance(frame, EncodedFrame) else frame.image.nbytes)
+                if write_failed or self._discard:
+                    frame.release()
+                    continue  # Xả hàng đợi sau khi lỗi để producer không bị chặn
+                try:
+                    self._write_frame(frame, pause_offset, log)
+                except Exception as e:
+                    write_failed = True
+                    self._accepting = False
+                    self.error.emit(f"Lỗi ghi frame video: {e}")
+                finally:
+                    frame.release()
+                    frame = None
+            if preroll_block:
+                # Khối pre-roll đã ghi xong: thu hồi phần nới. Frame trực tiếp đang vượt giới hạn gốc
+                # vẫn nằm trong hàng đợi; put() chờ/bỏ theo chính sách cho đến khi xả bớt.
+                with self._queue.mutex:
+                    self._queue.maxsize -= self._preroll_allowance
+                self._preroll_allowance = 0
+                self._preroll_credit = 0
+            if self.adaptive and not write_failed: self._update_load(log)
+        # Frame lọt vào sau sentinel (producer đang chờ đúng lúc stop) chỉ cần trả buffer
+        while True:
+            try: leftover = self._queue.get_nowait()
+            except queue.Empty: break
+            if leftover is not self._STOP: self._release_item(leftover)
+        if self._last_frame is not None:
+            self._last_frame.release()
+            self._last_frame = None
+        log.close()
+
+        try:
+            if self.writer is not None:
+                if self._discard and hasattr(self.writer, 'discard'):
+                    self.writer.discard() # Encoder tự hủy file, không cần hoàn tất phần còn lại
+                else:
+                    self.writer.release() # Encoder ffmpeg báo lỗi (exception) nếu tiến trình kết thúc bất thường
+                self.released_cleanly = True
+        except Exception as e:
+            self.release_error = e
+            print(f"Error releasing VideoWriter for {os.path.basename(self.filepath)}: {e}", file=sys.stderr)
+        self.encoder_cpu_seconds = getattr(self.writer, 'cpu_seconds', None)
+        if hasattr(self.writer, 'output_paths'): self._output_paths = self.writer.output_paths()
+        self.writer = None
+        print(f"RecordingSink ({os.path.basename(self.filepath)}): queued={self.frames_queued}, "
+              f"written={self.frames_written}, dropped={self.frames_dropped}, "
+              f"duplicated={self.cfr_duplicated}, skipped={self.cfr_skipped}, "
+              f"encode={self.counters()['encode_ms_per_frame']:.2f} ms/frame")
+
+    def stop(self, discard=False):
+        """Stop accepting frames, let the worker drain the queue, then release the writer.
+
+        With discard=True the queued frames are dropped and the writer is discarded instead of finalized.
+        """
+        self._accepting = False
+        self._discard = discard
+        # put() có thể chờ nếu hàng đợi đang đầy; worker vẫn tiêu thụ nên sentinel sẽ vào được
+        self._queue.put(self._STOP)
+
+
+# =============================================================================
+# == Recording Finalizer ==
+# =============================================================================
+class RecordingFinalizer(QThread):
+    """Finishes a stopped loop in the background: waits for audio and video, then saves or discards the files."""
+    finished_result = pyqtSignal(dict) # Kết quả: action, status, log, log_lines, warning, ok, video_outputs, audio_path
+
+    AUDIO_TIMEOUT_MS = 2000
+    SINK_TIMEOUT_MS = 60000 # File dài/encoder chậm có thể mất nhiều giây để release (ghi moov)
+
+    def __init__(self, action_type, source, sink, audio_loop, writer_was_opened,
+                 video_filepath, audio_filepath, video_filename, audio_filename, remux_to_mp4=False):
+        """
+        Initializes the RecordingFinalizer.
+
+        Args:
+            action_type (str): "Save" or "Discard".
+            source (str): Who requested the stop (Manual, Serial, ...), for log messages.
+            sink (RecordingSink): The detached sink, already told to stop (or None).
+            audio_loop (AudioLoopRecording): The loop's audio file, already told to stop (or None).
+            writer_was_opened (bool): Whether the sink's writer was open when the stop was requested.
+            video_filepath (str): Final video path of the loop.
+            audio_filepath (str): Audio (WAV) path of the loop.
+            video_filename (str): Video file name for messages.
+            audio_filename (str): Audio file name for messages.
+            remux_to_mp4 (bool): Convert a saved fragmented MP4/MKV/AVI recording to a regular MP4.
+        """
+        super().__init__()
+        self.action_type = action_type
+        self.source = source
+        self.sink = sink
+        self.audio_loop = audio_loop
+        self.writer_was_opened = writer_was_opened
+        self.video_filepath = video_filepath
+        self.audio_filepath = audio_filepath
+        self.video_filename = video_filename
+        self.audio_filename = audio_filename
+        self.remux_to_mp4 = remux_to_mp4
+
+    def run(self):
+        result = {'action': self.action_type, 'source': self.source, 'status': "", 'log': "",
+                  'log_lines': [], 'warning': None, 'ok': False, 'video_outputs': [],
+                  'audio_path': self.audio_filepath}
+        t0 = time.perf_counter()
+        try:
+            self._finalize(result)
+        except Exception as e:
+            result['status'] = f"LỖI hoàn tất ghi ({e})"
+            result['log'] = f"Lỗi hoàn tất [{self.source}]: {e}"
+            print(f"RecordingFinalizer error: {e}", file=sys.stderr)
+        result['seconds'] = time.perf_counter() - t0
+        self.finished_result.emit(result)
+
+    @staticmethod
+    def _remux_outputs(video_outputs, sidecar_paths, transcode, log):
+        """Remux every saved file to MP4; a file that fails keeps its original container (it is still playable)."""
+        remuxed = []
+        converted = 0
+        t0 = time.perf_counter()
+        for path in video_outputs:
+            try:
+                new_path = remux_to_mp4(path, transcode=transcode)
+            except Exception as e:
+                log(f"Không chuyển được {os.path.basename(path)} sang MP4, giữ nguyên file gốc: {e}")
+                print(f"Remux failed for {path}: {e}", file=sys.stderr)
+                remuxed.append(path)
+                continue
+            remuxed.append(new_path)
+            converted += 1
+            if new_path != path:
+                for manifest in sidecar_paths:
+                    if manifest.endswith(".segments.json") and os.path.exists(manifest):
+                        SegmentedEncoder.rename_in_manifest(manifest, os.path.basename(path), os.path.basename(new_path))
+        if converted:
+            log(f"Đã chuyển {converted} file sang MP4 trong {time.perf_counter() - t0:.1f}s"
+                + (" (mã hóa lại H.264)" if transcode else ""))
+        return remuxed
+
+    def _write_av_sync(self, audio_path, log):
+        """Measure the loop's A/V offset and drift and store them next to the WAV for the mux step."""
+        video = self.sink.sync_info() if self.sink else None
+        audio = self.audio_loop.sync_info() if self.audio_loop else None
+        if video is None or audio is None or not audio['samples']: return
+        sync = compute_av_sync(video, audio)
+        try:
+            with open(os.path.splitext(audio_path)[0] + AV_SYNC_SUFFIX, 'w', encoding='utf-8') as f:
+                json.dump(sync, f, indent=2)
+        except OSError as e:
+            print(f"Could not write A/V sync sidecar: {e}", file=sys.stderr)
+            return
+        rate_text = f"tỉ lệ {sync['rate_ratio']:.6f}" if sync['rate_measured'] else "chưa đo được tốc độ mẫu"
+        if not sync['linear']: rate_text = "có tạm dừng, chỉ bù độ lệch"
+        log(f"Đồng bộ A/V: audio lệch {sync['offset_s'] * 1000:+.0f} ms, trôi {sync['drift_ms']:+.1f} ms ({rate_text})")
+
+    def _finalize(self, result):
+        action_type, source = self.action_type, self.source
+        original_video_filename, original_audio_filename = self.video_filename, self.audio_filename
+        video_filepath_to_process, audio_filepath_to_process = self.video_filepath, self.audio_filepath
+        log = result['log_lines'].append
+
+        # --- 1. Wait for the loop's audio file to be closed ---
+        audio_stopped_cleanly = False
+        if self.audio_loop:
+            audio_loop_ref = self.audio_loop
+            if audio_loop_ref.wait(self.AUDIO_TIMEOUT_MS): # stop() đã được gọi trên luồng GUI
+                 audio_stopped_cleanly = audio_loop_ref.error is None
+                 print("Audio loop file closed.")
+                 a = audio_loop_ref.counters()
+                 if a['clipped_samples']: log(f"CẢNH BÁO: Audio bị clip {a['clipped_samples']} mẫu trong loop này")
+                 log(f"Audio: {a['frames_written']} mẫu; ring: đầy tối đa {a['ring_max_fill_ms']:.0f} ms "
+                     f"({a['ring_max_fill'] * 100 / a['ring_capacity']:.0f}%), tràn {a['ring_overflows']} lần "
+                     f"({a['ring_overflow_frames']} mẫu), thiết bị overflow/underflow "
+                     f"{a['device_overflows']}/{a['device_underflows']}")
+            else:
+                 print("Warning: Audio loop file was not closed within timeout.")
+                 # Không terminate audio thread vì có thể làm hỏng file wav
+
+
+        # --- 2. Wait for Recording Sink to Drain & Release Video Writer ---
+        video_writer_released_cleanly = False
+        video_writer_was_opened = False
+        release_error = None
+        sidecar_paths = []
+        video_outputs = [video_filepath_to_process] if video_filepath_to_process else [] # Nhiều file khi chia đoạn
+        sink = self.sink
+        if sink:
+            sidecar_paths = sink.sidecar_paths()
+            video_writer_was_opened = self.writer_was_opened
+            if video_writer_was_opened:
+                print(f"Draining recording queue and releasing VideoWriter for {original_video_filename}...")
+                if sink.wait(self.SINK_TIMEOUT_MS):
+                    video_writer_released_cleanly = sink.released_cleanly
+                    release_error = sink.release_error
+                    video_outputs = sink.output_paths()
+                    if action_type == "Save" and sink.filepath != sink.final_filepath:
+                        # Ghi bằng writer chờ sẵn: đổi tên file tạm sang tên của loop
+                        try:
+                            video_outputs = sink.rename_outputs(sink.final_filepath)
+                            sidecar_paths = sink.sidecar_paths()
+                        except OSError as e:
+                            release_error = f"không đổi tên được file tạm: {e}"
+                            video_writer_released_cleanly = False
+                            print(f"Error renaming standby recording: {e}", file=sys.stderr)
+                    latency = sink.start_latency()
+                    if latency is not None:
+                        log(f"Độ trễ START → frame đầu tiên: {latency * 1000:.0f} ms")
+                    c = sink.counters()
+                    log(f"Khung hình: xếp hàng={c['queued']}, đã ghi={c['written']}, bỏ={c['dropped']}, "
+                        f"CFR nhân bản={c['duplicated']}, CFR bỏ={c['skipped']}")
+                    if c['preroll']: log(f"Pre-roll: {c['preroll']} frame trước lệnh START.")
+                    if c['degrade_events']:
+                        log(f"Giảm tải: {c['degrade_events']} lần đổi mức, cao nhất {c['degrade_max']} "
+                            f"({RecordingSink.DEGRADE_NAMES[c['degrade_max']]}), bỏ {c['shed']} frame.")
+                    existing_outputs = [path for path in video_outputs if os.path.exists(path)]
+                    if existing_outputs:
+                        size_mb = sum(os.path.getsize(path) for path in existing_outputs) / (1024 * 1024)
+                        if len(video_outputs) > 1: log(f"Video gồm {len(video_outputs)} đoạn.")
+                        cpu_seconds = sink.encoder_cpu_seconds
+                        cpu_text = f", CPU encoder {cpu_seconds:.2f}s" if cpu_seconds is not None else ""
+                        log(f"Encoder {sink.writer_description}: {c['encode_ms_per_frame']:.2f} ms/frame, {size_mb:.1f} MB{cpu_text}")
+                    if video_writer_released_cleanly: print("VideoWriter released successfully.")
+                else:
+                    release_error = "hết thời gian chờ ghi"
+                    print("Warning: Recording sink did not finish within timeout.", file=sys.stderr)
+            else:
+                 print(f"Warning: VideoWriter for {original_video_filename} was not open when stop was requested.")
+
+        # --- 2b. Remux crash-tolerant container to MP4 (only once the video is known good) ---
+        container = getattr(sink, 'container', DEFAULT_RECORDING_CONTAINER)
+        if (action_type == "Save" and self.remux_to_mp4 and container != DEFAULT_RECORDING_CONTAINER
+                and video_writer_released_cleanly and video_outputs and all(os.path.exists(path) for path in video_outputs)):
+            video_outputs = self._remux_outputs(video_outputs, sidecar_paths, container == 'avi_mjpg', log)
+            original_video_filename = os.path.basename(video_outputs[0])
+
+        # --- 3. Process Files based on Action ---
+        final_status_msg = ""
+        final_log_msg = ""
+
+        if action_type == "Save":
+            # Kiểm tra xem các file có tồn tại không
+            video_exists = bool(video_outputs) and all(os.path.exists(path) and os.path.getsize(path) > 0 for path in video_outputs)
+            audio_exists = audio_filepath_to_process and os.path.exists(audio_filepath_to_process) and os.path.getsize(audio_filepath_to_process) > 1024 # File wav hợp lệ thường > 1KB
+
+            # Thông báo thành công nếu cả hai file có vẻ ổn
+            if video_writer_released_cleanly and audio_stopped_cleanly and video_exists and audio_exists:
+                 final_status_msg = f"Đã dừng & lưu: {original_video_filename}, {original_audio_filename}"
+                 final_log_msg = f"Dừng & Lưu [{source}]: Video={original_video_filename}, Audio={original_audio_filename}. (Chưa ghép)"
+                 print("Video and Audio saved successfully (separate files).")
+                 self._write_av_sync(audio_filepath_to_process, log)
+                 # Việc ghép được MainWindow._merge_audio_video xếp vào MuxQueue khi nhận kết quả này
+            else:
+                 # Xử lý lỗi lưu
+                 error_parts = []
+                 if not video_writer_released_cleanly: error_parts.append(f"Lỗi đóng video ({release_error or 'không mở'})")
+                 elif not video_exists: error_parts.append("File video không tồn tại/trống")
+                 if not audio_stopped_cleanly: error_parts.append("Lỗi dừng audio")
+                 elif not audio_exists: error_parts.append("File audio không tồn tại/trống")
+
+                 error_details = ", ".join(error_parts) if error_parts else "Lỗi không xác định"
+                 final_status_msg = f"LỖI LƯU ({error_details})"
+                 final_log_msg = f"Dừng & Lỗi Lưu [{source}]: {error_details}. Files: V='{original_video_filename}', A='{original_audio_filename}'"
+                 result['warning'] = f"Không thể lưu video và/hoặc audio:\n{error_details}\nVideo: {original_video_filename}\nAudio: {original_audio_filename}"
+
+        elif action_type == "Discard":
+            deleted_video = False
+            deleted_audio = False
+            delete_video_error = None
+            delete_audio_error = None
+
+            # Xóa video nếu writer đã được release (hoặc không mở) và file tồn tại
+            if video_outputs and (video_writer_released_cleanly or not video_writer_was_opened):
+                 for video_path in video_outputs:
+                     if os.path.exists(video_path):
+                         print(f"Attempting to delete discarded video: {os.path.basename(video_path)}")
+                         try:
+                             os.remove(video_path)
+                             print("-> Deleted video.")
+                         except OSError as e: delete_video_error = e; print(f"-> Error deleting video: {e}")
+                 # Encoder có thể đã tự xóa file khi hủy (tiến trình riêng, chia đoạn)
+                 deleted_video = delete_video_error is None and not any(os.path.exists(path) for path in video_outputs)
+                 for sidecar in sidecar_paths:
+                     try:
+                         if os.path.exists(sidecar): os.remove(sidecar)
+                     except OSError as e: print(f"-> Error deleting sidecar {os.path.basename(sidecar)}: {e}")
+
+            # Xóa audio nếu thread đã dừng và file tồn tại
+            if audio_filepath_to_process and audio_stopped_cleanly:
+                 if os.path.exists(audio_filepath_to_process):
+                     print(f"Attempting to delete discarded audio: {original_audio_filename}")
+                     try:
+                         os.remove(audio_filepath_to_process)
+                         deleted_audio = True
+                         print("-> Deleted audio.")
+                     except OSError as e: delete_audio_error = e; print(f"-> Error deleting audio: {e}")
+                 # else: print(f"Audio file {original_audio_filename} not found for deletion.")
+
+            # Tạo thông báo hủy
+            discard_status = []
+            if deleted_video: discard_status.append("Đã xóa video")
+            elif delete_video_error: discard_status.append(f"Lỗi xóa video ({delete_video_error})")
+            elif video_filepath_to_process: discard_status.append("Video không bị xóa") # Hoặc không tồn tại
+
+            if deleted_audio: discard_status.append("Đã xóa audio")
+            elif delete_audio_error: discard_status.append(f"Lỗi xóa audio ({delete_audio_error})")
+            elif audio_filepath_to_process: discard_status.append("Audio không bị xóa")
+
+            discard_details = ", ".join(discard_status) if discard_status else "Trạng thái hủy không xác định"
+            final_status_msg = f"Đã dừng & hủy: {discard_details}"
+            final_log_msg = f"Dừng & Hủy [{source}]: {discard_details}. Files: V='{original_video_filename}', A='{original_audio_filename}'"
+
+        result.update(status=final_status_msg, log=final_log_msg,
+                      ok=bool(final_status_msg) and not final_status_msg.startswith("LỖI"),
+                      video_outputs=video_outputs if action_type == "Save" else [])
+
+
+# =============================================================================
+# == Standby Writer Workers ==
+# =============================================================================
+class StandbyWriterOpener(QThread):
+    """Opens the standby encoder off the GUI thread; read writer/error once the thread has finished."""
+
+    def __init__(self, open_writer, filepath, fps, signature):
+        """
+        Initializes the StandbyWriterOpener.
+
+        Args:
+            open_writer (callable): Opens and returns the writer; built on the GUI thread from the current settings.
+            filepath (str): Temp file the writer records to.
+            fps (float): Frame rate the writer was opened with.
+            signature (tuple): Recording settings the writer was opened for.
+        """
+        super().__init__()
+        self.open_writer = open_writer
+        self.filepath = filepath
+        self.fps = fps
+        self.signature = signature
+        self.writer = None # Kết quả, GUI lấy đi trong slot finished
+        self.error = None
+        self.seconds = 0.0
+
+    def run(self):
+        t0 = time.perf_counter()
+        try:
+            self.writer = self.open_writer()
+        except Exception as e:
+            self.error = e
+        self.seconds = time.perf_counter() - t0
+
+
+class StandbySinkCloser(QThread):
+    """Waits for a discarded standby sink to close and deletes its temp files, off the GUI thread."""
+    WAIT_MS = 5000
+
+    def __init__(self, sink, paths):
+        """
+        Initializes the StandbySinkCloser.
+
+        Args:
+            sink (RecordingSink): The standby sink, already stopped with discard=True.
+            paths (list): Video and sidecar files of the sink to delete.
+        """
+        super().__init__()
+        self.sink = sink
+        self.paths = paths
+
+    def run(self):
+        if not self.sink.wait(self.WAIT_MS): print("Warning: Standby writer did not close within timeout.", file=sys.stderr)
+        for path in self.paths:
+            try:
+                if os.path.exists(path): os.remove(path)
+            except OSError as e: print(f"Cannot remove standby file {os.path.basename(path)}: {e}", file=sys.stderr)
+
+
+# =============================================================================
+# == Audio/Video Mux Queue ==
+# =============================================================================
+# Codec audio khi ghép: key -> (nhãn, tham số ffmpeg, đuôi file kết quả). Video luôn chép nguyên luồng.
+MUX_AUDIO_CODECS = {
+    'aac': ("AAC 128 kbps (.mp4)", ('-c:a', 'aac', '-b:a', '128k'), ".mp4"),
+    'opus': ("Opus 96 kbps (.mkv)", ('-c:a', 'libopus', '-b:a', '96k'), ".mkv"),
+}
+DEFAULT_MUX_AUDIO_CODEC = 'aac'
+
+
+AV_SYNC_SUFFIX = ".sync.json"
+MAX_CLOCK_DEVIATION = 0.01 # Đồng hồ card âm thanh lệch >1% là phép đo hỏng, không phải trôi thật
+
+
+def compute_av_sync(video, audio):
+    """
+    Relates a loop's audio to its video, both stamped on time.monotonic().
+
+    Args:
+        video (dict): RecordingSink.sync_info().
+        audio (dict): AudioLoopRecording.sync_info().
+
+    Returns:
+        dict: offset_s (audio start minus video start, positive = audio starts later), video_scale
+        (video file seconds per real second), rate_ratio (speed factor that fits the audio onto the
+        video timeline), drift_ms (misalignment reached at the end without rate correction), and
+        whether the mapping is linear (no video pause) and the audio rate was measured.
+    """
+    fps, frames = video['fps'], video['frames']
+    span = video['last_frame_time'] - video['first_frame_time'] + 1.0 / fps
+    video_scale = (frames / fps) / span if frames > 1 and span > 0 else 1.0
+    samplerate, measured = audio['samplerate'], audio['measured_rate']
+    rate_measured = measured is not None and abs(measured / samplerate - 1.0) <= MAX_CLOCK_DEVIATION
+    audio_rate = measured if rate_measured else samplerate
+    linear = not video.get('paused_s') # Tạm dừng video cắt dòng thời gian, audio thì không
+    rate_ratio = audio_rate / (samplerate * video_scale) if linear else 1.0
+    audio_seconds = audio['samples'] / samplerate
+    return {'clock': "time.monotonic", 'video': video, 'audio': audio,
+            'offset_s': audio['first_sample_time'] - video['first_frame_time'],
+            'video_scale': video_scale, 'rate_ratio': rate_ratio,
+            'drift_ms': audio_seconds * (1.0 - 1.0 / rate_ratio) * 1000.0,
+            'rate_measured': rate_measured, 'linear': linear}
+
+
+def sync_audio_span(sync, video_start, video_duration):
+    """
+    Map a span of the video file onto the WAV using a sync sidecar.
+
+    Returns:
+        tuple: (audio_start, audio_duration, delay) in seconds; delay is silence to insert before the
+        audio when the recording of sound started after the video span begins.
+    """
+    rate_ratio = sync['rate_ratio']
+    audio_start = (video_start - sync['offset_s'] * sync['video_scale']) * rate_ratio
+    delay = 0.0
+    if audio_start < 0:
+        delay, audio_start = -audio_start / rate_ratio, 0.0
+    audio_duration = max(0.0, video_duration - delay) * rate_ratio if video_duration else None
+    return audio_start, audio_duration, delay
+
+
+def _ffmpeg_decodes_stream(path, stream):
+    """True when ffmpeg decodes the first second of the first 'v' (video) or 'a' (audio) stream of path."""
+    cmd = [FFMPEG_BINARY, '-hide_banner', '-v', 'error', '-i', path, '-map', f'0:{stream}:0', '-t', '1', '-f', 'null', '-']
+    try:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def merge_audio_video(video_path, audio_path, output_path, audio_codec=DEFAULT_MUX_AUDIO_CODEC,
+                      audio_start=0.0, duration=None, progress=None, cancel_event=None,
+                      audio_delay=0.0, rate_ratio=1.0, samplerate=None):
+    """
+    Muxes a video file and a WAV file into output_path with ffmpeg (video stream copy, audio encoded).
+
+    Args:
+        video_path (str): Recorded video (any container ffmpeg reads).
+        audio_path (str): Recorded WAV.
+        output_path (str): Result file; its extension must match the codec's container.
+        audio_codec (str): Key of MUX_AUDIO_CODECS.
+        audio_start (float): Seconds into the WAV where this video starts (segments).
+        duration (float): Length in seconds of the WAV span to use (also drives progress).
+        progress (callable): Called with a 0..1 fraction while ffmpeg runs.
+        cancel_event (threading.Event): Set to abort the ffmpeg run.
+        audio_delay (float): Silence in seconds placed before the audio (sound started after the video).
+        rate_ratio (float): Playback speed applied to the audio so it stays on the video timeline.
+        samplerate (int): WAV sample rate, needed for rate correction.
+
+    Raises:
+        IOError: ffmpeg is missing, failed, was cancelled, or the result lacks a decodable stream.
+    """
+    if not FFMPEG_BINARY:
+        raise IOError("Không tìm thấy ffmpeg để ghép audio/video.")
+    audio_input = []
+    if audio_start > 0: audio_input += ['-ss', f"{audio_start:.6f}"]
+    if duration: audio_input += ['-t', f"{duration:.6f}"]
+    cmd = [FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-nostats', '-progress', 'pipe:1', '-y',
+           '-i', video_path, *audio_input, '-i', audio_path,
+           '-map', '0:v:0', '-map', '1:a:0', '-c:v', 'copy', *MUX_AUDIO_CODECS[audio_codec][1]]
+    filters = []
+    if samplerate and abs(rate_ratio - 1.0) > 1e-6:
+        if abs(rate_ratio - 1.0) <= MAX_CLOCK_DEVIATION:
+            # Trôi đồng hồ (vài chục ppm): đổi tốc độ bằng resample, cao độ lệch không nghe thấy
+            filters.append(f"asetrate={samplerate * rate_ratio:.4f},aresample={samplerate}")
+        else:
+            filters.append(f"atempo={rate_ratio:.6f}") # Video không CFR: co giãn giữ cao độ
+    if audio_delay > 0:
+        filters.append(f"adelay={audio_delay * 1000:.1f}:all=1")
+    if filters: cmd += ['-af', ",".join(filters)]
+    if output_path.lower().endswith(".mp4"): cmd += ['-movflags', '+faststart']
+    cmd.append(output_path)
+    with tempfile.TemporaryFile() as stderr:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, stdin=subprocess.DEVNULL)
+        try:
+            for line in proc.stdout: # ffmpeg ghi tiến độ dạng key=value khoảng 2 lần/giây
+                if cancel_event is not None and cancel_event.is_set():
+                    proc.kill()
+                    break
+                if progress and duration and line.startswith(b'out_time_us='):
+                    try:
+                        progress(min(1.0, int(line[12:]) / 1e6 / duration))
+                    except ValueError:
+                        pass # out_time_us=N/A ở đầu
+            code = proc.wait()
+        except BaseException:
+            proc.kill(); proc.wait()
+            raise
+        if cancel_event is not None and cancel_event.is_set():
+            raise IOError("Đã hủy ghép.")
+        if code != 0:
+            stderr.seek(0)
+            raise IOError(f"ffmpeg kết thúc với mã {code}: {stderr.read()[-500:].decode('utf-8', errors='ignore').strip()}")
+    if not (os.path.exists(output_path) and os.path.getsize(output_path) > 0
+            and _ffmpeg_decodes_stream(output_path, 'v') and _ffmpeg_decodes_stream(output_path, 'a')):
+        raise IOError("File ghép không có đủ luồng video/audio đọc được.")
+
+
+class MuxJob:
+    """One saved loop waiting to be muxed: its video part(s), the shared WAV, and how to store the result."""
+    _next_id = 0
+
+    def __init__(self, parts, audio_path, priority, audio_codec, delete_originals, manifest_path=None, sync=None):
+        """
+        Args:
+            parts (list): (video_path, audio_start, duration, delay) per video file (several when segmented).
+            audio_path (str): WAV of the loop.
+            priority (int): Lower runs first (MuxQueue.PRIORITY_*).
+            audio_codec (str): Key of MUX_AUDIO_CODECS.
+            delete_originals (bool): Replace the video and remove the WAV once every part is verified.
+            manifest_path (str): Segment manifest to update with the new file names, or None.
+            sync (dict): The loop's sync sidecar (compute_av_sync), or None to mux without alignment.
+        """
+        MuxJob._next_id += 1
+        self.id = MuxJob._next_id
+        self.parts = parts
+        self.audio_path = audio_path
+        self.priority = priority
+        self.audio_codec = audio_codec
+        self.delete_originals = delete_originals
+        self.manifest_path = manifest_path
+        self.sync = sync
+        self.label = os.path.basename(os.path.splitext(audio_path)[0])
+
+    def output_path(self, video_path):
+        base, ext = os.path.splitext(video_path)[0], MUX_AUDIO_CODECS[self.audio_codec][2]
+        return base + ext if self.delete_originals else base + "_av" + ext
+
+
+class MuxWorker(QThread):
+    """Takes jobs from the MuxQueue's priority queue and runs them one at a time."""
+
+    def __init__(self, mux_queue):
+        super().__init__()
+        self.mux_queue = mux_queue
+        self.cancel_event = threading.Event()
+        self._is_running = True
+
+    def run(self):
+        while self._is_running:
+            try:
+                _, _, job = self.mux_queue._jobs.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if job is None: break
+            self.mux_queue._set_active(job, True)
+            try:
+                result = self._run_job(job)
+            finally:
+                self.mux_queue._set_active(job, False)
+            self.mux_queue.job_finished.emit(result)
+
+    def _run_job(self, job):
+        result = {'id': job.id, 'label': job.label, 'ok': False, 'outputs': [], 'error': None,
+                  'seconds': 0.0, 'deleted_originals': False}
+        t0 = time.perf_counter()
+        total = sum(duration or 0.0 for _, _, duration, _ in job.parts) or None
+        rate_ratio = job.sync['rate_ratio'] if job.sync else 1.0
+        samplerate = job.sync['audio']['samplerate'] if job.sync else None
+        done = 0.0
+        last_emit = [0.0]
+        def report(fraction, done_before, duration):
+            now = time.monotonic()
+            if now - last_emit[0] < 0.25: return # Giới hạn tín hiệu tiến độ ~4 lần/giây
+            last_emit[0] = now
+            overall = (done_before + fraction * (duration or 0.0)) / total if total else fraction
+            self.mux_queue.job_progress.emit(job.id, job.label, overall)
+        temps = []
+        try:
+            for video_path, audio_start, duration, delay in job.parts:
+                tmp = os.path.splitext(video_path)[0] + ".muxing" + MUX_AUDIO_CODECS[job.audio_codec][2]
+                temps.append((video_path, tmp))
+                merge_audio_video(video_path, job.audio_path, tmp, job.audio_codec, audio_start, duration,
+                                  progress=lambda f, d0=done, d=duration: report(f, d0, d),
+                                  cancel_event=self.cancel_event, audio_delay=delay,
+                                  rate_ratio=rate_ratio, samplerate=samplerate)
+                done += duration or 0.0
+            # Mọi phần đã ghép và kiểm tra xong: giờ mới thay/xóa file gốc
+            for video_path, tmp in temps:
+                output = job.output_path(video_path)
+                os.replace(tmp, output)
+                result['outputs'].append(output)
+                if job.delete_originals and output != video_path and os.path.exists(video_path):
+                    os.remove(video_path)
+                if job.manifest_path and output != video_path and os.path.exists(job.manifest_path):
+                    SegmentedEncoder.rename_in_manifest(job.manifest_path, os.path.basename(video_path),
+                                                        os.path.basename(output))
+            if job.delete_originals and os.path.exists(job.audio_path):
+                os.remove(job.audio_path)
+                sync_path = os.path.splitext(job.audio_path)[0] + AV_SYNC_SUFFIX
+                if os.path.exists(sync_path): os.remove(sync_path) # Sidecar chỉ mô tả WAV đã xóa
+                result['deleted_originals'] = True
+            result['ok'] = True
+            self.mux_queue.job_progress.emit(job.id, job.label, 1.0)
+        except Exception as e:
+            result['error'] = str(e)
+            print(f"Mux job {job.id} ({job.label}) failed: {e}", file=sys.stderr)
+        finally:
+            for _, tmp in temps:
+                if os.path.exists(tmp):
+                    try: os.remove(tmp)
+                    except OSError: pass
+        result['seconds'] = time.perf_counter() - t0
+        return result
 
     def stop(self):
-        """Requests the thread to stop."""
-        # print(f"WebcamThread {self.webcam_index}: Stop requested.")
         self._is_running = False
-        if not self.wait(2000):
-             # print(f"Warning: Webcam thread {self.webcam_index} did not finish cleanly after 2s. Terminating.")
-             self.terminate()
-             if self.cap and self.cap.isOpened():
-                  try:
-                      self.cap.release()
-                      # print(f"Webcam {self.webcam_index} capture released after termination.")
-                  except Exception as e:
-                      print(f"Error releasing webcam {self.webcam_index} after termination: {e}")
-        # else:
-            # print(f"WebcamThread {self.webcam_index}: Stopped successfully.")
-        # Double-check release
-        if self.cap and self.cap.isOpened():
-             # print(f"Warning: Webcam {self.webcam_index} capture still open after wait(). Releasing fallback.")
-             try: self.cap.release()
-             except Exception as e: print(f"Error in fallback release for webcam {self.webcam_index}: {e}")
+        self.cancel_event.set()
+
+
+class MuxQueue(QObject):
+    """Bounded, prioritised pool of MuxWorkers that combine saved video and audio files in the background."""
+    job_progress = pyqtSignal(int, str, float) # id, tên loop, tiến độ 0..1 (đã giới hạn tần suất)
+    job_finished = pyqtSignal(dict)            # id, label, ok, outputs, error, seconds, deleted_originals
+
+    PRIORITY_HIGH = 0   # Lưu thủ công: người vận hành đang chờ
+    PRIORITY_NORMAL = 1 # Lưu theo lệnh serial
+
+    def __init__(self, workers=1, max_pending=32):
+        """
+        Args:
+            workers (int): Number of ffmpeg jobs running at the same time.
+            max_pending (int): Jobs allowed to wait; submit() refuses more.
+        """
+        super().__init__()
+        self.max_pending = max(1, int(max_pending))
+        self._jobs = queue.PriorityQueue()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._active = set()
+        self._workers = [MuxWorker(self) for _ in range(max(1, int(workers)))]
+        for worker in self._workers: worker.start()
+
+    def _set_active(self, job, active):
+        with self._lock:
+            if active: self._active.add(job.id)
+            else: self._active.discard(job.id)
+
+    def pending_count(self):
+        return self._jobs.qsize()
+
+    def active_count(self):
+        with self._lock:
+            return len(self._active)
+
+    @staticmethod
+    def load_sync(audio_path):
+        """The loop's sync sidecar, or None if it is missing/unreadable."""
+        sync_path = os.path.splitext(audio_path)[0] + AV_SYNC_SUFFIX
+        try:
+            with open(sync_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def parts_for(video_outputs, audio_path, sync=None):
+        """(video, audio_start, duration, delay) per output; segment spans come from the loop's manifest."""
+        manifest_path = os.path.splitext(audio_path)[0] + ".segments.json"
+        spans = None
+        if len(video_outputs) > 1 and os.path.exists(manifest_path):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                segments = {seg['file']: seg for seg in json.load(f).get('segments', [])}
+            spans = [(segments.get(os.path.basename(path), {}).get('start_time_s', 0.0),
+                      segments.get(os.path.basename(path), {}).get('duration_s')) for path in video_outputs]
+        else:
+            manifest_path = None
+        if sync is not None:
+            if spans is None:
+                spans = [(0.0, sync['video']['frames'] / sync['video']['fps'])]
+            return [(path, *sync_audio_span(sync, start, duration)) for path, (start, duration) in zip(video_outputs, spans)], manifest_path
+        if spans is not None:
+            return [(path, start, duration, 0.0) for path, (start, duration) in zip(video_outputs, spans)], manifest_path
+        try:
+            duration = sf.info(audio_path).duration
+        except Exception:
+            duration = None
+        return [(path, 0.0, duration, 0.0) for path in video_outputs], None
+
+    def submit(self, video_outputs, audio_path, priority=PRIORITY_NORMAL, audio_codec=DEFAULT_MUX_AUDIO_CODEC,
+               delete_originals=True):
+        """Queue a saved loop; returns the MuxJob, or None when the queue is full (the files stay separate)."""
+        if self.pending_count() >= self.max_pending: return None
+        sync = self.load_sync(audio_path)
+        parts, manifest_path = self.parts_for(video_outputs, audio_path, sync)
+        job = MuxJob(parts, audio_path, priority, audio_codec, delete_originals, manifest_path, sync)
+        with self._lock:
+            self._seq += 1
+            self._jobs.put((priority, self._seq, job))
+        return job
+
+    def shutdown(self, wait_ms=5000):
+        """Cancel running jobs (originals are kept) and stop the workers; queued jobs are dropped."""
+        for worker in self._workers: worker.stop()
+        for worker in self._workers:
+            if not worker.wait(wait_ms):
+                print("Warning: Mux worker did not finish in time.")
 
 
 # =============================================================================
 # == Audio Worker Thread ==
 # =============================================================================
-# <<< THÊM MỚI: Lớp AudioThread >>>
-class AudioThread(QThread):
-    """Handles audio recording in a separate thread using sounddevice and soundfile."""
-    error = pyqtSignal(str)            # Emits error messages
-    status_update = pyqtSignal(str)    # Emits status messages (e.g., started, stopped)
-    finished_writing = pyqtSignal(str) # Emits the filename when writing is complete
-
-    def __init__(self, filename, samplerate=44100, channels=1, device=None, blocksize=1024):
+class AudioRingBuffer:
+    """
+    Single-producer/single-consumer ring of audio frames.
+
+    The PortAudio callback only copies each block into a preallocated array and advances the write
+    position; the writer thread reads contiguous views and advances the read position. Each position
+    is written by exactly one side, so no lock is needed (plain int assignment is atomic under the GIL).
+    """
+
+    def __init__(self, capacity_frames, channels, dtype=np.float32):
+        """
+        Args:
+            capacity_frames (int): Frames the ring holds before new blocks are dropped.
+            channels (int): Interleaved channels per frame.
+            dtype: Sample type of the blocks (same as the stream's dtype).
+        """
+        self.capacity = max(1, int(capacity_frames))
+        self.channels = channels
+        self._data = np.zeros((self.capacity, channels), dtype=dtype)
+        self._write_pos = 0 # Tổng số frame đã ghi (chỉ callback thay đổi)
+        self._read_pos = 0  # Tổng số frame đã đọc (chỉ luồng ghi file thay đổi)
+        self.overflows = 0       # Số block bị bỏ vì ring đầy (luồng ghi file chậm)
+        self.overflow_frames = 0
+        self.max_fill = 0        # Số frame chờ nhiều nhất từng thấy
+
+    def fill(self):
+        return self._write_pos - self._read_pos
+
+    def write(self, block):
+        """Producer side (audio callback): copy a block in, or count an overflow if it does not fit."""
+        frames = len(block)
+        write_pos = self._write_pos
+        if write_pos - self._read_pos + frames > self.capacity:
+            self.overflows += 1
+            self.overflow_frames += frames
+            return False
+        start = write_pos % self.capacity
+        first = min(frames, self.capacity - start)
+        self._data[start:start + first] = block[:first]
+        if first < frames:
+            self._data[:frames - first] = block[first:]
+        self._write_pos = write_pos + frames # Công bố dữ liệu sau khi đã chép xong
+        fill = self._write_pos - self._read_pos
+        if fill > self.max_fill: self.max_fill = fill
+        return True
+
+    def peek(self):
+        """Consumer side: up to two views covering everything written so far (valid until consume())."""
+        read_pos, available = self._read_pos, self._write_pos - self._read_pos
+        if available <= 0: return []
+        start = read_pos % self.capacity
+        first = min(available, self.capacity - start)
+        views = [self._data[start:start + first]]
+        if first < available: views.append(self._data[:available - first])
+        return views
+
+    def consume(self, frames):
+        self._read_pos += frames
+
+
+class AudioLoopRecording:
+    """
+    One loop's WAV file, fed by the AudioCaptureService between two sample positions.
+
+    Stands in for the old per-loop audio thread: stop(), wait() and isRunning() behave the same,
+    but no device is opened or closed for a loop.
+    """
+
+    def __init__(self, service, filename, start_frame):
+        self.service = service
+        self.filename = filename
+        self.start_frame = start_frame # Vị trí mẫu tuyệt đối (theo bộ đếm của luồng thu)
+        self.end_frame = None          # None khi loop còn đang ghi
+        self.frames_written = 0
+        self.error = None
+        self._file = None
+        self._next_frame = start_frame
+        self._clips_at_start = service.clipped_samples
+        clock = service._clock
+        # Thời điểm (time.monotonic()) thu mẫu đầu tiên của loop, suy từ mốc đồng hồ gần nhất
+        self.first_sample_time = clock[1] + (start_frame - clock[0]) / service.samplerate if clock else None
+        self._fit = [0, 0.0, 0.0, 0.0, 0.0] # n, Σt, Σp, Σt², Σtp của các mốc (vị trí, thời điểm) trong loop
+        self._fit_origin = clock
+        self._fit_last = None
+        self._done = threading.Event()
+
+    def _add_clock(self, clock):
+        """Accumulate a (position, time) stamp for the sample-rate fit (writer thread, once per drain)."""
+        if clock is None or clock == self._fit_last or self._fit_origin is None: return
+        self._fit_last = clock
+        p, t = clock[0] - self._fit_origin[0], clock[1] - self._fit_origin[1]
+        fit = self._fit
+        fit[0] += 1; fit[1] += t; fit[2] += p; fit[3] += t * t; fit[4] += t * p
+
+    def measured_rate(self):
+        """Samples per second of the capture clock, by least squares over the loop; None if too short."""
+        n, st, sp, stt, stp = self._fit
+        if n < 10: return None
+        denom = n * stt - st * st
+        if denom <= 0 or (stt / n - (st / n) ** 2) < 0.25: return None # Cần ít nhất vài giây mốc
+        return (n * stp - st * sp) / denom
+
+    def sync_info(self):
+        """The loop's audio timeline on the capture clock, or None when the clock was unknown."""
+        if self.first_sample_time is None: return None
+        return {'first_sample_time': self.first_sample_time, 'samples': self.frames_written,
+                'samplerate': self.service.samplerate, 'measured_rate': self.measured_rate()}
+
+    def stop(self, at_time=None):
+        """End the loop at the sample captured at at_time (time.monotonic(), default now)."""
+        self.service.end_loop(self, time.monotonic() if at_time is None else at_time)
+
+    def wait(self, timeout_ms=None):
+        """Block until the WAV file is closed; False on timeout."""
+        return self._done.wait(None if timeout_ms is None else timeout_ms / 1000.0)
+
+    def isRunning(self):
+        return not self._done.is_set()
+
+    def counters(self):
+        counters = self.service.counters()
+        counters['frames_written'] = self.frames_written
+        counters['clipped_samples'] -= self._clips_at_start # Gần đúng: đếm theo lúc xả, không theo ranh giới mẫu
+        return counters
+
+
+class AudioCaptureService(QThread):
+    """
+    Long-lived input stream for the selected device; routes captured audio to the active loop's WAV.
+
+    The PortAudio callback only copies blocks into an AudioRingBuffer and stamps the capture clock.
+    This thread drains the ring, keeps a short history (so a loop can start in the past, matching the
+    video pre-roll) and writes each loop's exact sample range [start_frame, end_frame) to its file.
+    Loops that follow each other share the boundary sample, so switching loses nothing and the
+    device is never reopened.
+    """
+    error = pyqtSignal(str) # Emits error messages (stream open/runtime failures)
+    opened = pyqtSignal()   # Emitted once the stream is capturing
+
+    DRAIN_INTERVAL_MS = 50 # Gom dữ liệu trong ring rồi ghi một lần (cũng là nhịp cập nhật đồng hồ mức)
+    OPEN_TIMEOUT = 3.0     # Giây tối đa cho PortAudio mở thiết bị trước khi START đang chờ bị hủy
+
+    def __init__(self, samplerate=44100, channels=1, device=None, blocksize=1024, ring_seconds=10.0,
+                 history_seconds=1.0, latency=None, dtype='int16'):
         """
-        Initializes the AudioThread.
+        Initializes the capture service (the stream opens when the thread starts).
 
         Args:
-            filename (str): Path to save the WAV file.
             samplerate (int): Sampling frequency in Hz.
             channels (int): Number of input channels (1 for mono, 2 for stereo).
             device (int or str, optional): Input device ID or substring. Defaults to None (system default).
             blocksize (int): The number of frames passed to the stream callback.
+            latency (float or str, optional): PortAudio input latency ('low', 'high' or seconds); None = default.
+            dtype (str): Sample format requested from the device; 'int16' matches the PCM_16 WAV so
+                blocks go from the driver to the file without conversion.
+            ring_seconds (float): Audio the ring can hold while the WAV writer is stalled.
+            history_seconds (float): Drained audio kept so a loop can start before the START command.
         """
         super().__init__()
-        self.filename = filename
         self.samplerate = samplerate
         self.channels = channels
         self.device = device
-        self.blocksize = blocksize # Thêm blocksize để điều chỉnh
+        self.blocksize = blocksize
+        self.history_seconds = history_seconds
+        self.latency = latency
+        self.dtype = dtype
+        self.ring = AudioRingBuffer(int(samplerate * ring_seconds), channels, dtype=np.dtype(dtype))
+        self.device_overflows = 0  # Cờ input_overflow từ PortAudio (mất mẫu ở phía thiết bị)
+        self.device_underflows = 0 # Cờ input_underflow từ PortAudio
+        self._clock = None         # (vị trí mẫu đầu block, time.monotonic() lúc mẫu đó được thu)
+        self._history = deque()    # (vị trí mẫu, bản sao) của dữ liệu đã xả khỏi ring
+        self._drained = 0          # Vị trí mẫu đã xả khỏi ring
+        self._loops = []
+        self._loops_lock = threading.Lock()
         self._is_running = True
-        self._audio_file = None
+        self._opened = threading.Event()
+        self._failed = threading.Event()
         self._stream = None
-        print(f"Initializing AudioThread: File='{os.path.basename(filename)}', Rate={samplerate}, Channels={channels}, Device={device}")
-
-    def _audio_callback(self, indata, frames, time, status):
-        """This is called (from a separate thread) for each audio block."""
+        # Đồng hồ mức: luồng xả cộng dồn, luồng GUI lấy và reset (không đụng tới callback)
+        self._full_scale = float(np.iinfo(self.ring._data.dtype).max + 1) if self.ring._data.dtype.kind == 'i' else 1.0
+        self._levels_lock = threading.Lock()
+        self._levels = [0.0, 0, 0, 0] # tổng bình phương, số mẫu, đỉnh |x|, số mẫu bị clip
+        self.clipped_samples = 0
+
+    # --- Callback (luồng PortAudio) ---
+    def _audio_callback(self, indata, frames, time_info, status):
+        """Copy the block into the ring and stamp when its first sample was captured; nothing else."""
         if status:
-            print(f"Audio Stream Status Warning: {status}", file=sys.stderr)
-        # Ghi dữ liệu nhận được vào file WAV
-        # Kiểm tra xem file còn mở và thread có đang chạy không
-        if self._is_running and self._audio_file:
+            if status.input_overflow: self.device_overflows += 1
+            if status.input_underflow: self.device_underflows += 1
+        now = time.monotonic()
+        try: # Độ trễ từ ADC đến callback theo đồng hồ PortAudio
+            latency = min(max(time_info.currentTime - time_info.inputBufferAdcTime, 0.0), 1.0)
+        except AttributeError:
+            latency = 0.0
+        position = self.ring._write_pos
+        if self.ring.write(indata):
+            self._clock = (position, now - latency)
+
+    # --- Public API (luồng GUI) ---
+    def is_opening(self):
+        """True while the thread is still opening the stream (opened or error follows)."""
+        return not self._opened.is_set() and not self._failed.is_set() and not self.isFinished()
+
+    def is_capturing(self):
+        return self._opened.is_set() and not self._failed.is_set() and self.isRunning()
+
+    def position(self):
+        """Frames captured so far."""
+        return self.ring._write_pos
+
+    def position_at(self, at_time):
+        """Sample position captured at a time.monotonic() instant (may lie slightly in the future)."""
+        clock = self._clock
+        if clock is None: return self.position()
+        position, stamp = clock
+        return max(0, int(round(position + (at_time - stamp) * self.samplerate)))
+
+    def begin_loop(self, filename, start_time=None):
+        """Start routing audio into filename from the sample captured at start_time (default now)."""
+        start = self.position_at(time.monotonic() if start_time is None else start_time)
+        oldest = self._history[0][0] if self._history else self._drained
+        loop = AudioLoopRecording(self, filename, max(start, oldest))
+        with self._loops_lock:
+            self._loops.append(loop)
+        return loop
+
+    def end_loop(self, loop, at_time):
+        with self._loops_lock:
+            if loop.end_frame is None:
+                loop.end_frame = max(loop.start_frame, self.position_at(at_time))
+
+    def take_levels(self):
+        """RMS and peak (dBFS) plus clipped samples since the previous call; None before any audio."""
+        with self._levels_lock:
+            sum_sq, count, peak, clips = self._levels
+            self._levels = [0.0, 0, 0, 0]
+        if not count: return None
+        full_scale = self._full_scale
+        rms = np.sqrt(sum_sq / count) / full_scale
+        return {'rms_db': 20 * np.log10(max(rms, 1e-6)), 'peak_db': 20 * np.log10(max(peak / full_scale, 1e-6)),
+                'clips': clips}
+
+    def _measure(self, data):
+        """Accumulate level statistics of a drained chunk (vectorised, on the writer thread)."""
+        peak = max(-float(data.min()), float(data.max())) # float trước khi đổi dấu: -(-32768) tràn int16
+        samples = data.astype(np.float32).ravel()
+        sum_sq = float(np.dot(samples, samples))
+        threshold = self._full_scale - 1 if self._full_scale > 1 else 0.999 # Mẫu chạm biên số học
+        clips = int(np.count_nonzero(data >= threshold) + np.count_nonzero(data <= -threshold))
+        self.clipped_samples += clips
+        with self._levels_lock:
+            levels = self._levels
+            levels[0] += sum_sq
+            levels[1] += data.size
+            levels[2] = max(levels[2], peak)
+            levels[3] += clips
+
+    def counters(self):
+        """Ring and device counters, for sizing the ring per station."""
+        ring = self.ring
+        return {'clipped_samples': self.clipped_samples, 'ring_overflows': ring.overflows, 'ring_overflow_frames': ring.overflow_frames,
+                'ring_max_fill': ring.max_fill, 'ring_max_fill_ms': ring.max_fill * 1000.0 / self.samplerate,
+                'ring_capacity': ring.capacity, 'device_overflows': self.device_overflows,
+                'device_underflows': self.device_underflows}
+
+    # --- Writer (luồng này) ---
+    def _write_range(self, loop, first_frame, data):
+        """Append the part of data (starting at first_frame) that belongs to the loop."""
+        end = loop.end_frame if loop.end_frame is not None else first_frame + len(data)
+        lo = max(loop._next_frame, first_frame)
+        hi = min(end, first_frame + len(data))
+        if hi <= lo: return
+        loop._file.write(data[lo - first_frame:hi - first_frame])
+        loop.frames_written += hi - lo
+        loop._next_frame = hi
+
+    def _open_loop(self, loop):
+        os.makedirs(os.path.dirname(loop.filename), exist_ok=True)
+        # subtype='PCM_16' là định dạng WAV phổ biến
+        loop._file = sf.SoundFile(loop.filename, mode='w', samplerate=self.samplerate,
+                                  channels=self.channels, subtype='PCM_16')
+        for first_frame, data in list(self._history): # Phần loop nằm trước vị trí đã xả (pre-roll)
+            self._write_range(loop, first_frame, data)
+
+    def _close_loop(self, loop):
+        try:
+            if loop._file is not None: loop._file.close()
+        except Exception as e:
+            loop.error = str(e)
+            print(f"Error closing audio file '{loop.filename}': {e}", file=sys.stderr)
+        loop._file = None
+        print(f"Audio loop closed: {os.path.basename(loop.filename)} ({loop.frames_written} frames)")
+        loop._done.set()
+
+    def _route(self, first_frame, data, final=False):
+        """Write a drained chunk to every loop it overlaps and close loops that are complete."""
+        with self._loops_lock:
+            loops = list(self._loops)
+        finished = []
+        clock = self._clock
+        for loop in loops:
+            if loop.end_frame is None: loop._add_clock(clock)
             try:
-                self._audio_file.write(indata)
+                if loop._file is None: self._open_loop(loop)
+                if data is not None: self._write_range(loop, first_frame, data)
             except Exception as e:
-                 # Lỗi này có thể xảy ra nếu file bị đóng bất ngờ
-                 print(f"Error writing audio block: {e}", file=sys.stderr)
-                 # Có thể emit lỗi hoặc cố gắng dừng thread ở đây
-                 # self.error.emit(f"Lỗi ghi audio block: {e}")
-                 # self._is_running = False # Dừng thread nếu ghi lỗi
+                loop.error = str(e)
+                print(f"Error writing audio loop {os.path.basename(loop.filename)}: {e}", file=sys.stderr)
+                finished.append(loop)
+                continue
+            if final or (loop.end_frame is not None and self._drained >= loop.end_frame):
+                finished.append(loop)
+        if finished:
+            with self._loops_lock:
+                self._loops = [loop for loop in self._loops if loop not in finished]
+            for loop in finished: self._close_loop(loop)
+
+    def _drain(self, final=False):
+        """Move everything waiting in the ring to the history and the active loops."""
+        for view in self.ring.peek():
+            first_frame = self._drained
+            data = view.copy() # Ring có thể ghi đè vùng này ngay sau consume()
+            self.ring.consume(len(view))
+            self._drained += len(data)
+            self._measure(data)
+            self._history.append((first_frame, data))
+            self._route(first_frame, data)
+        history_frames = int(self.history_seconds * self.samplerate)
+        while self._history and self._drained - (self._history[0][0] + len(self._history[0][1])) > history_frames:
+            self._history.popleft()
+        self._route(self._drained, None, final=final)
 
     def run(self):
-        """Starts the audio recording stream."""
-        print(f"AudioThread ({os.path.basename(self.filename)}): Starting run loop.")
-        self._is_running = True # Đảm bảo cờ được đặt khi bắt đầu
-
+        """Open the stream once and drain it until stop()."""
+        print(f"AudioCaptureService: opening device {self.device} ({self.samplerate} Hz, {self.channels} ch, "
+              f"{self.dtype}, block={self.blocksize}, latency={self.latency}).")
         try:
-            # Đảm bảo thư mục tồn tại
-            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
-
-            # Mở file WAV để ghi
-            # subtype='PCM_16' là định dạng WAV phổ biến
-            self._audio_file = sf.SoundFile(self.filename, mode='w', samplerate=self.samplerate,
-                                            channels=self.channels, subtype='PCM_16')
-            print(f"Audio file opened: {self.filename}")
-
-            # Tạo và bắt đầu luồng ghi âm
             self._stream = sd.InputStream(
                 samplerate=self.samplerate,
                 device=self.device,
                 channels=self.channels,
+                dtype=self.dtype, # PCM 16-bit thẳng từ driver, soundfile ghi không cần chuyển đổi
+                latency=self.latency,
                 callback=self._audio_callback,
-                blocksize=self.blocksize # Sử dụng blocksize
+                blocksize=self.blocksize
             )
             self._stream.start()
-            self.status_update.emit(f"Bắt đầu ghi âm thanh vào {os.path.basename(self.filename)}")
-
-            # Giữ thread chạy miễn là _is_running là True
-            # Luồng callback của sounddevice sẽ xử lý việc ghi dữ liệu
+            self._opened.set()
+            self.opened.emit()
+            reported = (0, 0, 0)
             while self._is_running:
-                self.msleep(100) # Ngủ một chút để không chiếm CPU quá nhiều
-
-            print(f"AudioThread ({os.path.basename(self.filename)}): Run loop requested to exit.")
-
+                self.msleep(self.DRAIN_INTERVAL_MS)
+                self._drain()
+                current = (self.ring.overflows, self.device_overflows, self.device_underflows)
+                if current != reported:
+                    print(f"Audio Stream Status Warning: ring tràn={current[0]}, "
+                          f"overflow thiết bị={current[1]}, underflow thiết bị={current[2]}", file=sys.stderr)
+                    reported = current
         except sd.PortAudioError as pae:
-             error_msg = f"Lỗi PortAudio ({self.device}): {pae}"
-             print(error_msg, file=sys.stderr)
-             self.error.emit(error_msg + "\nKiểm tra thiết bị âm thanh hoặc thử chọn thiết bị khác.")
-             self._is_running = False
+            self._failed.set()
+            error_msg = f"Lỗi PortAudio ({self.device}): {pae}"
+            print(error_msg, file=sys.stderr)
+            self.error.emit(error_msg + "\nKiểm tra thiết bị âm thanh hoặc thử chọn thiết bị khác.")
         except Exception as e:
-            error_msg = f"Lỗi AudioThread không xác định: {e}"
+            self._failed.set()
+            error_msg = f"Lỗi luồng thu âm không xác định: {e}"
             print(error_msg, file=sys.stderr)
             self.error.emit(error_msg)
-            self._is_running = False # Dừng nếu có lỗi nghiêm trọng
         finally:
-            print(f"AudioThread ({os.path.basename(self.filename)}): Entering finally block.")
-            # --- Dọn dẹp tài nguyên ---
-            stream_closed = False
-            if self._stream:
+            if self._stream is not None:
                 try:
-                    if not self._stream.stopped: # Chỉ stop nếu chưa dừng
-                         print("Stopping audio stream...")
-                         self._stream.stop()
-                    if not self._stream.closed: # Chỉ close nếu chưa đóng
-                         print("Closing audio stream...")
-                         self._stream.close()
-                    stream_closed = True
-                    print("Audio stream stopped and closed.")
-                except sd.PortAudioError as pae_stop:
-                     print(f"Error stopping/closing audio stream: {pae_stop}", file=sys.stderr)
+                    self._stream.stop()
+                    self._stream.close()
                 except Exception as e_stop:
-                     print(f"Generic error stopping/closing audio stream: {e_stop}", file=sys.stderr)
-                self._stream = None # Xóa tham chiếu
+                    print(f"Error stopping/closing audio stream: {e_stop}", file=sys.stderr)
+                self._stream = None
+            self._drain(final=True) # Ghi phần còn lại và đóng mọi loop còn mở
+            print("AudioCaptureService: stream closed.")
 
-            file_closed = False
-            if self._audio_file:
-                try:
-                    if not self._audio_file.closed:
-                        print("Closing audio file...")
-                        self._audio_file.close()
-                        file_closed = True
-                        print("Audio file closed.")
-                except Exception as e_close:
-                     print(f"Error closing audio file '{self.filename}': {e_close}", file=sys.stderr)
-                self._audio_file = None # Xóa tham chiếu
-
-            # Emit tín hiệu chỉ khi cả stream và file đã được đóng (hoặc không tồn tại)
-            if stream_closed and file_closed:
-                 self.finished_writing.emit(self.filename)
-                 print(f"AudioThread confirmed finished writing: {os.path.basename(self.filename)}")
-            else:
-                 print(f"AudioThread finished writing confirmation SKIPPED (Stream closed: {stream_closed}, File closed: {file_closed})")
+    def stop(self):
+        """Stop capturing; open loops are closed with what has been captured."""
+        self._is_running = False
+
+
+class AudioCalibrator(QThread):
+    """Tries blocksize/latency combinations on a device and reports the lowest one that runs without xruns."""
+    progress = pyqtSignal(str)
+    finished_result = pyqtSignal(dict) # ok, blocksize, latency, latency_ms, trials
+
+    BLOCKSIZES = (64, 128, 256, 512, 1024, 2048)
+    LATENCIES = ('low', 'high')
+    TRIAL_SECONDS = 2.0
+
+    def __init__(self, samplerate=44100, channels=1, device=None, dtype='int16', trial_seconds=TRIAL_SECONDS):
+        """
+        Initializes the calibration run (the capture service must release the device first).
+
+        Args:
+            samplerate (int): Sampling frequency in Hz.
+            channels (int): Number of input channels.
+            device (int or str, optional): Input device ID; None = system default.
+            dtype (str): Sample format, as used by AudioCaptureService.
+            trial_seconds (float): How long each combination is captured.
+        """
+        super().__init__()
+        self.samplerate = samplerate
+        self.channels = channels
+        self.device = device
+        self.dtype = dtype
+        self.trial_seconds = trial_seconds
+        self._is_running = True
 
-            print(f"AudioThread ({os.path.basename(self.filename)}): Exiting run loop.")
+    def _trial(self, blocksize, latency):
+        """Capture for trial_seconds; returns xrun counts and the stream's reported input latency."""
+        counts = {'overflows': 0, 'underflows': 0, 'blocks': 0}
+        def callback(indata, frames, time_info, status):
+            counts['blocks'] += 1
+            if status:
+                if status.input_overflow: counts['overflows'] += 1
+                if status.input_underflow: counts['underflows'] += 1
+        with sd.InputStream(samplerate=self.samplerate, device=self.device, channels=self.channels,
+                            dtype=self.dtype, blocksize=blocksize, latency=latency, callback=callback) as stream:
+            deadline = time.monotonic() + self.trial_seconds
+            while self._is_running and time.monotonic() < deadline:
+                self.msleep(50)
+            reported = stream.latency
+        expected_blocks = self.trial_seconds * self.samplerate / blocksize
+        return {'blocksize': blocksize, 'latency': latency, 'xruns': counts['overflows'] + counts['underflows'],
+                'blocks': counts['blocks'], 'starved': counts['blocks'] < 0.8 * expected_blocks,
+                'latency_ms': (blocksize / self.samplerate + float(reported)) * 1000.0}
+
+    def run(self):
+        trials = []
+        best = None
+        # Thử từ cấu hình độ trễ thấp nhất; dừng ở cấu hình đầu tiên chạy sạch
+        for blocksize in self.BLOCKSIZES:
+            for latency in self.LATENCIES:
+                if not self._is_running: break
+                self.progress.emit(f"Hiệu chỉnh audio: block {blocksize}, latency {latency}...")
+                try:
+                    trial = self._trial(blocksize, latency)
+                except Exception as e:
+                    trial = {'blocksize': blocksize, 'latency': latency, 'error': str(e)}
+                trials.append(trial)
+                print(f"Audio calibration trial: {trial}")
+                if 'error' not in trial and trial['xruns'] == 0 and not trial['starved']:
+                    best = trial
+                    break
+            if best or not self._is_running: break
+        result = {'ok': best is not None, 'trials': trials}
+        if best: result.update(blocksize=best['blocksize'], latency=best['latency'], latency_ms=best['latency_ms'])
+        self.finished_result.emit(result)
 
     def stop(self):
-        """Requests the thread to stop recording."""
-        print(f"AudioThread ({os.path.basename(self.filename)}): Stop requested.")
         self._is_running = False
-        # Không cần gọi stream.stop() hay file.close() ở đây,
-        # vì khối finally trong run() sẽ xử lý việc đó khi vòng lặp kết thúc.
-        # Việc chờ thread kết thúc sẽ được thực hiện ở Main Window.
 
 
 # =============================================================================
@@ -342,6 +3276,129 @@ class SerialThread(QThread):
              # print(f"SerialThread ({self.port}) stopped successfully.")
 
 
+# =============================================================================
+# == Video Preview Widget ==
+# =============================================================================
+# Qt >= 5.14 vẽ được BGR trực tiếp; bản cũ hơn phải đảo kênh (một lần sao chép)
+_QIMAGE_FORMAT_BGR888 = getattr(QImage, 'Format_BGR888', None)
+
+
+class VideoWidget(QWidget):
+    """Paints BGR frames straight from their numpy buffer, without QPixmap/QLabel round-trips."""
+
+    def __init__(self, text="", parent=None):
+        super().__init__(parent)
+        self._text = text
+        self._frame = None       # PooledFrame đang hiển thị (được giữ tham chiếu)
+        self._image = None       # QImage bọc trực tiếp bộ nhớ của frame
+        self._image_size = None  # (w, h) của frame gần nhất, để biết khi nào cần tính lại khung vẽ
+        self._target_rect = QRect()
+        self.setAttribute(Qt.WA_OpaquePaintEvent) # Tự vẽ toàn bộ nền, Qt không cần xóa trước
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
+
+    def set_frame(self, frame):
+        """Display a PooledFrame (BGR, uint8). The widget keeps a reference until the next frame."""
+        image = frame.image
+        h, w = image.shape[:2]
+        if _QIMAGE_FORMAT_BGR888 is not None and image.flags['C_CONTIGUOUS']:
+            qt_image = QImage(image.data, w, h, image.strides[0], _QIMAGE_FORMAT_BGR888)
+        else:
+            qt_image = QImage(np.ascontiguousarray(image).data, w, h, 3 * w, QImage.Format_RGB888).rgbSwapped()
+        frame.retain()
+        old = self._frame
+        self._frame, self._image = frame, qt_image
+        if old is not None: old.release()
+        if self._image_size != (w, h):
+            self._image_size = (w, h)
+            self._update_target_rect()
+        self.update()
+
+    def setText(self, text):
+        """Show a placeholder message instead of video."""
+        self._text = text
+        self.clear_frame()
+
+    def clear_frame(self):
+        old, self._frame, self._image = self._frame, None, None
+        if old is not None: old.release()
+        self.update()
+
+    def _update_target_rect(self):
+        """Compute the aspect-preserving rect the frame is drawn into (only on resize/shape change)."""
+        if not self._image_size:
+            self._target_rect = QRect()
+            return
+        img_w, img_h = self._image_size
+        scale = min(self.width() / img_w, self.height() / img_h) if img_w and img_h else 0
+        w, h = int(img_w * scale), int(img_h * scale)
+        self._target_rect = QRect((self.width() - w) // 2, (self.height() - h) // 2, w, h)
+
+    def resizeEvent(self, event):
+        self._update_target_rect()
+        super().resizeEvent(event)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), QColor(Qt.black))
+        if self._image is not None:
+            painter.drawImage(self._target_rect, self._image)
+        elif self._text:
+            painter.setPen(QColor(Qt.white))
+            painter.drawText(self.rect(), Qt.AlignCenter, self._text)
+        painter.end()
+
+
+class AudioLevelMeter(QWidget):
+    """Horizontal dBFS bar (RMS) with a peak-hold tick and a clip indicator."""
+    FLOOR_DB = -60.0
+    PEAK_HOLD = 1.0 # Giây giữ vạch đỉnh
+    CLIP_HOLD = 2.0 # Giây giữ đèn báo clip
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rms_db = self.FLOOR_DB
+        self._peak_db = self.FLOOR_DB
+        self._peak_at = 0.0
+        self._clip_at = -self.CLIP_HOLD
+        self.setMinimumSize(120, 16)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
+
+    def set_levels(self, rms_db, peak_db, clips):
+        now = time.monotonic()
+        self._rms_db = max(self.FLOOR_DB, rms_db)
+        if peak_db >= self._peak_db or now - self._peak_at > self.PEAK_HOLD:
+            self._peak_db, self._peak_at = max(self.FLOOR_DB, peak_db), now
+        if clips: self._clip_at = now
+        self.setToolTip(f"RMS {rms_db:.1f} dBFS, đỉnh {peak_db:.1f} dBFS" + (f", clip {clips} mẫu" if clips else ""))
+        self.update()
+
+    def reset(self):
+        self._rms_db = self._peak_db = self.FLOOR_DB
+        self._clip_at = -self.CLIP_HOLD
+        self.setToolTip("Không có tín hiệu")
+        self.update()
+
+    def _x(self, db, width):
+        return int(width * (min(0.0, db) - self.FLOOR_DB) / -self.FLOOR_DB)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        clip_w = 12
+        bar_w = self.width() - clip_w - 2
+        h = self.height()
+        painter.fillRect(0, 0, bar_w, h, QColor(40, 40, 40))
+        level_x = self._x(self._rms_db, bar_w)
+        # Xanh dưới -18 dBFS, vàng tới -6 dBFS, đỏ gần 0
+        for start_db, end_db, color in ((self.FLOOR_DB, -18.0, QColor(0, 170, 0)), (-18.0, -6.0, QColor(220, 200, 0)),
+                                        (-6.0, 0.0, QColor(220, 0, 0))):
+            x0, x1 = self._x(start_db, bar_w), min(level_x, self._x(end_db, bar_w))
+            if x1 > x0: painter.fillRect(x0, 0, x1 - x0, h, color)
+        painter.fillRect(max(0, self._x(self._peak_db, bar_w) - 1), 0, 2, h, QColor(Qt.white))
+        clipping = time.monotonic() - self._clip_at < self.CLIP_HOLD
+        painter.fillRect(bar_w + 2, 0, clip_w, h, QColor(Qt.red) if clipping else QColor(80, 0, 0))
+        painter.end()
+
+
 # =============================================================================
 # == Main Application Window ==
 # =============================================================================
@@ -354,12 +3411,20 @@ class MainWindow(QMainWindow):
         # --- State Variables ---
         self.webcam_thread = None
         self.serial_thread = None
-        self.audio_thread = None # <<< THÊM MỚI: Biến cho audio thread
-        self.video_writer = None
+        self.audio_capture = None # AudioCaptureService: luồng thu âm mở suốt thời gian chạy app
+        self.audio_loop = None # AudioLoopRecording của loop đang ghi
+        self.audio_restart_pending = False # Đổi thiết bị khi đang ghi: mở lại sau khi loop dừng
+        self.pending_start = None # (source, requested_at) của lệnh START chờ luồng thu âm mở xong
+        self.recording_sink = None # RecordingSink sở hữu VideoWriter trong lúc ghi
+        self.finalizers = [] # RecordingFinalizer đang đóng/lưu các loop đã dừng
         self.is_recording = False
         self.is_paused = False # Pause hiện chỉ áp dụng cho video
         self.save_directory = os.getcwd()
         self.webcam_properties = {'width': None, 'height': None, 'fps': None}
+        self.camera_modes = {} # webcam index -> bảng chế độ đã dò (list of dict)
+        self.camera_cache = {} # webcam index -> {'name', 'backend'} từ lần quét trước
+        self.camera_scanner = None
+        self.requested_capture_format = None # None = để driver tự chọn
         self.last_video_filename = ""
         self.last_audio_filename = "" # <<< THÊM MỚI: Tên file audio gần nhất
 
@@ -369,11 +3434,87 @@ class MainWindow(QMainWindow):
         self.audio_samplerate = 44100
         self.audio_channels = 1 # Mono
         self.audio_device_index = None # None = Default device
+        self.audio_blocksize = 1024 # Ghi đè bởi kết quả hiệu chỉnh của từng thiết bị (audio/tuning/...)
+        self.audio_latency = None   # None = mặc định của PortAudio
+        self.audio_calibrator = None
+
+        # --- Recording Queue Config ---
+        self.record_queue_size = 60 # ~2 giây ở 30 FPS
+        self.record_queue_policy = RecordingSink.POLICY_BLOCK
+        self.settings = QSettings(SETTINGS_ORG, SETTINGS_APP)
+        self.record_cfr = self.settings.value("recording/cfr", True, type=bool) # Nhân bản/bỏ frame để thời lượng video khớp thời gian thực
+        self.record_adaptive = self.settings.value("recording/adaptive", True, type=bool) # Giảm tải theo từng mức khi encoder chậm
+        self.encoder_profile = self.settings.value("encoder/profile", DEFAULT_ENCODER_PROFILE)
+        if self.encoder_profile not in ENCODER_PROFILES or not encoder_available(self.encoder_profile):
+            self.encoder_profile = DEFAULT_ENCODER_PROFILE
+        self.encoder_threads = int(self.settings.value("encoder/threads", 0)) # 0 = encoder tự chọn
+        # CRF/bitrate cho encoder ffmpeg; -1 / "" = theo profile. Có bitrate (vd "4M") thì bỏ qua CRF
+        self.encoder_crf = max(-1, min(51, int(self.settings.value("encoder/crf", -1))))
+        self.encoder_bitrate = str(self.settings.value("encoder/bitrate", "") or "").strip()
+        if self.encoder_bitrate and not re.fullmatch(r"\d+(\.\d+)?[kKmM]?", self.encoder_bitrate):
+            print(f"Warning: Ignoring invalid encoder/bitrate setting '{self.encoder_bitrate}'.", file=sys.stderr)
+            self.encoder_bitrate = ""
+        self.encode_in_process = self.settings.value("encoder/separate_process", False, type=bool)
+        self.segment_seconds = int(self.settings.value("recording/segment_seconds", 0)) # 0 = một file cho cả loop
+        self.segment_mb = int(self.settings.value("recording/segment_mb", 0))
+        self.preroll_seconds = int(self.settings.value("preroll/seconds", 0)) # 0 = không giữ pre-roll
+        self.preroll_mb = int(self.settings.value("preroll/max_mb", 512))
+        self.preroll_mode = self.settings.value("preroll/mode", "raw") # "raw" = frame BGR, "jpeg" = nén trong RAM
+        self.preroll_jpeg_quality = int(self.settings.value("preroll/jpeg_quality", 90))
+        # Writer chờ sẵn trên file tạm để lệnh START không phải đợi mở encoder
+        self.use_standby_writer = self.settings.value("recording/standby_writer", True, type=bool)
+        self.audio_ring_seconds = float(self.settings.value("audio/ring_seconds", 10.0)) # Đệm audio khi ghi file bị chậm
+        # Định dạng chịu được sập nguồn/treo app; chuyển lại MP4 thường khi lưu nếu bật
+        self.record_container = self.settings.value("recording/container", DEFAULT_RECORDING_CONTAINER)
+        if self.record_container not in RECORDING_CONTAINERS:
+            self.record_container = DEFAULT_RECORDING_CONTAINER
+        self.remux_to_mp4 = self.settings.value("recording/remux_to_mp4", True, type=bool)
+        # Ghép video + WAV thành một file sau khi lưu (chạy nền bằng ffmpeg)
+        self.mux_enabled = self.settings.value("mux/enabled", bool(FFMPEG_BINARY), type=bool) and bool(FFMPEG_BINARY)
+        self.mux_audio_codec = self.settings.value("mux/audio_codec", DEFAULT_MUX_AUDIO_CODEC)
+        if self.mux_audio_codec not in MUX_AUDIO_CODECS: self.mux_audio_codec = DEFAULT_MUX_AUDIO_CODEC
+        self.mux_delete_originals = self.settings.value("mux/delete_originals", True, type=bool)
+        self.mux_queue = MuxQueue(workers=int(self.settings.value("mux/workers", 1)),
+                                  max_pending=int(self.settings.value("mux/max_pending", 32)))
+        self.mux_queue.job_progress.connect(self._on_mux_progress)
+        self.mux_queue.job_finished.connect(self._on_mux_finished)
+        self.standby_sink = None
+        self.standby_signature = None
+        self.standby_counter = 0
+        self.standby_opener = None # StandbyWriterOpener đang mở writer chờ sẵn
+        self.standby_closers = []  # StandbySinkCloser đang đóng/xóa writer chờ sẵn bị bỏ
 
         # --- Timers ---
         self.status_timer = QTimer(self)
         self.status_timer.timeout.connect(self._update_status_visuals)
         self.recording_flash_state = False
+        # Preview kéo frame mới nhất từ mailbox của WebcamThread theo nhịp này
+        self.preview_fps = 15.0 # Không cần 30 FPS cho người vận hành; để CPU cho việc mã hóa
+        self.preview_interval_ms = int(1000 / self.preview_fps)
+        self.preview_worker = None
+        self.preview_timer = QTimer(self)
+        self.preview_timer.timeout.connect(self._on_preview_tick)
+        # Gom các thay đổi cấu hình liên tiếp rồi mới chuẩn bị lại writer chờ sẵn
+        self.standby_timer = QTimer(self)
+        self.standby_timer.setSingleShot(True)
+        self.standby_timer.setInterval(500)
+        self.standby_timer.timeout.connect(self._prepare_standby_sink)
+        # Mở lại luồng thu âm sau khi việc chọn thiết bị đã ổn định (quét thiết bị đổi chọn nhiều lần)
+        self.audio_restart_timer = QTimer(self)
+        self.audio_restart_timer.setSingleShot(True)
+        self.audio_restart_timer.setInterval(300)
+        self.audio_restart_timer.timeout.connect(self._restart_audio_capture)
+        # Giới hạn thời gian một lệnh START chờ thiết bị âm thanh mở (không chờ chặn trên luồng GUI)
+        self.audio_open_timer = QTimer(self)
+        self.audio_open_timer.setSingleShot(True)
+        self.audio_open_timer.setInterval(int(AudioCaptureService.OPEN_TIMEOUT * 1000))
+        self.audio_open_timer.timeout.connect(self._on_audio_open_timeout)
+        # Đồng hồ mức audio: GUI hỏi số liệu ~20 lần/giây, luồng thu không phát tín hiệu theo từng block
+        self.audio_meter_timer = QTimer(self)
+        self.audio_meter_timer.setInterval(50)
+        self.audio_meter_timer.timeout.connect(self._on_audio_meter_tick)
+        self._last_preview_seq = 0
+        self.preview_frames_skipped = 0 # Số frame bị ghi đè trước khi kịp hiển thị
 
         # --- Constants ---
         self.common_baud_rates = ["9600", "19200", "38400", "57600", "115200", "250000", "4800", "2400"]
@@ -386,6 +3527,8 @@ class MainWindow(QMainWindow):
         self._scan_webcams()
         self._scan_serial_ports()
         self._scan_audio_devices() # <<< THÊM MỚI: Quét thiết bị audio
+        self.audio_restart_timer.start() # Mở luồng thu âm một lần, dùng cho mọi loop
+        self.audio_meter_timer.start()
         self._update_save_dir_label()
 
         print("MainWindow initialized.")
@@ -398,10 +3541,9 @@ class MainWindow(QMainWindow):
         self.main_layout = QVBoxLayout(self.central_widget)
 
         # --- 1. Video Display Area (Giữ nguyên) ---
-        self.video_frame_label = QLabel("Chưa bật Webcam")
-        # ... (Giữ nguyên cấu hình QLabel)
-        self.video_frame_label.setMinimumSize(640, 480)
-        self.main_layout.addWidget(self.video_frame_label, 1)
+        self.video_widget = VideoWidget("Chưa bật Webcam")
+        self.video_widget.setMinimumSize(640, 480)
+        self.main_layout.addWidget(self.video_widget, 1)
 
         # --- 2. Controls Area (Horizontal Layout) ---
         self.controls_area_widget = QWidget()
@@ -427,8 +3569,32 @@ class MainWindow(QMainWindow):
         self.btn_stop_webcam.setEnabled(False)
         webcam_buttons_layout.addWidget(self.btn_start_webcam)
         webcam_buttons_layout.addWidget(self.btn_stop_webcam)
+        webcam_rate_layout = QHBoxLayout()
+        self.combo_target_fps = QComboBox()
+        self.combo_target_fps.addItem("Theo camera", userData=None)
+        for rate in (30, 25, 20, 15, 10, 5):
+            self.combo_target_fps.addItem(f"{rate} FPS", userData=float(rate))
+        webcam_rate_layout.addWidget(QLabel("Tốc độ:"))
+        webcam_rate_layout.addWidget(self.combo_target_fps, 1)
+        self.combo_preview_fps = QComboBox()
+        for rate in (5, 10, 15, 20, 30):
+            self.combo_preview_fps.addItem(f"{rate} FPS", userData=float(rate))
+        self.combo_preview_fps.setCurrentIndex(self.combo_preview_fps.findData(self.preview_fps))
+        webcam_rate_layout.addWidget(QLabel("Xem trước:"))
+        webcam_rate_layout.addWidget(self.combo_preview_fps, 1)
+        webcam_format_layout = QHBoxLayout()
+        self.combo_capture_format = QComboBox()
+        self.combo_capture_format.addItem("Mặc định driver", userData=None)
+        self.combo_capture_format.setToolTip("Bảng chế độ được dò khi bật webcam lần đầu")
+        webcam_format_layout.addWidget(QLabel("Định dạng:"))
+        webcam_format_layout.addWidget(self.combo_capture_format, 1)
+        self.lbl_capture_stats = QLabel("FPS: - | Jitter: - | Mất (driver): -")
+        self.lbl_capture_stats.setFont(QFont("Consolas", 9))
         webcam_group_layout.addLayout(webcam_select_layout)
         webcam_group_layout.addLayout(webcam_buttons_layout)
+        webcam_group_layout.addLayout(webcam_rate_layout)
+        webcam_group_layout.addLayout(webcam_format_layout)
+        webcam_group_layout.addWidget(self.lbl_capture_stats)
         webcam_group.setLayout(webcam_group_layout)
         col1_layout.addWidget(webcam_group)
 
@@ -437,9 +3603,14 @@ class MainWindow(QMainWindow):
         audio_layout = QHBoxLayout()
         self.combo_audio_device = QComboBox()
         self.btn_scan_audio = QPushButton("Quét Mic")
+        self.btn_calibrate_audio = QPushButton("Hiệu chỉnh")
+        self.btn_calibrate_audio.setToolTip("Thử các cỡ block/độ trễ trên Mic đã chọn và lưu cấu hình thấp nhất không bị mất mẫu")
         audio_layout.addWidget(QLabel("Chọn Mic:"))
         audio_layout.addWidget(self.combo_audio_device, 1)
+        self.audio_meter = AudioLevelMeter()
+        audio_layout.addWidget(self.audio_meter, 1)
         audio_layout.addWidget(self.btn_scan_audio)
+        audio_layout.addWidget(self.btn_calibrate_audio)
         audio_group.setLayout(audio_layout)
         col1_layout.addWidget(audio_group)
         # <<< /THÊM MỚI >>>
@@ -467,6 +3638,120 @@ class MainWindow(QMainWindow):
         record_buttons_layout.addWidget(self.btn_pause_record)
         record_buttons_layout.addWidget(self.btn_stop_save_record)
         record_buttons_layout.addWidget(self.btn_reset_counter) # <<< THÊM VÀO LAYOUT >>>
+        # Encoder Layout
+        encoder_layout = QHBoxLayout()
+        self.combo_encoder = QComboBox()
+        for profile, (label, _, _) in ENCODER_PROFILES.items():
+            self.combo_encoder.addItem(label, userData=profile)
+            if not encoder_available(profile):
+                # Làm mờ hồ sơ ffmpeg khi máy không có ffmpeg
+                self.combo_encoder.model().item(self.combo_encoder.count() - 1).setEnabled(False)
+        self.combo_encoder.setCurrentIndex(self.combo_encoder.findData(self.encoder_profile))
+        encoder_layout.addWidget(QLabel("Bộ mã hóa:"))
+        encoder_layout.addWidget(self.combo_encoder, 1)
+        self.chk_encode_process = QCheckBox("Tiến trình riêng")
+        self.chk_encode_process.setChecked(self.encode_in_process)
+        self.chk_encode_process.setToolTip("Mã hóa trong tiến trình riêng (frame qua shared memory) để không tranh CPU với giao diện/serial")
+        encoder_layout.addWidget(self.chk_encode_process)
+        # Container Layout
+        container_layout = QHBoxLayout()
+        self.combo_container = QComboBox()
+        for container, (label, _) in RECORDING_CONTAINERS.items():
+            self.combo_container.addItem(label, userData=container)
+            if container == 'fmp4' and not FFMPEG_BINARY:
+                self.combo_container.model().item(self.combo_container.count() - 1).setEnabled(False)
+        self.combo_container.setCurrentIndex(self.combo_container.findData(self.record_container))
+        self.combo_container.setToolTip("MP4 thường mất toàn bộ nếu app bị tắt đột ngột; MP4 phân mảnh/MKV/AVI vẫn xem được phần đã ghi")
+        container_layout.addWidget(QLabel("Vùng chứa (container):"))
+        container_layout.addWidget(self.combo_container, 1)
+        self.chk_remux_mp4 = QCheckBox("Chuyển sang MP4 khi lưu")
+        self.chk_remux_mp4.setChecked(self.remux_to_mp4)
+        self.chk_remux_mp4.setToolTip("Sau khi lưu, ffmpeg chép lại luồng video sang MP4 thường (AVI MJPEG được mã hóa lại H.264)")
+        self.chk_remux_mp4.setEnabled(bool(FFMPEG_BINARY))
+        container_layout.addWidget(self.chk_remux_mp4)
+        # Mux Layout
+        mux_layout = QHBoxLayout()
+        self.chk_mux = QCheckBox("Ghép A/V sau khi lưu")
+        self.chk_mux.setChecked(self.mux_enabled)
+        self.chk_mux.setEnabled(bool(FFMPEG_BINARY))
+        self.chk_mux.setToolTip("Ghép video và WAV thành một file (chép nguyên luồng video, nén audio) trong nền")
+        mux_layout.addWidget(self.chk_mux)
+        self.combo_mux_codec = QComboBox()
+        for codec, (label, _, _) in MUX_AUDIO_CODECS.items():
+            self.combo_mux_codec.addItem(label, userData=codec)
+        self.combo_mux_codec.setCurrentIndex(self.combo_mux_codec.findData(self.mux_audio_codec))
+        mux_layout.addWidget(self.combo_mux_codec, 1)
+        self.chk_mux_delete = QCheckBox("Xóa file gốc")
+        self.chk_mux_delete.setChecked(self.mux_delete_originals)
+        self.chk_mux_delete.setToolTip("Chỉ xóa video/WAV gốc sau khi file ghép đã được kiểm tra đọc được")
+        mux_layout.addWidget(self.chk_mux_delete)
+        self.lbl_mux_status = QLabel("")
+        mux_layout.addWidget(self.lbl_mux_status, 1)
+        # Segment Layout
+        segment_layout = QHBoxLayout()
+        self.combo_segment_seconds = QComboBox()
+        for seconds, label in ((0, "Tắt"), (60, "1 phút"), (300, "5 phút"), (600, "10 phút"), (900, "15 phút")):
+            self.combo_segment_seconds.addItem(label, userData=seconds)
+        if self.combo_segment_seconds.findData(self.segment_seconds) < 0:
+            self.combo_segment_seconds.addItem(f"{self.segment_seconds} giây", userData=self.segment_seconds)
+        self.combo_segment_seconds.setCurrentIndex(self.combo_segment_seconds.findData(self.segment_seconds))
+        self.combo_segment_mb = QComboBox()
+        for mb, label in ((0, "Không giới hạn"), (100, "100 MB"), (500, "500 MB"), (1024, "1 GB"), (2048, "2 GB")):
+            self.combo_segment_mb.addItem(label, userData=mb)
+        if self.combo_segment_mb.findData(self.segment_mb) < 0:
+            self.combo_segment_mb.addItem(f"{self.segment_mb} MB", userData=self.segment_mb)
+        self.combo_segment_mb.setCurrentIndex(self.combo_segment_mb.findData(self.segment_mb))
+        segment_layout.addWidget(QLabel("Chia đoạn:"))
+        segment_layout.addWidget(self.combo_segment_seconds, 1)
+        segment_layout.addWidget(QLabel("hoặc mỗi"))
+        segment_layout.addWidget(self.combo_segment_mb, 1)
+        # Pre-roll Layout
+        preroll_layout = QHBoxLayout()
+        self.combo_preroll_seconds = QComboBox()
+        for seconds, label in ((0, "Tắt"), (5, "5 giây"), (10, "10 giây"), (20, "20 giây"), (30, "30 giây")):
+            self.combo_preroll_seconds.addItem(label, userData=seconds)
+        if self.combo_preroll_seconds.findData(self.preroll_seconds) < 0:
+            self.combo_preroll_seconds.addItem(f"{self.preroll_seconds} giây", userData=self.preroll_seconds)
+        self.combo_preroll_seconds.setCurrentIndex(self.combo_preroll_seconds.findData(self.preroll_seconds))
+        self.combo_preroll_mb = QComboBox()
+        for mb in (128, 256, 512, 1024, 2048):
+            self.combo_preroll_mb.addItem(f"{mb} MB", userData=mb)
+        if self.combo_preroll_mb.findData(self.preroll_mb) < 0:
+            self.combo_preroll_mb.addItem(f"{self.preroll_mb} MB", userData=self.preroll_mb)
+        self.combo_preroll_mb.setCurrentIndex(self.combo_preroll_mb.findData(self.preroll_mb))
+        self.combo_preroll_mb.setToolTip("Giới hạn RAM cho pre-roll; frame cũ bị loại trước khi vượt giới hạn")
+        preroll_layout.addWidget(QLabel("Pre-roll:"))
+        preroll_layout.addWidget(self.combo_preroll_seconds, 1)
+        preroll_layout.addWidget(QLabel("tối đa"))
+        preroll_layout.addWidget(self.combo_preroll_mb, 1)
+        self.combo_preroll_mode = QComboBox()
+        self.combo_preroll_mode.addItem("Thô (BGR)", userData="raw")
+        self.combo_preroll_mode.addItem("Nén JPEG", userData="jpeg")
+        self.combo_preroll_mode.setCurrentIndex(max(0, self.combo_preroll_mode.findData(self.preroll_mode)))
+        self.combo_preroll_mode.setToolTip("JPEG giữ được nhiều giây hơn trong cùng dung lượng RAM, đổi lại tốn CPU để nén/giải nén")
+        preroll_layout.addWidget(self.combo_preroll_mode)
+        # Queue policy Layout
+        queue_policy_layout = QHBoxLayout()
+        self.combo_queue_policy = QComboBox()
+        self.combo_queue_policy.addItem("Chờ (không bỏ frame)", userData=RecordingSink.POLICY_BLOCK)
+        self.combo_queue_policy.addItem("Bỏ frame cũ nhất", userData=RecordingSink.POLICY_DROP_OLDEST)
+        self.combo_queue_policy.addItem("Bỏ frame mới nhất", userData=RecordingSink.POLICY_DROP_NEWEST)
+        self.combo_queue_policy.setCurrentIndex(self.combo_queue_policy.findData(self.record_queue_policy))
+        queue_policy_layout.addWidget(QLabel("Hàng đợi ghi đầy:"))
+        queue_policy_layout.addWidget(self.combo_queue_policy, 1)
+        self.chk_cfr = QCheckBox("FPS cố định (CFR)")
+        self.chk_cfr.setChecked(self.record_cfr)
+        self.chk_cfr.setToolTip("Nhân bản/bỏ frame theo thời điểm chụp để video phát đúng thời lượng thực")
+        queue_policy_layout.addWidget(self.chk_cfr)
+        self.chk_adaptive = QCheckBox("Tự giảm tải")
+        self.chk_adaptive.setChecked(self.record_adaptive)
+        self.chk_adaptive.setToolTip("Khi encoder không theo kịp: bỏ 1/2 frame (lấp bằng frame nhân bản), giảm chi tiết, rồi bỏ 2/3 frame "
+                                     "và giảm chất lượng; tự phục hồi khi tải giảm")
+        queue_policy_layout.addWidget(self.chk_adaptive)
+        self.chk_standby_writer = QCheckBox("Writer chờ sẵn")
+        self.chk_standby_writer.setChecked(self.use_standby_writer)
+        self.chk_standby_writer.setToolTip("Mở sẵn encoder trên file tạm để START ghi ngay frame đầu tiên; đổi tên khi lưu")
+        queue_policy_layout.addWidget(self.chk_standby_writer)
         # Recording Status Label (Giữ nguyên)
         self.lbl_record_status = QLabel("Trạng thái: Sẵn sàng")
         self.lbl_record_status.setAlignment(Qt.AlignCenter)
@@ -474,6 +3759,12 @@ class MainWindow(QMainWindow):
         # Add sub-layouts to group
         record_group_layout.addLayout(save_dir_layout)
         record_group_layout.addLayout(record_buttons_layout)
+        record_group_layout.addLayout(encoder_layout)
+        record_group_layout.addLayout(container_layout)
+        record_group_layout.addLayout(mux_layout)
+        record_group_layout.addLayout(segment_layout)
+        record_group_layout.addLayout(preroll_layout)
+        record_group_layout.addLayout(queue_policy_layout)
         record_group_layout.addWidget(self.lbl_record_status)
         record_group.setLayout(record_group_layout)
         col1_layout.addWidget(record_group)
@@ -543,10 +3834,14 @@ class MainWindow(QMainWindow):
         self.btn_scan_webcam.clicked.connect(self._scan_webcams)
         self.btn_start_webcam.clicked.connect(self._start_webcam)
         self.btn_stop_webcam.clicked.connect(self._stop_webcam)
+        self.combo_webcam.currentIndexChanged.connect(self._on_webcam_selected)
+        self.combo_capture_format.currentIndexChanged.connect(self._on_capture_format_selected)
+        self.combo_preview_fps.currentIndexChanged.connect(self._on_preview_fps_selected)
 
         # <<< THÊM MỚI: Audio Controls >>>
         self.btn_scan_audio.clicked.connect(self._scan_audio_devices)
         self.combo_audio_device.currentIndexChanged.connect(self._on_audio_device_selected)
+        self.btn_calibrate_audio.clicked.connect(self._calibrate_audio)
 
         # Recording Controls
         self.btn_select_dir.clicked.connect(self._select_save_directory)
@@ -554,6 +3849,22 @@ class MainWindow(QMainWindow):
         self.btn_pause_record.clicked.connect(self._manual_pause_recording)
         self.btn_stop_save_record.clicked.connect(self._manual_stop_save_recording)
         self.btn_reset_counter.clicked.connect(self._reset_recording_counter) # <<< KẾT NỐI RESET >>>
+        self.combo_queue_policy.currentIndexChanged.connect(self._on_queue_policy_selected)
+        self.chk_cfr.toggled.connect(self._on_cfr_toggled)
+        self.combo_encoder.currentIndexChanged.connect(self._on_encoder_selected)
+        self.chk_encode_process.toggled.connect(self._on_encode_process_toggled)
+        self.combo_container.currentIndexChanged.connect(self._on_container_selected)
+        self.chk_remux_mp4.toggled.connect(self._on_remux_toggled)
+        self.chk_mux.toggled.connect(self._on_mux_settings_changed)
+        self.combo_mux_codec.currentIndexChanged.connect(self._on_mux_settings_changed)
+        self.chk_mux_delete.toggled.connect(self._on_mux_settings_changed)
+        self.combo_segment_seconds.currentIndexChanged.connect(self._on_segment_limits_changed)
+        self.combo_segment_mb.currentIndexChanged.connect(self._on_segment_limits_changed)
+        self.chk_standby_writer.toggled.connect(self._on_standby_writer_toggled)
+        self.chk_adaptive.toggled.connect(self._on_adaptive_toggled)
+        self.combo_preroll_seconds.currentIndexChanged.connect(self._on_preroll_limits_changed)
+        self.combo_preroll_mb.currentIndexChanged.connect(self._on_preroll_limits_changed)
+        self.combo_preroll_mode.currentIndexChanged.connect(self._on_preroll_mode_selected)
 
         # Serial Controls
         self.btn_scan_serial.clicked.connect(self._scan_serial_ports)
@@ -586,6 +3897,10 @@ class MainWindow(QMainWindow):
             display_filename_vid = os.path.basename(self.last_video_filename) if self.last_video_filename else "..."
             display_filename_aud = os.path.basename(self.last_audio_filename) if self.last_audio_filename else "..."
             base_text = f"VID: {display_filename_vid} | AUD: {display_filename_aud}"
+            sink = self.recording_sink
+            if sink:
+                c = sink.counters()
+                base_text += f" | Q: {c['pending']} Mất: {c['dropped']}"
 
             self.recording_flash_state = not self.recording_flash_state
             if self.is_paused: # Chỉ trạng thái pause của video
@@ -617,41 +3932,69 @@ class MainWindow(QMainWindow):
     # ================== Device Scan Methods ==================
 
     def _scan_webcams(self):
-        """Scan for available webcams and update the combobox."""
-        self.combo_webcam.clear()
-        available_webcams = []
-        index = 0
-        max_scan_index = 5
+        """Start a background webcam scan; cached cameras are listed immediately."""
+        if self.camera_scanner and self.camera_scanner.isRunning():
+            return
         print("Scanning for webcams...")
-        while index < max_scan_index:
-            # print(f"  Checking webcam index: {index}") # Giảm log
-            cap = cv2.VideoCapture(index, cv2.CAP_MSMF)
-            opened = cap.isOpened()
-            if not opened: cap.release(); cap = cv2.VideoCapture(index); opened = cap.isOpened()
-
-            if opened:
-                cam_name = f"Webcam {index}"
-                # Cố gắng lấy tên thân thiện hơn (có thể không hoạt động trên mọi OS/backend)
-                try: backend_name = cap.getBackendName()
-                except: backend_name = "?"
-                # print(f"  Webcam {index} ({backend_name}) opened.")
-                available_webcams.append((index, cam_name))
-                cap.release()
-                index += 1
-            else:
-                cap.release()
-                # print(f"  Webcam index {index} failed.")
-                break # Dừng quét nếu không mở được index liên tiếp
+        self.combo_webcam.clear()
+        for index in sorted(self.camera_cache):
+            self._set_webcam_item(index, self.camera_cache[index]['name'])
+        if self.combo_webcam.count() == 0:
+            self.combo_webcam.addItem("Đang quét webcam...")
+            self.btn_start_webcam.setEnabled(False)
+        self.btn_scan_webcam.setEnabled(False)
+        self._update_status("Đang quét webcam...")
+
+        self.camera_scanner = CameraScanner()
+        self.camera_scanner.camera_found.connect(self._on_camera_found)
+        self.camera_scanner.scan_finished.connect(self._on_camera_scan_finished)
+        self.camera_scanner.start()
+
+    def _set_webcam_item(self, index, name):
+        """Add or rename the combobox entry for a webcam index, keeping entries sorted by index."""
+        existing = self.combo_webcam.findData(index)
+        if existing >= 0:
+            self.combo_webcam.setItemText(existing, name)
+            return
+        # Bỏ mục giữ chỗ ("Đang quét..."/"Không tìm thấy") nếu có
+        if self.combo_webcam.count() == 1 and self.combo_webcam.itemData(0) is None:
+            self.combo_webcam.clear()
+        position = 0
+        while position < self.combo_webcam.count() and self.combo_webcam.itemData(position) < index:
+            position += 1
+        self.combo_webcam.insertItem(position, name, index)
+        if self.combo_webcam.currentIndex() < 0: self.combo_webcam.setCurrentIndex(0)
+        if not (self.webcam_thread and self.webcam_thread.isRunning()):
+            self.btn_start_webcam.setEnabled(True)
 
-        if not available_webcams:
+    def _on_camera_found(self, index, name, backend):
+        """Slot for each camera the scanner managed to open."""
+        if self.sender() != self.camera_scanner: return
+        self.camera_cache[index] = {'name': name, 'backend': backend}
+        self._set_webcam_item(index, name)
+        print(f"  Found webcam {index}: {name} ({backend})")
+
+    def _on_camera_scan_finished(self, found, unresolved):
+        """Drop cached cameras that were reported missing and finalize the combobox."""
+        if self.sender() != self.camera_scanner: return
+        self.camera_scanner = None
+        running_index = self.webcam_thread.webcam_index if self.webcam_thread and self.webcam_thread.isRunning() else None
+        for index in list(self.camera_cache):
+            # Lượt dò quá hạn/lỗi không chứng minh camera đã mất: giữ lại trong danh sách
+            if index not in found and index not in unresolved and index != running_index:
+                del self.camera_cache[index]
+                position = self.combo_webcam.findData(index)
+                if position >= 0: self.combo_webcam.removeItem(position)
+
+        if self.combo_webcam.count() == 0 or self.combo_webcam.itemData(0) is None:
+            self.combo_webcam.clear()
             self.combo_webcam.addItem("Không tìm thấy webcam")
             self.btn_start_webcam.setEnabled(False)
             self._update_status("Không tìm thấy webcam nào.")
         else:
-            for idx, name in available_webcams: self.combo_webcam.addItem(name, userData=idx)
-            self.btn_start_webcam.setEnabled(True)
-            self._update_status(f"Tìm thấy {len(available_webcams)} webcam.")
-            if len(available_webcams) > 0: self.combo_webcam.setCurrentIndex(0)
+            self._update_status(f"Tìm thấy {self.combo_webcam.count()} webcam.")
+        if not (self.webcam_thread and self.webcam_thread.isRunning()):
+            self.btn_scan_webcam.setEnabled(True)
 
     def _scan_serial_ports(self):
         """Scan for available serial ports and update the combobox."""
@@ -741,9 +4084,120 @@ class MainWindow(QMainWindow):
             selected_data = self.combo_audio_device.itemData(index)
             self.audio_device_index = selected_data # Sẽ là None nếu chọn "Thiết bị mặc định"
             print(f"Audio device selection changed to index: {self.audio_device_index}")
+            if self.is_recording:
+                self.audio_restart_pending = True # Không cắt ngang loop đang ghi
+            else:
+                self.audio_restart_timer.start()
             # Có thể cập nhật samplerate mặc định ở đây nếu muốn
             # Hoặc hiển thị thông tin thiết bị trong status bar
 
+    def _on_encoder_selected(self, index):
+        """Remember the encoder profile used for the next recording."""
+        if index < 0: return
+        self.encoder_profile = self.combo_encoder.itemData(index)
+        self.settings.setValue("encoder/profile", self.encoder_profile)
+        print(f"Encoder profile changed to: {self.encoder_profile}")
+        self.standby_timer.start()
+
+    def _on_encode_process_toggled(self, checked):
+        """Run the next recording's encoder in a separate process."""
+        self.encode_in_process = checked
+        self.settings.setValue("encoder/separate_process", checked)
+        self.standby_timer.start()
+
+    def _on_container_selected(self, index):
+        """Remember the file container used for the next recording."""
+        if index < 0: return
+        self.record_container = self.combo_container.itemData(index)
+        self.settings.setValue("recording/container", self.record_container)
+        print(f"Recording container changed to: {self.record_container}")
+        self.standby_timer.start()
+
+    def _on_remux_toggled(self, checked):
+        """Enable/disable converting saved recordings to a regular MP4."""
+        self.remux_to_mp4 = checked
+        self.settings.setValue("recording/remux_to_mp4", checked)
+
+    def _on_mux_settings_changed(self, *_):
+        """Remember how saved loops are muxed; applies to loops saved from now on."""
+        self.mux_enabled = self.chk_mux.isChecked()
+        self.mux_audio_codec = self.combo_mux_codec.currentData() or DEFAULT_MUX_AUDIO_CODEC
+        self.mux_delete_originals = self.chk_mux_delete.isChecked()
+        self.settings.setValue("mux/enabled", self.mux_enabled)
+        self.settings.setValue("mux/audio_codec", self.mux_audio_codec)
+        self.settings.setValue("mux/delete_originals", self.mux_delete_originals)
+
+    def _on_segment_limits_changed(self):
+        """Update the segment duration/size limits used by the next recording."""
+        self.segment_seconds = self.combo_segment_seconds.currentData() or 0
+        self.segment_mb = self.combo_segment_mb.currentData() or 0
+        self.settings.setValue("recording/segment_seconds", self.segment_seconds)
+        self.settings.setValue("recording/segment_mb", self.segment_mb)
+        print(f"Segment limits changed to: {self.segment_seconds}s / {self.segment_mb} MB")
+        self.standby_timer.start()
+
+    def _on_preroll_limits_changed(self):
+        """Apply new pre-roll limits to the running webcam and remember them."""
+        self.preroll_seconds = self.combo_preroll_seconds.currentData() or 0
+        self.preroll_mb = self.combo_preroll_mb.currentData() or 0
+        self.settings.setValue("preroll/seconds", self.preroll_seconds)
+        self.settings.setValue("preroll/max_mb", self.preroll_mb)
+        if self.webcam_thread and self.webcam_thread.preroll is not None:
+            self.webcam_thread.preroll.configure(self.preroll_seconds, self.preroll_mb * 1024 * 1024)
+        if self.audio_capture:
+            self.audio_capture.history_seconds = self.preroll_seconds + 1.0 # Audio giữ đủ để khớp pre-roll video
+        print(f"Pre-roll limits changed to: {self.preroll_seconds}s / {self.preroll_mb} MB")
+
+    def _make_preroll_buffer(self):
+        """Create the pre-roll buffer type chosen for this station."""
+        max_bytes = self.preroll_mb * 1024 * 1024
+        if self.preroll_mode == "jpeg":
+            return CompressedPreRollBuffer(self.preroll_seconds, max_bytes, quality=self.preroll_jpeg_quality)
+        return PreRollBuffer(self.preroll_seconds, max_bytes)
+
+    def _on_preroll_mode_selected(self, index):
+        """Switch between raw and JPEG pre-roll storage (the buffered frames are dropped)."""
+        if index < 0: return
+        self.preroll_mode = self.combo_preroll_mode.itemData(index)
+        self.settings.setValue("preroll/mode", self.preroll_mode)
+        if self.webcam_thread:
+            old, self.webcam_thread.preroll = self.webcam_thread.preroll, self._make_preroll_buffer()
+            if old is not None: old.shutdown()
+        print(f"Pre-roll mode changed to: {self.preroll_mode}")
+
+    def _on_standby_writer_toggled(self, checked):
+        """Enable/disable keeping a pre-opened writer for the next START."""
+        self.use_standby_writer = checked
+        self.settings.setValue("recording/standby_writer", checked)
+        if checked: self.standby_timer.start()
+        else: self._discard_standby_sink()
+
+    def _on_cfr_toggled(self, checked):
+        """Enable/disable constant-frame-rate correction for the next recording."""
+        self.record_cfr = checked
+        self.settings.setValue("recording/cfr", checked)
+        self.standby_timer.start()
+
+    def _on_adaptive_toggled(self, checked):
+        """Enable/disable load-aware degradation for the next recording."""
+        self.record_adaptive = checked
+        self.settings.setValue("recording/adaptive", checked)
+        self.standby_timer.start()
+
+    def _on_recording_degradation(self, level, reason):
+        """Log a degradation step against the loop whose sink reported it."""
+        sink = self.sender()
+        if sink is None or sink is self.standby_sink: return
+        name = os.path.basename(sink.final_filepath)
+        self._log_serial(f"[{name}] Giảm tải → mức {level} ({RecordingSink.DEGRADE_NAMES[level]}): {reason}")
+
+    def _on_queue_policy_selected(self, index):
+        """Update the full-queue policy used by the next recording."""
+        if index >= 0:
+            self.record_queue_policy = self.combo_queue_policy.itemData(index)
+            print(f"Recording queue policy changed to: {self.record_queue_policy}")
+            self.standby_timer.start()
+
 
     # ================== Webcam Control Methods (Gần như giữ nguyên) ==================
 
@@ -759,20 +4213,33 @@ class MainWindow(QMainWindow):
 
         webcam_idx = self.combo_webcam.itemData(selected_index)
         print(f"Starting webcam {webcam_idx}...")
-        self.video_frame_label.setText(f"Đang kết nối Webcam {webcam_idx}...")
-        self.video_frame_label.repaint()
+        self.video_widget.setText(f"Đang kết nối Webcam {webcam_idx}...")
+        self.video_widget.repaint()
         self.btn_start_webcam.setEnabled(False)
         self.btn_stop_webcam.setEnabled(True)
         self.combo_webcam.setEnabled(False)
+        self.combo_target_fps.setEnabled(False)
         self.btn_scan_webcam.setEnabled(False)
         self._update_status(f"Đang khởi động Webcam {webcam_idx}...")
 
-        self.webcam_thread = WebcamThread(webcam_idx)
-        self.webcam_thread.frame_ready.connect(self._update_frame)
+        self.webcam_thread = WebcamThread(webcam_idx, target_fps=self.combo_target_fps.currentData(),
+                                          capture_format=self.requested_capture_format,
+                                          probe_modes=webcam_idx not in self.camera_modes)
+        self.webcam_thread.preroll = self._make_preroll_buffer()
         self.webcam_thread.error.connect(self._handle_webcam_error)
+        self.webcam_thread.stats_ready.connect(self._on_capture_stats)
+        self.webcam_thread.modes_ready.connect(self._on_capture_modes_ready)
+        self.webcam_thread.backend_ready.connect(self._on_capture_backend_ready)
+        self.webcam_thread.format_applied.connect(self._on_capture_format_applied)
         self.webcam_thread.properties_ready.connect(self._on_webcam_properties_ready)
         self.webcam_thread.finished.connect(self._on_webcam_thread_finished)
+        self._last_preview_seq = 0
+        self.preview_frames_skipped = 0
         self.webcam_thread.start()
+        self.preview_worker = PreviewWorker(self.webcam_thread.preview_mailbox, self.preview_fps)
+        self.preview_worker.set_target_size(self.video_widget.width(), self.video_widget.height())
+        self.preview_worker.start()
+        self.preview_timer.start(self.preview_interval_ms)
 
     def _on_webcam_properties_ready(self, width, height, fps):
         """Slot called when webcam properties are successfully retrieved."""
@@ -787,6 +4254,76 @@ class MainWindow(QMainWindow):
                 self.btn_pause_record.setEnabled(False)
                 self.btn_stop_save_record.setEnabled(False)
                 self.status_timer.start(500)
+                self.standby_timer.start()
+
+    def _on_webcam_selected(self, index):
+        """Show the cached mode table of the newly selected webcam."""
+        self._populate_capture_formats(self.camera_modes.get(self.combo_webcam.itemData(index), []))
+
+    def _populate_capture_formats(self, modes):
+        """Fill the capture format combobox from a probed mode table."""
+        self.combo_capture_format.blockSignals(True)
+        self.combo_capture_format.clear()
+        self.combo_capture_format.addItem("Mặc định driver", userData=None)
+        for mode in modes:
+            fps_text = f"@{mode['fps']:.0f}" if mode['fps'] > 0 else ""
+            self.combo_capture_format.addItem(f"{mode['fourcc']} {mode['width']}x{mode['height']}{fps_text}", userData=mode)
+        selected = 0
+        for i in range(1, self.combo_capture_format.count()):
+            if self.combo_capture_format.itemData(i) == self.requested_capture_format: selected = i
+        self.combo_capture_format.setCurrentIndex(selected)
+        self.combo_capture_format.blockSignals(False)
+
+    def _on_capture_modes_ready(self, modes):
+        """Cache the probed mode table for the running webcam and surface it in the UI."""
+        if not (self.webcam_thread and self.sender() == self.webcam_thread): return
+        self.camera_modes[self.webcam_thread.webcam_index] = modes
+        self._populate_capture_formats(modes)
+        self._log_serial(f"Webcam {self.webcam_thread.webcam_index}: dò được {len(modes)} chế độ.")
+
+    def _on_capture_backend_ready(self, name, attempts):
+        """Log which backend opened the webcam and how long each attempt took."""
+        if not (self.webcam_thread and self.sender() == self.webcam_thread): return
+        timings = ", ".join(f"{n} {ms:.0f} ms{'' if ok else ' lỗi'}" for n, ms, ok in attempts)
+        self._log_serial(f"Webcam {self.webcam_thread.webcam_index} mở bằng {name} ({timings}).")
+
+    def _on_capture_format_applied(self, requested, actual):
+        """Report whether the requested capture format actually took effect."""
+        if not (self.webcam_thread and self.sender() == self.webcam_thread): return
+        req_text = f"{requested.get('fourcc')} {requested.get('width')}x{requested.get('height')}@{requested.get('fps') or 0:.0f}"
+        act_text = f"{actual['fourcc'] or '?'} {actual['width']}x{actual['height']}@{actual['fps']:.0f}"
+        mismatch = ((actual['fourcc'] and actual['fourcc'] != requested.get('fourcc')) or
+                    (actual['width'], actual['height']) != (requested.get('width'), requested.get('height')))
+        if mismatch:
+            self._log_serial(f"CẢNH BÁO: Định dạng yêu cầu {req_text} không được áp dụng, driver dùng {act_text}.")
+        else:
+            self._log_serial(f"Định dạng camera: {act_text}")
+
+    def _on_capture_format_selected(self, index):
+        """Store the requested capture format and restart the webcam to apply it when safe."""
+        if index < 0: return
+        self.requested_capture_format = self.combo_capture_format.itemData(index)
+        if self.webcam_thread and self.webcam_thread.isRunning():
+            if self.is_recording:
+                self._update_status("Định dạng mới sẽ áp dụng khi bật lại webcam.")
+                return
+            print(f"Restarting webcam to apply capture format: {self.requested_capture_format}")
+            self._stop_webcam()
+            self._start_webcam()
+
+    def _on_capture_stats(self, stats):
+        """Show real delivered FPS, jitter and estimated driver drops from WebcamThread."""
+        if not (self.webcam_thread and self.sender() == self.webcam_thread): return
+        text = (f"FPS: {stats['delivered_fps']:.1f}/{stats['capture_fps']:.1f} | "
+                f"Jitter: {stats['jitter_ms']:.1f} ms | Mất (driver): {stats['driver_drops']}")
+        if stats['decimated']: text += f" | Bỏ qua: {stats['decimated']}"
+        if stats.get('pool_misses'): text += f" | Cấp phát thêm: {stats['pool_misses']}"
+        if stats.get('preroll_enabled'):
+            text += f" | Pre-roll: {stats['preroll_seconds']:.1f}s/{stats['preroll_mb']:.0f} MB"
+            if stats['preroll_mode'] == 'jpeg':
+                text += f" (JPEG x{stats['preroll_ratio']:.0f}, {stats['preroll_encode_ms']:.1f} ms/frame"
+                text += f", bỏ {stats['preroll_skipped']})" if stats['preroll_skipped'] else ")"
+        self.lbl_capture_stats.setText(text)
 
     def _stop_webcam(self):
         """Stop the running webcam thread and handle recording state."""
@@ -815,10 +4352,14 @@ class MainWindow(QMainWindow):
 
         if self.webcam_thread:
             # Ngắt kết nối tín hiệu webcam trước khi dừng
+            self.preview_timer.stop()
             signals_to_disconnect = [
-                (self.webcam_thread.frame_ready, self._update_frame),
                 (self.webcam_thread.error, self._handle_webcam_error),
                 (self.webcam_thread.properties_ready, self._on_webcam_properties_ready),
+                (self.webcam_thread.stats_ready, self._on_capture_stats),
+                (self.webcam_thread.modes_ready, self._on_capture_modes_ready),
+                (self.webcam_thread.backend_ready, self._on_capture_backend_ready),
+                (self.webcam_thread.format_applied, self._on_capture_format_applied),
                 (self.webcam_thread.finished, self._on_webcam_thread_finished)
             ]
             for signal, slot in signals_to_disconnect:
@@ -826,42 +4367,36 @@ class MainWindow(QMainWindow):
                 except: pass
 
             self.webcam_thread.stop() # stop() bao gồm wait()
+            # Tín hiệu 'finished' đã bị ngắt ở trên nên tự reset UI tại đây
+            self._on_webcam_thread_finished()
 
     def _on_webcam_thread_finished(self):
         """Slot called when the WebcamThread has completely finished."""
         print("Webcam thread 'finished' signal received. Resetting UI.")
+        # Webcam dừng/lỗi khi đang ghi: lưu phần đã ghi qua cùng đường RecordingFinalizer như lệnh STOP
+        # (chia đoạn, chuyển MP4, ghép A/V) thay vì chờ sink trên luồng GUI
+        if self.is_recording:
+             print("Warning: Webcam finished while recording was active. Saving the partial loop.")
+             self._stop_recording_base("Save", "Webcam")
+        self.preview_timer.stop()
+        if self.preview_worker:
+            self.preview_worker.stop()
+            self.preview_worker = None
+        if self.webcam_thread:
+            self.webcam_thread.preview_mailbox.clear()
+            if self.webcam_thread.preroll is not None: self.webcam_thread.preroll.shutdown()
         self.webcam_thread = None
+        self.standby_timer.stop()
+        self._discard_standby_sink()
 
-        self.video_frame_label.setText("Webcam đã tắt")
-        self.video_frame_label.setPixmap(QPixmap())
+        self.video_widget.setText("Webcam đã tắt")
 
         self.btn_start_webcam.setEnabled(True)
         self.btn_stop_webcam.setEnabled(False)
         self.combo_webcam.setEnabled(True)
+        self.combo_target_fps.setEnabled(True)
         self.btn_scan_webcam.setEnabled(True)
-
-        # Reset recording state (quan trọng nếu webcam bị lỗi khi đang ghi)
-        if self.is_recording:
-             print("Warning: Webcam finished while recording was marked active. Forcing recording stop state.")
-             # Không gọi hàm stop phức tạp ở đây, chỉ reset cờ và UI
-             self.is_recording = False
-             self.is_paused = False
-             # Đảm bảo audio cũng dừng nếu webcam dừng đột ngột
-             if self.audio_thread and self.audio_thread.isRunning():
-                 print("Stopping associated audio thread due to webcam finish.")
-                 self.audio_thread.stop()
-                 if not self.audio_thread.wait(1500): print("Audio thread wait timeout during webcam finish.")
-                 self.audio_thread = None
-                 # Cần xử lý file audio tạm thời ở đây không? Có lẽ nên để lại file đã ghi.
-             # Đảm bảo video writer đóng lại
-             if self.video_writer and self.video_writer.isOpened():
-                 print("Releasing video writer due to webcam finish.")
-                 try: self.video_writer.release()
-                 except Exception as e: print(f"Error releasing video writer: {e}")
-             self.video_writer = None
-             self.last_video_filename = ""
-             self.last_audio_filename = ""
-
+        self.lbl_capture_stats.setText("FPS: - | Jitter: - | Mất (driver): -")
 
         self.btn_start_record.setEnabled(False) # Tắt nút ghi khi webcam tắt
         self.btn_pause_record.setEnabled(False); self.btn_pause_record.setText("Tạm dừng Video")
@@ -883,42 +4418,49 @@ class MainWindow(QMainWindow):
         # else: print(f"Ignoring error from non-active webcam thread: {message}") # Giảm log
 
 
+    def _on_preview_fps_selected(self, index):
+        """Change the preview rate independently of the capture/recording rate."""
+        if index < 0: return
+        self.preview_fps = self.combo_preview_fps.itemData(index)
+        self.preview_interval_ms = int(1000 / self.preview_fps)
+        if self.preview_worker: self.preview_worker.set_preview_fps(self.preview_fps)
+        if self.preview_timer.isActive(): self.preview_timer.start(self.preview_interval_ms)
+
+    def _on_preview_tick(self):
+        """Pull the latest downscaled preview frame (if any newer one arrived) and render it."""
+        worker = self.preview_worker
+        if not worker: return
+        # Worker thu nhỏ theo kích thước hiện tại của widget (gán tuple, rẻ)
+        worker.set_target_size(self.video_widget.width(), self.video_widget.height())
+        seq, frame = worker.output_mailbox.get(self._last_preview_seq)
+        if frame is None: return
+        if seq > self._last_preview_seq + 1:
+            self.preview_frames_skipped += seq - self._last_preview_seq - 1
+        self._last_preview_seq = seq
+        try:
+            self._update_frame(frame)
+        finally:
+            frame.release()
+
     def _update_frame(self, frame):
-        """Update the video display label and write frame if recording."""
+        """Show a PooledFrame in the video widget. Recording is fed directly by WebcamThread."""
         if frame is None: return
 
         try:
-            # Hiển thị frame (giữ nguyên logic)
-            rgb_image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            h, w, ch = rgb_image.shape
-            bytes_per_line = ch * w
-            qt_image = QImage(rgb_image.data, w, h, bytes_per_line, QImage.Format_RGB888)
-            label_size = self.video_frame_label.size()
-            if label_size.width() > 0 and label_size.height() > 0:
-                 pixmap = QPixmap.fromImage(qt_image)
-                 scaled_pixmap = pixmap.scaled(label_size, Qt.KeepAspectRatio, Qt.FastTransformation)
-                 self.video_frame_label.setPixmap(scaled_pixmap)
-            else:
-                 self.video_frame_label.setPixmap(QPixmap.fromImage(qt_image))
-
+            # Widget bọc buffer BGR trực tiếp và vẽ trong paintEvent: không cvtColor/QPixmap/scaled
+            self.video_widget.set_frame(frame)
         except Exception as e:
             print(f"Error converting/displaying frame: {e}", file=sys.stderr)
             # Có thể dừng webcam nếu lỗi hiển thị liên tục
 
-        # Ghi frame video nếu đang ghi và không pause
-        if self.is_recording and not self.is_paused:
-            writer = self.video_writer
-            if writer and writer.isOpened():
-                try:
-                    writer.write(frame) # Ghi frame BGR gốc
-                except Exception as e:
-                    error_msg = f"Lỗi ghi frame video: {e}"
-                    print(error_msg, file=sys.stderr)
-                    self._log_serial(error_msg) # Ghi lỗi vào log serial
-                    # Dừng ghi hình khi có lỗi ghi frame? Cân nhắc
-                    QMessageBox.critical(self, "Lỗi Ghi Video", f"{error_msg}\nĐang dừng ghi hình.")
-                    # Gọi hàm dừng an toàn, giả sử là lưu lại những gì đã có
-                    self._stop_save_recording("VideoWriteError")
+    def _handle_recording_sink_error(self, message):
+        """Handle write errors emitted by the recording sink."""
+        if self.recording_sink and self.sender() == self.recording_sink:
+            print(message, file=sys.stderr)
+            self._log_serial(message) # Ghi lỗi vào log serial
+            QMessageBox.critical(self, "Lỗi Ghi Video", f"{message}\nĐang dừng ghi hình.")
+            # Gọi hàm dừng an toàn, giả sử là lưu lại những gì đã có
+            self._stop_save_recording("VideoWriteError")
 
 
     # ================== Serial Control Methods (Giữ nguyên) ==================
@@ -1042,11 +4584,12 @@ class MainWindow(QMainWindow):
         if directory:
             self.save_directory = directory
             self._update_save_dir_label()
+            self.standby_timer.start() # Writer chờ sẵn phải nằm cùng thư mục để đổi tên khi lưu
             self._update_status(f"Thư mục lưu: {self.save_directory}")
         # else: self._update_status("Việc chọn thư mục bị hủy.") # Giảm log
 
     def _generate_filenames(self):
-        """Generate video (.mp4) and audio (.wav) filenames."""
+        """Generate video (extension of the selected container) and audio (.wav) filenames."""
         # 1. Tăng biến đếm TRƯỚC KHI tạo tên file
         self.recording_session_counter += 1
         counter = self.recording_session_counter
@@ -1060,7 +4603,7 @@ class MainWindow(QMainWindow):
         base_filename = f"Loop_{counter}_{time_str}_{date_str}"
 
         # 4. Tạo tên file video và audio
-        video_filename = f"{base_filename}.mp4"
+        video_filename = f"{base_filename}{container_extension(self.record_container)}"
         audio_filename = f"{base_filename}.wav" # <<< THÊM MỚI: Tên file audio
 
         # 5. Lưu lại tên file gần nhất
@@ -1071,30 +4614,103 @@ class MainWindow(QMainWindow):
         return video_filename, audio_filename # Trả về cả hai tên
 
 
-    def _create_video_writer(self, filepath):
-        """Initialize the OpenCV VideoWriter for MP4."""
+    def _recording_signature(self):
+        """Everything a prepared writer depends on; a standby writer is reused only while this still matches."""
         props = self.webcam_properties
-        if not all(props.values()) or props['width'] <= 0 or props['height'] <= 0 or props['fps'] <= 0:
-             error_msg = f"Lỗi: Thông số webcam không hợp lệ để tạo VideoWriter: {props}"
-             print(error_msg, file=sys.stderr)
-             QMessageBox.critical(self, "Lỗi Ghi Video", error_msg)
-             self._update_status("Lỗi thông số webcam."); return False
+        return (props['width'], props['height'], props['fps'], os.path.abspath(self.save_directory),
+                self.encoder_profile, self.encode_in_process, self.encoder_threads, self.encoder_crf,
+                self.encoder_bitrate, self.segment_seconds,
+                self.segment_mb, self.record_queue_size, self.record_queue_policy, self.record_cfr,
+                self.record_adaptive, self.record_container)
+
+    def _encoder_overrides(self):
+        """ffmpeg options from the settings (threads, CRF, bitrate) for the selected profile; OpenCV writers take none."""
+        if ENCODER_PROFILES[self.encoder_profile][1] is not FFmpegPipeEncoder: return {}
+        overrides = {'threads': self.encoder_threads}
+        if self.encoder_crf >= 0: overrides['crf'] = self.encoder_crf
+        if self.encoder_bitrate: overrides['bitrate'] = self.encoder_bitrate
+        return overrides
+
+    def _recording_writer_opener(self, filepath):
+        """
+        Capture the current encoder settings for filepath.
 
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+        Returns:
+            tuple: (open_writer, fps); open_writer() opens and returns the writer (raises on failure)
+                and only uses the captured values, so it may run on a worker thread.
+        """
+        props = self.webcam_properties
         width = props['width']; height = props['height']; fps = props['fps']
         # Clamp FPS lại một lần nữa cho chắc
         safe_fps = max(1.0, min(120.0, fps))
         if safe_fps != fps: print(f"Warning: Clamping FPS from {fps:.2f} to {safe_fps:.2f} for VideoWriter.")
 
-        try:
+        print(f"Creating encoder: Path='{os.path.basename(filepath)}', Profile={self.encoder_profile}, FPS={safe_fps:.2f}, Size=({width}x{height})")
+        overrides = self._encoder_overrides()
+        profile, in_process, container = self.encoder_profile, self.encode_in_process, self.record_container
+        def open_encoder(path):
+            if in_process:
+                return ProcessEncoder(profile, path, safe_fps, (width, height), container=container, **overrides)
+            return create_container_encoder(container, profile, path, safe_fps, (width, height), **overrides)
+        segment_seconds, segment_bytes = self.segment_seconds, int(self.segment_mb * 1024 * 1024)
+        def open_writer():
             os.makedirs(os.path.dirname(filepath), exist_ok=True)
-            print(f"Creating VideoWriter: Path='{os.path.basename(filepath)}', FourCC=mp4v, FPS={safe_fps:.2f}, Size=({width}x{height})")
-            self.video_writer = cv2.VideoWriter(filepath, fourcc, safe_fps, (width, height))
+            if segment_seconds or segment_bytes:
+                writer = SegmentedEncoder(open_encoder, filepath, safe_fps, segment_seconds=segment_seconds,
+                                          segment_bytes=segment_bytes)
+            else:
+                writer = open_encoder(filepath)
+            if not writer.isOpened():
+                try: writer.release()
+                except Exception: pass
+                raise IOError(f"Không thể mở/tạo file video ({writer.description}): {os.path.basename(filepath)}")
+            return writer
+        return open_writer, safe_fps
+
+    def _open_recording_sink(self, filepath):
+        """Open the selected encoder at filepath and return a started RecordingSink (raises on failure)."""
+        open_writer, fps = self._recording_writer_opener(filepath)
+        return self._start_recording_sink(open_writer(), filepath, fps)
+
+    def _start_recording_sink(self, writer, filepath, fps):
+        """Wrap an opened writer in a RecordingSink with the current queue settings and start it (raises on failure)."""
+        try:
+            sink = RecordingSink(writer, filepath, fps=fps,
+                                 max_queue=self.record_queue_size,
+                                 policy=self.record_queue_policy,
+                                 cfr=self.record_cfr,
+                                 adaptive=self.record_adaptive)
+        except Exception:
+            try: writer.release()
+            except Exception: pass
+            raise
+        sink.container = self.record_container # Bộ hoàn tất cần biết định dạng thật của file khi chuyển sang MP4
+        sink.error.connect(self._handle_recording_sink_error)
+        sink.degradation_changed.connect(self._on_recording_degradation)
+        sink.start()
+        return sink
+
+    def _create_video_writer(self, filepath):
+        """Attach the standby sink (or open the selected encoder) for MP4 recording to filepath."""
+        props = self.webcam_properties
+        if not all(props.values()) or props['width'] <= 0 or props['height'] <= 0 or props['fps'] <= 0:
+             error_msg = f"Lỗi: Thông số webcam không hợp lệ để tạo VideoWriter: {props}"
+             print(error_msg, file=sys.stderr)
+             QMessageBox.critical(self, "Lỗi Ghi Video", error_msg)
+             self._update_status("Lỗi thông số webcam."); return False
 
-            if not self.video_writer.isOpened():
-                raise IOError(f"Không thể mở/tạo file video MP4: {os.path.basename(filepath)}")
+        sink = self._take_standby_sink()
+        if sink:
+            # Encoder đã mở sẵn trên file tạm: chỉ cần ghi nhớ tên đích, đổi tên khi lưu
+            sink.final_filepath = filepath
+            self.recording_sink = sink
+            print(f"Using standby encoder {sink.writer_description} for {os.path.basename(filepath)}")
+            return True
 
-            print(f"VideoWriter MP4 created successfully for {os.path.basename(filepath)}")
+        try:
+            self.recording_sink = self._open_recording_sink(filepath)
+            print(f"Encoder {self.recording_sink.writer_description} created successfully for {os.path.basename(filepath)} "
+                  f"(queue={self.record_queue_size}, policy={self.record_queue_policy})")
             return True
 
         except Exception as e:
@@ -1102,21 +4718,208 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, "Lỗi Ghi Video", error_msg)
             self._update_status(error_msg)
             print(error_msg, file=sys.stderr)
-            if self.video_writer:
-                try: self.video_writer.release()
-                except: pass
-            self.video_writer = None
+            self.recording_sink = None
             return False
 
-    # <<< THÊM MỚI: Hàm xử lý lỗi từ AudioThread >>>
+    def _prepare_standby_sink(self):
+        """Open a recording sink on a temp file in the save directory so the next START only attaches it."""
+        if not self.use_standby_writer or self.is_recording: return
+        if not (self.webcam_thread and self.webcam_thread.isRunning()): return
+        props = self.webcam_properties
+        if not all(props.values()) or not os.path.isdir(self.save_directory): return
+        # Đang mở dở: kết quả được kiểm tra lại khi xong, lệch cấu hình thì chuẩn bị lại
+        if self.standby_opener is not None: return
+        signature = self._recording_signature()
+        if self.standby_sink and self.standby_signature == signature: return
+        self._discard_standby_sink()
+        self.standby_counter += 1
+        temp_path = os.path.join(self.save_directory, f".standby_{os.getpid()}_{self.standby_counter}{container_extension(self.record_container)}")
+        open_writer, fps = self._recording_writer_opener(temp_path)
+        # Mở ffmpeg/tiến trình encoder có thể mất hàng trăm ms: không làm trên luồng GUI
+        self.standby_opener = StandbyWriterOpener(open_writer, temp_path, fps, signature)
+        self.standby_opener.finished.connect(self._on_standby_writer_opened)
+        self.standby_opener.start()
+
+    def _on_standby_writer_opened(self):
+        """Slot: wrap the writer opened in the background as the standby sink, or drop it if it is stale."""
+        opener = self.sender()
+        if opener is None or opener is not self.standby_opener: return
+        self.standby_opener = None
+        writer, opener.writer = opener.writer, None
+        if writer is None:
+            print(f"Cannot prepare standby writer: {opener.error}", file=sys.stderr)
+            return
+        try:
+            sink = self._start_recording_sink(writer, opener.filepath, opener.fps)
+        except Exception as e:
+            print(f"Cannot prepare standby writer: {e}", file=sys.stderr)
+            return
+        self.standby_sink, self.standby_signature = sink, opener.signature
+        if (not self.use_standby_writer or self.is_recording or opener.signature != self._recording_signature()
+                or not (self.webcam_thread and self.webcam_thread.isRunning())):
+            # Cấu hình/trạng thái đã đổi trong lúc mở: bỏ, hẹn giờ chuẩn bị lại (nếu vẫn cần)
+            self._discard_standby_sink()
+            self.standby_timer.start()
+            return
+        print(f"Standby writer ready ({sink.writer_description}) in {opener.seconds * 1000:.0f} ms")
+
+    def _take_standby_sink(self):
+        """Hand over the standby sink if it matches the current settings, else drop it."""
+        sink, self.standby_sink = self.standby_sink, None
+        if sink is None: return None
+        if (self.use_standby_writer and self.standby_signature == self._recording_signature()
+                and sink.isRunning() and sink.writer is not None and sink.writer.isOpened()):
+            return sink
+        self.standby_sink = sink
+        self._discard_standby_sink()
+        return None
+
+    def _discard_standby_sink(self):
+        """Close the unused standby sink and delete its temp files."""
+        sink, self.standby_sink = self.standby_sink, None
+        self.standby_signature = None
+        if sink is None: return
+        paths = sink.output_paths() + sink.sidecar_paths()
+        sink.stop(discard=True)
+        # Chờ encoder đóng (có thể lâu với ffmpeg/tiến trình riêng) rồi xóa file tạm, trên luồng riêng
+        closer = StandbySinkCloser(sink, paths)
+        closer.finished.connect(lambda c=closer: self.standby_closers.remove(c) if c in self.standby_closers else None)
+        self.standby_closers.append(closer)
+        closer.start()
+
+    def _restart_audio_capture(self):
+        """(Re)open the long-lived capture stream on the selected device; returns False if it cannot be opened.
+
+        The stream opens on its own thread; AudioCaptureService.opened / error report the outcome.
+        """
+        self.audio_restart_pending = False
+        old, self.audio_capture = self.audio_capture, None
+        if old is not None:
+            old.stop()
+            if not old.wait(2000): print("Warning: Audio capture did not stop within timeout.")
+        if self.combo_audio_device.itemText(0) == "Không tìm thấy Mic": return False
+        if self.audio_calibrator and self.audio_calibrator.isRunning(): return False # Đang giữ thiết bị
+        self._load_audio_tuning()
+        self.audio_capture = AudioCaptureService(samplerate=self.audio_samplerate, channels=self.audio_channels,
+                                                 device=self.audio_device_index,
+                                                 blocksize=self.audio_blocksize, latency=self.audio_latency,
+                                                 ring_seconds=self.audio_ring_seconds,
+                                                 history_seconds=self.preroll_seconds + 1.0)
+        self.audio_capture.error.connect(self._handle_audio_error)
+        self.audio_capture.opened.connect(self._on_audio_capture_opened)
+        self.audio_capture.start()
+        return True
+
+    def _on_audio_meter_tick(self):
+        capture = self.audio_capture
+        levels = capture.take_levels() if capture is not None and capture.is_capturing() else None
+        if levels is None:
+            if capture is None or not capture.is_capturing(): self.audio_meter.reset()
+            return
+        self.audio_meter.set_levels(levels['rms_db'], levels['peak_db'], levels['clips'])
+
+    def _audio_device_key(self):
+        """Stable settings key for the selected input device (indices change between sessions)."""
+        if self.audio_device_index is None: return "default"
+        try:
+            device = sd.query_devices(self.audio_device_index)
+            name = f"{device['name']} ({sd.query_hostapis(device['hostapi'])['name']})"
+        except Exception:
+            name = str(self.audio_device_index)
+        return name.replace("/", "_").replace("\\", "_")
+
+    def _load_audio_tuning(self):
+        """Use the calibrated blocksize/latency of the selected device, or the defaults."""
+        tuning = self.settings.value(f"audio/tuning/{self._audio_device_key()}", "")
+        try:
+            blocksize, latency = str(tuning).split("|")
+            self.audio_blocksize = int(blocksize)
+            self.audio_latency = latency if latency in ("low", "high") else float(latency)
+        except ValueError:
+            self.audio_blocksize, self.audio_latency = 1024, None
+
+    def _calibrate_audio(self):
+        """Release the device and run an AudioCalibrator on it; the capture stream reopens afterwards."""
+        if self.is_recording:
+            QMessageBox.warning(self, "Cảnh báo", "Dừng ghi trước khi hiệu chỉnh audio."); return
+        if self.audio_calibrator and self.audio_calibrator.isRunning(): return
+        if self.combo_audio_device.itemText(0) == "Không tìm thấy Mic":
+            QMessageBox.warning(self, "Cảnh báo", "Không tìm thấy thiết bị ghi âm thanh."); return
+        self.audio_restart_timer.stop()
+        if self.audio_capture:
+            self.audio_capture.stop()
+            if not self.audio_capture.wait(2000): print("Warning: Audio capture did not stop before calibration.")
+            self.audio_capture = None
+        self.btn_calibrate_audio.setEnabled(False)
+        self.btn_start_record.setEnabled(False)
+        self.audio_calibrator = AudioCalibrator(samplerate=self.audio_samplerate, channels=self.audio_channels,
+                                                device=self.audio_device_index)
+        self.audio_calibrator.progress.connect(self._update_status)
+        self.audio_calibrator.finished_result.connect(self._on_audio_calibrated)
+        self.audio_calibrator.start()
+
+    def _on_audio_calibrated(self, result):
+        """Store the lowest clean setting for this device and reopen the capture stream with it."""
+        self.audio_calibrator.wait()
+        self.audio_calibrator = None
+        key = self._audio_device_key()
+        tried = len(result['trials'])
+        if result['ok']:
+            self.settings.setValue(f"audio/tuning/{key}", f"{result['blocksize']}|{result['latency']}")
+            msg = (f"Hiệu chỉnh audio ({key}): block {result['blocksize']}, latency {result['latency']} "
+                   f"≈ {result['latency_ms']:.1f} ms, sau {tried} lần thử")
+        else:
+            errors = [t['error'] for t in result['trials'] if 'error' in t]
+            msg = f"Hiệu chỉnh audio ({key}) không tìm được cấu hình sạch sau {tried} lần thử" + \
+                  (f": {errors[-1]}" if errors else "")
+        self._log_serial(msg)
+        self._update_status(msg)
+        self.btn_calibrate_audio.setEnabled(True)
+        self.btn_start_record.setEnabled(bool(self.webcam_thread and self.webcam_thread.isRunning()))
+        self._restart_audio_capture()
+
+    def _ensure_audio_capture(self):
+        """
+        The capture stream normally runs already; reopen it if it failed or the device changed.
+
+        Returns:
+            True if capturing, None while the stream is opening (opened/error follow), False if it cannot be opened.
+        """
+        if self.audio_restart_timer.isActive(): self.audio_restart_timer.stop()
+        if self.audio_capture is not None and self.audio_capture.is_capturing(): return True
+        if self.audio_capture is not None and self.audio_capture.is_opening(): return None
+        return None if self._restart_audio_capture() else False
+
+    def _on_audio_capture_opened(self):
+        """Resume a START that was waiting for the capture stream."""
+        if self.sender() != self.audio_capture: return
+        self.audio_open_timer.stop()
+        pending, self.pending_start = self.pending_start, None
+        if pending: self._start_recording(*pending)
+
+    def _on_audio_open_timeout(self):
+        if self.pending_start: self._fail_pending_start("thiết bị âm thanh không mở kịp")
+
+    def _fail_pending_start(self, reason):
+        source, _ = self.pending_start
+        self.pending_start = None
+        self.audio_open_timer.stop()
+        QMessageBox.critical(self, "Lỗi Ghi Âm", "Không thể mở luồng thu âm thanh. Xem Log để biết chi tiết.")
+        self._log_serial(f"[{source}] Ghi thất bại: luồng thu âm không chạy ({reason}).")
+        self._update_status("Ghi thất bại: luồng thu âm không chạy.")
+
     def _handle_audio_error(self, message):
-        """Handle errors emitted by the audio thread."""
-        # Chỉ xử lý lỗi từ thread audio đang hoạt động (nếu có)
-        if self.audio_thread and self.sender() == self.audio_thread:
+        """Handle errors emitted by the audio capture stream."""
+        # Chỉ xử lý lỗi từ luồng thu đang dùng (nếu có)
+        if self.audio_capture and self.sender() == self.audio_capture:
              log_msg = f"LỖI AUDIO: {message}"
              self._log_serial(log_msg) # Ghi vào log serial luôn
              self._update_status(f"Lỗi Audio: Xem Log")
              print(log_msg, file=sys.stderr)
+             if self.pending_start:
+                 self._fail_pending_start(message) # START đang chờ thiết bị mở
+                 return
+             if not self.is_recording: return # Thông báo khi bấm ghi (_start_recording), không hiện hộp thoại lúc khởi động
              QMessageBox.critical(self, "Lỗi Ghi Âm Thanh", message)
              # Lỗi audio có nên dừng cả video không? Có lẽ nên.
              if self.is_recording:
@@ -1126,8 +4929,15 @@ class MainWindow(QMainWindow):
         # else: print(f"Ignoring error from non-active audio thread: {message}") # Giảm log
 
 
-    def _start_recording(self, source="Manual"):
-        """Start both video and audio recording."""
+    def _start_recording(self, source="Manual", requested_at=None):
+        """Start both video and audio recording.
+
+        Args:
+            source (str): Who requested the start (for logs and mux priority).
+            requested_at (float): time.monotonic() of the original START when resumed after the audio
+                stream finished opening; None = now.
+        """
+        if requested_at is None: requested_at = time.monotonic() # Mốc đo độ trễ START -> frame đầu tiên được ghi
         # --- Pre-checks ---
         if not (self.webcam_thread and self.webcam_thread.isRunning()):
              QMessageBox.warning(self, "Cảnh báo", "Webcam chưa bật.")
@@ -1146,40 +4956,41 @@ class MainWindow(QMainWindow):
                  QMessageBox.warning(self, "Cảnh báo", "Không tìm thấy thiết bị ghi âm thanh.")
                  return
 
+        # --- Route Audio FIRST ---
+        # Lý do: Nếu audio thất bại, không cần tạo video writer
+        capture_state = self._ensure_audio_capture()
+        if capture_state is None:
+            # Luồng thu đang mở: tiếp tục START khi có tín hiệu opened (hoặc hủy khi error/hết giờ).
+            # Audio vẫn bắt đầu từ requested_at, phần trước khi thiết bị mở được bỏ qua.
+            self.pending_start = (source, requested_at)
+            self.audio_open_timer.start()
+            self._update_status("Đang mở thiết bị âm thanh...")
+            return
+        if not capture_state:
+            QMessageBox.critical(self, "Lỗi Ghi Âm", "Không thể mở luồng thu âm thanh. Xem Log để biết chi tiết.")
+            self._log_serial(f"[{source}] Ghi thất bại: luồng thu âm không chạy.")
+            return
+
         # --- Generate Filenames ---
         video_filename, audio_filename = self._generate_filenames()
         video_filepath = os.path.join(self.save_directory, video_filename)
         audio_filepath = os.path.join(self.save_directory, audio_filename) # <<< THÊM MỚI
 
-        # --- Start Audio Recording Thread FIRST ---
-        # Lý do: Nếu audio thất bại, không cần tạo video writer
-        print(f"Starting AudioThread for: {audio_filename}")
-        self.audio_thread = AudioThread(
-            filename=audio_filepath,
-            samplerate=self.audio_samplerate,
-            channels=self.audio_channels,
-            device=self.audio_device_index # Lấy từ combobox hoặc None (mặc định)
-        )
-        self.audio_thread.error.connect(self._handle_audio_error)
-        # Kết nối status update nếu muốn log chi tiết hơn
-        # self.audio_thread.status_update.connect(self._log_serial)
-        # Kết nối finished writing nếu cần làm gì đó khi file audio đóng xong
-        # self.audio_thread.finished_writing.connect(lambda fn: print(f"Confirmed audio written: {fn}"))
-        self.audio_thread.start()
-        # Chờ một chút xem audio có báo lỗi ngay không? (Tùy chọn, có thể làm chậm khởi động)
-        # self.audio_thread.msleep(100)
-        # if not self.audio_thread.isRunning(): # Kiểm tra sơ bộ xem thread có chạy không
-        #    QMessageBox.critical(self, "Lỗi Ghi Âm", "Không thể khởi động luồng ghi âm thanh.")
-        #    self.audio_thread = None # Dọn dẹp
-        #    self.last_video_filename = "" # Xóa tên file đã tạo
-        #    self.last_audio_filename = ""
-        #    return # Không tiếp tục nếu audio lỗi ngay
+        # Audio bắt đầu cùng lúc với frame pre-roll cũ nhất (nếu có), nếu không thì tại lệnh START
+        audio_start = requested_at
+        preroll = self.webcam_thread.preroll
+        if preroll is not None and preroll.enabled:
+            audio_start = min(audio_start, preroll.oldest_timestamp() or audio_start)
+        print(f"Routing audio capture to: {audio_filename}")
+        self.audio_loop = self.audio_capture.begin_loop(audio_filepath, start_time=audio_start)
 
         # --- Create Video Writer ---
         if self._create_video_writer(video_filepath):
             # --- Success: Update State & UI ---
             self.is_recording = True
             self.is_paused = False # Video không pause khi bắt đầu
+            self.recording_sink.armed_at = requested_at
+            self.webcam_thread.attach_recording_sink(self.recording_sink) # Bắt đầu nhận frame (kèm pre-roll) từ luồng capture
             status_msg = f"Bắt đầu ghi: {os.path.basename(video_filepath)} + {os.path.basename(audio_filepath)}"
             self._update_status(status_msg)
             self._log_serial(f"Bắt đầu ghi [{source}]: Video={video_filename}, Audio={audio_filename}")
@@ -1192,11 +5003,11 @@ class MainWindow(QMainWindow):
             if not self.status_timer.isActive(): self.status_timer.start(500)
         else:
              # --- Video Writer Failure: Stop Audio Thread ---
-             print("VideoWriter creation failed. Stopping audio thread...")
-             if self.audio_thread and self.audio_thread.isRunning():
-                 self.audio_thread.stop()
-                 if not self.audio_thread.wait(1500): print("Audio thread wait timeout during video writer failure.")
-                 self.audio_thread = None
+             print("VideoWriter creation failed. Stopping audio loop...")
+             if self.audio_loop and self.audio_loop.isRunning():
+                 self.audio_loop.stop()
+                 if not self.audio_loop.wait(1500): print("Audio loop wait timeout during video writer failure.")
+                 self.audio_loop = None
                  # Xóa file audio tạm nếu có thể (thread có thể chưa kịp tạo/ghi)
                  if os.path.exists(audio_filepath):
                      try: os.remove(audio_filepath); print(f"Removed incomplete audio file: {audio_filename}")
@@ -1213,6 +5024,7 @@ class MainWindow(QMainWindow):
              self._log_serial(f"[{source}] Pause/Resume Video bị bỏ qua: Chưa ghi."); return
 
         self.is_paused = not self.is_paused # Toggle state video pause
+        if self.recording_sink: self.recording_sink.set_paused(self.is_paused)
         if self.is_paused:
             self.btn_pause_record.setText("Tiếp tục Video")
             status_msg = "Đã tạm dừng ghi video (audio vẫn ghi)."; log_msg = f"Tạm dừng Video [{source}]."
@@ -1223,7 +5035,12 @@ class MainWindow(QMainWindow):
 
 
     def _stop_recording_base(self, action_type, source):
-        """Core logic to stop video and audio recording."""
+        """Stop video and audio recording; the files are closed and saved/discarded by a RecordingFinalizer."""
+        if self.pending_start and not self.is_recording:
+             # STOP đến khi START còn chờ thiết bị âm thanh: hủy START đó
+             self.pending_start = None
+             self.audio_open_timer.stop()
+             self._log_serial(f"[{source}] Hủy lệnh START đang chờ thiết bị âm thanh."); return False
         if not self.is_recording:
              self._log_serial(f"[{source}] Dừng ({action_type}) bị bỏ qua: Chưa ghi."); return False
 
@@ -1237,119 +5054,35 @@ class MainWindow(QMainWindow):
         video_filepath_to_process = os.path.join(self.save_directory, original_video_filename) if original_video_filename else ""
         audio_filepath_to_process = os.path.join(self.save_directory, original_audio_filename) if original_audio_filename else ""
 
-        # --- 1. Stop Audio Thread ---
-        audio_stopped_cleanly = False
-        if self.audio_thread:
-            audio_thread_ref = self.audio_thread # Giữ tham chiếu tạm
-            self.audio_thread = None # Xóa tham chiếu chính
-            print("Requesting audio thread stop...")
-            audio_thread_ref.stop()
-            if audio_thread_ref.wait(2000): # Chờ tối đa 2 giây
-                 audio_stopped_cleanly = True
-                 print("Audio thread stopped cleanly.")
-            else:
-                 print("Warning: Audio thread did not stop cleanly within timeout.")
-                 # Không terminate audio thread vì có thể làm hỏng file wav
+        # --- 1. Stop feeding audio/video (không chờ trên luồng GUI) ---
+        if self.webcam_thread: self.webcam_thread.detach_recording_sink() # Ngừng đẩy frame mới
+        audio_loop_ref, self.audio_loop = self.audio_loop, None
+        if audio_loop_ref:
+            print("Ending audio loop at current sample...")
+            audio_loop_ref.stop() # Luồng thu vẫn chạy, chỉ ngừng ghi vào file của loop này
         else:
-            print("Warning: No audio thread object found during stop.")
-
-
-        # --- 2. Release Video Writer ---
-        video_writer_released_cleanly = False
-        video_writer_was_opened = False
-        release_error = None
-        writer = self.video_writer
-        if writer:
-            self.video_writer = None # Xóa tham chiếu chính
-            video_writer_was_opened = writer.isOpened()
-            if video_writer_was_opened:
-                print(f"Releasing VideoWriter for {original_video_filename}...")
-                try:
-                    writer.release()
-                    video_writer_released_cleanly = True
-                    print("VideoWriter released successfully.")
-                except Exception as e:
-                    release_error = e
-                    print(f"Error releasing VideoWriter: {e}", file=sys.stderr)
-            else:
-                 print(f"Warning: VideoWriter for {original_video_filename} was not open when stop was requested.")
+            print("Warning: No audio loop object found during stop.")
+        if self.audio_restart_pending: self.audio_restart_timer.start()
+        sink, self.recording_sink = self.recording_sink, None
+        writer_was_opened = False
+        if sink:
+            writer_was_opened = sink.writer is not None and sink.writer.isOpened()
+            sink.stop(discard=(action_type == "Discard"))
         else:
             print("Warning: No video writer object found during stop.")
 
-        # --- 3. Process Files based on Action ---
-        final_status_msg = ""
-        final_log_msg = ""
-
-        if action_type == "Save":
-            # Kiểm tra xem các file có tồn tại không
-            video_exists = video_filepath_to_process and os.path.exists(video_filepath_to_process) and os.path.getsize(video_filepath_to_process) > 0
-            audio_exists = audio_filepath_to_process and os.path.exists(audio_filepath_to_process) and os.path.getsize(audio_filepath_to_process) > 1024 # File wav hợp lệ thường > 1KB
-
-            # Thông báo thành công nếu cả hai file có vẻ ổn
-            if video_writer_released_cleanly and audio_stopped_cleanly and video_exists and audio_exists:
-                 final_status_msg = f"Đã dừng & lưu: {original_video_filename}, {original_audio_filename}"
-                 final_log_msg = f"Dừng & Lưu [{source}]: Video={original_video_filename}, Audio={original_audio_filename}. (Chưa ghép)"
-                 print("Video and Audio saved successfully (separate files).")
-                 # <<< CHỖ ĐỂ GỌI HÀM GHÉP FILE SAU NÀY >>>
-                 # self._merge_audio_video(video_filepath_to_process, audio_filepath_to_process, ...)
-            else:
-                 # Xử lý lỗi lưu
-                 error_parts = []
-                 if not video_writer_released_cleanly: error_parts.append(f"Lỗi đóng video ({release_error or 'không mở'})")
-                 elif not video_exists: error_parts.append("File video không tồn tại/trống")
-                 if not audio_stopped_cleanly: error_parts.append("Lỗi dừng audio")
-                 elif not audio_exists: error_parts.append("File audio không tồn tại/trống")
-
-                 error_details = ", ".join(error_parts) if error_parts else "Lỗi không xác định"
-                 final_status_msg = f"LỖI LƯU ({error_details})"
-                 final_log_msg = f"Dừng & Lỗi Lưu [{source}]: {error_details}. Files: V='{original_video_filename}', A='{original_audio_filename}'"
-                 QMessageBox.warning(self, "Lưu Thất Bại", f"Không thể lưu video và/hoặc audio:\n{error_details}\nVideo: {original_video_filename}\nAudio: {original_audio_filename}")
-
-        elif action_type == "Discard":
-            deleted_video = False
-            deleted_audio = False
-            delete_video_error = None
-            delete_audio_error = None
-
-            # Xóa video nếu writer đã được release (hoặc không mở) và file tồn tại
-            if video_filepath_to_process and (video_writer_released_cleanly or not video_writer_was_opened):
-                 if os.path.exists(video_filepath_to_process):
-                     print(f"Attempting to delete discarded video: {original_video_filename}")
-                     try:
-                         os.remove(video_filepath_to_process)
-                         deleted_video = True
-                         print("-> Deleted video.")
-                     except OSError as e: delete_video_error = e; print(f"-> Error deleting video: {e}")
-                 # else: print(f"Video file {original_video_filename} not found for deletion.")
-
-            # Xóa audio nếu thread đã dừng và file tồn tại
-            if audio_filepath_to_process and audio_stopped_cleanly:
-                 if os.path.exists(audio_filepath_to_process):
-                     print(f"Attempting to delete discarded audio: {original_audio_filename}")
-                     try:
-                         os.remove(audio_filepath_to_process)
-                         deleted_audio = True
-                         print("-> Deleted audio.")
-                     except OSError as e: delete_audio_error = e; print(f"-> Error deleting audio: {e}")
-                 # else: print(f"Audio file {original_audio_filename} not found for deletion.")
-
-            # Tạo thông báo hủy
-            discard_status = []
-            if deleted_video: discard_status.append("Đã xóa video")
-            elif delete_video_error: discard_status.append(f"Lỗi xóa video ({delete_video_error})")
-            elif video_filepath_to_process: discard_status.append("Video không bị xóa") # Hoặc không tồn tại
-
-            if deleted_audio: discard_status.append("Đã xóa audio")
-            elif delete_audio_error: discard_status.append(f"Lỗi xóa audio ({delete_audio_error})")
-            elif audio_filepath_to_process: discard_status.append("Audio không bị xóa")
-
-            discard_details = ", ".join(discard_status) if discard_status else "Trạng thái hủy không xác định"
-            final_status_msg = f"Đã dừng & hủy: {discard_details}"
-            final_log_msg = f"Dừng & Hủy [{source}]: {discard_details}. Files: V='{original_video_filename}', A='{original_audio_filename}'"
+        # --- 2. Close, verify and save/discard the files in the background ---
+        finalizer = RecordingFinalizer(action_type, source, sink, audio_loop_ref, writer_was_opened,
+                                       video_filepath_to_process, audio_filepath_to_process,
+                                       original_video_filename, original_audio_filename,
+                                       remux_to_mp4=self.remux_to_mp4)
+        finalizer.finished_result.connect(self._on_recording_finalized)
+        finalizer.finished.connect(lambda f=finalizer: self.finalizers.remove(f) if f in self.finalizers else None)
+        self.finalizers.append(finalizer)
+        finalizer.start()
 
-        # --- 4. Update UI ---
-        self._update_status(final_status_msg)
-        self._log_serial(final_log_msg)
+        # --- 3. Update UI (loop kế tiếp có thể bắt đầu ngay) ---
+        self._update_status(f"Đang hoàn tất: {original_video_filename or '-'}...")
 
         # Reset filenames sau khi xử lý xong
         self.last_video_filename = ""
@@ -1361,9 +5094,52 @@ class MainWindow(QMainWindow):
         self.btn_pause_record.setEnabled(False); self.btn_pause_record.setText("Tạm dừng Video")
         self.btn_stop_save_record.setEnabled(False)
         self._update_status_visuals() # Cập nhật trạng thái text
+        if webcam_can_run: self.standby_timer.start() # Chuẩn bị writer cho loop kế tiếp
 
         return True # Hàm này trả về True nếu việc dừng được thực hiện (bất kể thành công hay lỗi)
 
+    def _on_recording_finalized(self, result):
+        """Show the outcome of a background finalization."""
+        for line in result['log_lines']: self._log_serial(line)
+        if result['status'] and not self.is_recording: self._update_status(result['status'])
+        if result['log']: self._log_serial(result['log'])
+        print(f"Recording finalized ({result['action']}) in {result['seconds']:.2f}s")
+        if result['warning']:
+            QMessageBox.warning(self, "Lưu Thất Bại", result['warning'])
+        elif result['action'] == "Save" and result['ok'] and self.mux_enabled:
+            self._merge_audio_video(result['video_outputs'], result['audio_path'], result['source'])
+
+    def _merge_audio_video(self, video_outputs, audio_path, source):
+        """Queue a saved loop for muxing; manual saves jump ahead of serial-triggered ones."""
+        if not video_outputs or not audio_path: return
+        priority = MuxQueue.PRIORITY_HIGH if source in ("Manual", "Confirm") else MuxQueue.PRIORITY_NORMAL
+        job = self.mux_queue.submit(video_outputs, audio_path, priority=priority, audio_codec=self.mux_audio_codec,
+                                    delete_originals=self.mux_delete_originals)
+        if job is None:
+            self._log_serial(f"Hàng đợi ghép đầy ({self.mux_queue.max_pending}), giữ file rời: {os.path.basename(audio_path)}")
+            return
+        self._log_serial(f"Đã xếp hàng ghép A/V #{job.id}: {job.label} ({len(job.parts)} phần, "
+                         f"{MUX_AUDIO_CODECS[job.audio_codec][0]})")
+        self._update_mux_label()
+
+    def _update_mux_label(self, current=""):
+        pending, active = self.mux_queue.pending_count(), self.mux_queue.active_count()
+        text = f"Ghép: {active} đang chạy, {pending} chờ" if pending or active else ""
+        self.lbl_mux_status.setText(f"{text} | {current}" if text and current else text)
+
+    def _on_mux_progress(self, job_id, label, fraction):
+        self._update_mux_label(f"{label}: {fraction * 100:.0f}%")
+
+    def _on_mux_finished(self, result):
+        """Log the outcome of a mux job; on failure the separate files are left untouched."""
+        if result['ok']:
+            names = ", ".join(os.path.basename(path) for path in result['outputs'])
+            self._log_serial(f"Đã ghép A/V #{result['id']} trong {result['seconds']:.1f}s: {names}"
+                             + (" (đã xóa file gốc)" if result['deleted_originals'] else ""))
+        else:
+            self._log_serial(f"LỖI ghép A/V #{result['id']} ({result['label']}), giữ file rời: {result['error']}")
+        self._update_mux_label()
+
 
     def _stop_save_recording(self, source="Manual"):
         """Stop recording and save the video/audio files."""
@@ -1449,24 +5225,66 @@ class MainWindow(QMainWindow):
              self._stop_webcam() # Đã bao gồm wait
 
         # Stop audio (nếu chưa dừng bởi _stop_webcam hoặc _confirm)
-        if self.audio_thread and self.audio_thread.isRunning():
-             print("Stopping audio thread (on close)...")
-             self.audio_thread.stop()
-             if not self.audio_thread.wait(1500): print("Audio thread wait timeout on close.")
-             self.audio_thread = None
+        if self.audio_loop and self.audio_loop.isRunning():
+             print("Stopping audio loop (on close)...")
+             self.audio_loop.stop()
+             if not self.audio_loop.wait(1500): print("Audio loop wait timeout on close.")
+             self.audio_loop = None
+        self.audio_restart_timer.stop()
+        self.audio_meter_timer.stop()
+        if self.audio_calibrator:
+             self.audio_calibrator.finished_result.disconnect() # Không mở lại luồng thu khi đang đóng app
+             self.audio_calibrator.stop()
+             self.audio_calibrator.wait(int(AudioCalibrator.TRIAL_SECONDS * 1000) + 2000)
+        if self.audio_capture:
+             print("Closing audio capture stream...")
+             self.audio_capture.stop()
+             if not self.audio_capture.wait(2000): print("Audio capture wait timeout on close.")
+             self.audio_capture = None
+
+        # Chờ lượt quét webcam đang chạy (các lượt dò bị treo đã được bỏ qua sau timeout)
+        if self.camera_scanner and self.camera_scanner.isRunning():
+             print("Waiting for webcam scan to finish...")
+             if not self.camera_scanner.wait(int((self.camera_scanner.probe_timeout + 1) * 1000)):
+                 print("Webcam scan wait timeout on close.")
 
         # Stop serial (hàm _disconnect_serial đã bao gồm ngắt tín hiệu và chờ)
         if self.serial_thread and self.serial_thread.isRunning():
              print("Stopping serial thread...")
              self._disconnect_serial() # Đã bao gồm wait
 
+        self.standby_timer.stop()
+        self._discard_standby_sink()
+        opener, self.standby_opener = self.standby_opener, None
+        if opener is not None and opener.wait(RecordingFinalizer.SINK_TIMEOUT_MS) and opener.writer is not None:
+            # Slot finished không còn chạy khi đóng app: bọc writer mở dở vào sink rồi hủy như thường
+            try:
+                self.standby_sink = self._start_recording_sink(opener.writer, opener.filepath, opener.fps)
+            except Exception as e:
+                print(f"Cannot discard standby writer: {e}", file=sys.stderr)
+            self._discard_standby_sink()
+        for closer in list(self.standby_closers):
+            if not closer.wait(StandbySinkCloser.WAIT_MS + 1000): print("Standby writer close wait timeout on exit.")
+
+        # Chờ các loop đã dừng hoàn tất việc đóng/lưu file
+        for finalizer in list(self.finalizers):
+             print("Waiting for recording finalization...")
+             if not finalizer.wait(RecordingFinalizer.SINK_TIMEOUT_MS + RecordingFinalizer.AUDIO_TIMEOUT_MS):
+                 print("Recording finalizer wait timeout on exit.")
+
+        # Ghép đang chạy bị hủy (file gốc được giữ nguyên), các job còn chờ bị bỏ
+        if self.mux_queue.pending_count() or self.mux_queue.active_count():
+             print(f"Cancelling A/V mux ({self.mux_queue.active_count()} running, {self.mux_queue.pending_count()} queued)...")
+        self.mux_queue.shutdown()
+
         # --- Final Video Writer Check (Safety net) ---
         # Các hàm stop ở trên nên đã xử lý cái này
-        if self.video_writer and self.video_writer.isOpened():
-             print("Warning: Final check releasing video writer on exit...")
-             try: self.video_writer.release(); print(" -> Released.")
-             except Exception as e: print(f" -> Error releasing writer on exit: {e}")
-             self.video_writer = None
+        if self.recording_sink:
+             print("Warning: Final check stopping recording sink on exit...")
+             self.recording_sink.stop()
+             if self.recording_sink.wait(5000): print(" -> Released.")
+             else: print(" -> Recording sink wait timeout on exit.")
+             self.recording_sink = None
 
         print("Exiting application cleanly.")
         event.accept()
@@ -1480,6 +5298,7 @@ if __name__ == '__main__':
     # QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
     # QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)
 
+    multiprocessing.freeze_support() # Cần cho encoder tiến trình riêng khi đóng gói (PyInstaller)
     app = QApplication(sys.argv)
     main_window = MainWindow()
     main_window.show()